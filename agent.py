@@ -37,6 +37,7 @@ from emitter import http_emitter
 from util import (
     EC2,
     get_hostname,
+    HostIdentity,
     Watchdog,
 )
 from utils.flare import configcheck, Flare
@@ -73,6 +74,7 @@ class Agent(Daemon):
         self.collector_profile_interval = DEFAULT_COLLECTOR_PROFILE_INTERVAL
         self.check_frequency = None
         self.configs_reloaded = False
+        self.reload_requested = False
 
     def _handle_sigterm(self, signum, frame):
         """Handles SIGTERM and SIGINT, which gracefully stops the agent."""
@@ -89,24 +91,31 @@ class Agent(Daemon):
         self._do_restart()
 
     def _handle_sighup(self, signum, frame):
-        """Handles SIGHUP, which signals a configuration reload."""
+        """
+        Handles SIGHUP, which signals a configuration reload. The reload
+        resolves the host name and loads the checks, it's done by the main
+        loop.
+        """
         log.info("SIGHUP caught!")
-        self.reload_configs()
-        self.configs_reloaded = True
+        self.reload_requested = True
 
     def reload_configs(self):
         """Reloads the agent configuration and checksd configurations."""
         log.info("Attempting a configuration reload...")
 
         # Reload checksd configs
-        hostname = get_hostname(self._agentConfig)
+        HostIdentity.invalidate()
+        hostname = HostIdentity.get_hostname()
         self._checksd = load_check_directory(self._agentConfig, hostname)
 
         # Logging
         num_checks = len(self._checksd['initialized_checks'])
         if num_checks > 0:
-            log.info("Successfully reloaded {num_checks} checks".
-                     format(num_checks=num_checks))
+            load_stats = self._checksd['load_stats']
+            log.info("Successfully reloaded {num_checks} checks in {duration}s, "
+                     "{reused} of them unchanged".
+                     format(num_checks=num_checks, duration=load_stats['duration'],
+                            reused=load_stats['reused']))
         else:
             log.info("No checksd configs found")
 
@@ -138,7 +147,7 @@ class Agent(Daemon):
             config = get_config(parse_args=True)
 
         self._agentConfig = self._set_agent_config_hostname(config)
-        hostname = get_hostname(self._agentConfig)
+        hostname = HostIdentity.init(self._agentConfig)
         systemStats = get_system_stats()
         emitters = self._get_emitters()
 
@@ -176,6 +185,11 @@ class Agent(Daemon):
                 except Exception as e:
                     log.warn("Cannot enable profiler: %s" % str(e))
 
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload_configs()
+                self.configs_reloaded = True
+
             # Do the work.
             self.collector.run(checksd=self._checksd,
                                start_event=self.start_event,
@@ -733,6 +733,12 @@ class MetricsBucketAggregator(Aggregator):
         self.current_bucket = None
         self.current_mbc = {}
         self.last_flush_cutoff_time = 0
+        # When set, points of contexts that would make a bucket hold more
+        # contexts than this are dropped, e.g. under memory pressure
+        self.context_limit = None
+        self.num_discarded_contexts = 0
+        # Largest number of contexts of a bucket during the last flush
+        self.last_flush_context_count = 0
         self.metric_type_to_class = {
             'g': BucketGauge,
             'c': Counter,
@@ -778,6 +784,9 @@ class MetricsBucketAggregator(Aggregator):
                 self.current_mbc = metric_by_context
 
             if context not in metric_by_context:
+                if self.context_limit is not None and len(metric_by_context) >= self.context_limit:
+                    self.num_discarded_contexts += 1
+                    return
                 metric_class = self.metric_type_to_class[mtype]
                 metric_by_context[context] = metric_class(self.formatter, name, tags,
                     hostname, device_name, self.metric_config.get(metric_class))
@@ -803,6 +812,7 @@ class MetricsBucketAggregator(Aggregator):
         expiry_timestamp = cur_time - self.expiry_seconds
 
         metrics = []
+        context_count = 0
 
         if self.metric_by_bucket:
             # We want to process these in order so that we can check for and expired metrics and
@@ -810,6 +820,7 @@ class MetricsBucketAggregator(Aggregator):
             for bucket_start_timestamp in sorted(self.metric_by_bucket.keys()):
                 metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
                 if bucket_start_timestamp < flush_cutoff_time:
+                    context_count = max(context_count, len(metric_by_context))
                     not_sampled_in_this_bucket = self.last_sample_time_by_context.copy()
                     # We mutate this dictionary while iterating so don't use an iterator.
                     for context, metric in metric_by_context.items():
@@ -839,6 +850,10 @@ class MetricsBucketAggregator(Aggregator):
             log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
             self.num_discarded_old_points = 0
 
+        if self.num_discarded_contexts > 0:
+            log.warn('%s points were discarded as their bucket already had %s contexts' % (self.num_discarded_contexts, self.context_limit))
+            self.num_discarded_contexts = 0
+
         # Save some stats.
         log.debug("received %s payloads since last flush" % self.count)
         self.total_count += self.count
@@ -846,6 +861,7 @@ class MetricsBucketAggregator(Aggregator):
         self.current_bucket = None
         self.current_mbc = {}
         self.last_flush_cutoff_time = flush_cutoff_time
+        self.last_flush_context_count = context_count
         return metrics
 
 
@@ -922,8 +938,8 @@ class MetricsAggregator(Aggregator):
         self.submit_metric(name, value, 'ct-c', tags,
                            hostname, device_name)
 
-    def histogram(self, name, value, tags=None, hostname=None, device_name=None):
-        self.submit_metric(name, value, 'h', tags, hostname, device_name)
+    def histogram(self, name, value, tags=None, hostname=None, device_name=None, sample_rate=1):
+        self.submit_metric(name, value, 'h', tags, hostname, device_name, sample_rate=sample_rate)
 
     def set(self, name, value, tags=None, hostname=None, device_name=None):
         self.submit_metric(name, value, 's', tags, hostname, device_name)
@@ -1,9 +1,6 @@
 # stdlib
 from xml.etree import ElementTree
 
-# third party
-import requests
-
 # project
 from checks import AgentCheck
 
@@ -61,7 +58,7 @@ class ActiveMQXML(AgentCheck):
             auth = (username, password)
         url = "%s%s" % (base_url, xml_url)
         self.log.debug("ActiveMQ Fetching queue data from: %s" % url)
-        r = requests.get(url, auth=auth)
+        r = self.http_get(url, auth=auth)
         r.raise_for_status()
         return r.text
 
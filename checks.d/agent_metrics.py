@@ -8,7 +8,7 @@ except ImportError:
     psutil = None
 
 # project
-from checks import AgentCheck
+from checks import AgentCheck, normalization_cache
 from checks.metric_types import MetricTypes
 from config import _is_affirmative
 
@@ -101,6 +101,17 @@ class AgentMetrics(AgentCheck):
                 full_metric_name = 'datadog.agent.collector.{0}'.format(k)
                 self._send_single_metric(full_metric_name, v, metric_type)
 
+    def _register_normalization_cache_metrics(self):
+        """
+        Usage of the metric names cache shared by the checks, hits, misses
+        and evictions are sent as rates
+        """
+        stats = normalization_cache.get_stats()
+        for key in ('hits', 'misses', 'evictions'):
+            self.rate('datadog.agent.collector.normalization_cache.{0}'.format(key), stats[key])
+        for key in ('entries', 'size'):
+            self.gauge('datadog.agent.collector.normalization_cache.{0}'.format(key), stats[key])
+
     def set_metric_context(self, payload, context):
         self._collector_payload = payload
         self._metric_context = context
@@ -139,6 +150,9 @@ class AgentMetrics(AgentCheck):
                 self.log.info("Emit time (s) is high: %.1f, metrics count: %d, events count: %d",
                               emit_time, len(payload['metrics']), len(payload['events']))
 
+        if self.in_developer_mode:
+            self._register_normalization_cache_metrics()
+
         if cpu_time is not None:
             try:
                 cpu_used_pct = 100.0 * float(cpu_time)/float(collection_time)
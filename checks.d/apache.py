@@ -1,9 +1,6 @@
 # stdlib
 import urlparse
 
-# 3rd party
-import requests
-
 # project
 from checks import AgentCheck
 from util import headers
@@ -51,7 +48,7 @@ class Apache(AgentCheck):
         service_check_name = 'apache.can_connect'
         service_check_tags = ['host:%s' % apache_host, 'port:%s' % apache_port]
         try:
-            r = requests.get(url, auth=auth, headers=headers(self.agentConfig))
+            r = self.http_get(url, auth=auth, headers=headers(self.agentConfig))
             r.raise_for_status()
 
         except Exception:
@@ -40,7 +40,7 @@ class ConsulCheck(AgentCheck):
     def consul_request(self, instance, endpoint):
         url = urljoin(instance.get('url'), endpoint)
         try:
-            resp = requests.get(url)
+            resp = self.http_get(url)
         except requests.exceptions.Timeout:
             self.log.exception('Consul request to {0} timed out'.format(url))
             raise
@@ -49,7 +49,7 @@ class CouchDb(AgentCheck):
         # Override Accept request header so that failures are not redirected to the Futon web-ui
         request_headers = headers(self.agentConfig)
         request_headers['Accept'] = 'text/json'
-        r = requests.get(url, auth=auth, headers=request_headers,
+        r = self.http_get(url, auth=auth, headers=request_headers,
                          timeout=int(instance.get('timeout', self.TIMEOUT)))
         r.raise_for_status()
         return r.json()
@@ -1,13 +1,73 @@
 # stdlib
 from fnmatch import fnmatch
-from os import stat, walk
-from os.path import abspath, exists, join
+import math
+from os import listdir, stat
+from os.path import abspath, exists, islink, join
+import random
+from stat import S_ISDIR
 import time
 
 # project
 from checks import AgentCheck
 from config import _is_affirmative
 
+# Files of a directory whose stats are kept to compute the percentiles of
+# the histograms, bigger directories keep a uniform sample of their files
+MAX_SAMPLES_PER_DIRECTORY = 256
+# Histogram values submitted per instance and run, bigger directories
+# submit a systematic sample of their files (500 to 1000 values), with the
+# matching sample rate
+MAX_HISTOGRAM_SAMPLES = 1000
+# Files with their own gauges when `filegauges` is set
+MAX_FILEGAUGES = 20
+
+
+class DirectorySummary(object):
+    """
+    What the check knows about the files of a single directory (not the
+    ones of its sub-directories), in a bounded amount of memory
+    """
+    __slots__ = ('mtime', 'scanned_at', 'subdirs', 'files', 'bytes', 'minimums', 'maximums',
+                 'samples', 'first_files')
+
+    def __init__(self, mtime, scanned_at):
+        self.mtime = mtime
+        self.scanned_at = scanned_at
+        self.subdirs = []
+        self.files = 0
+        self.bytes = 0
+        # Exact (size, mtime, ctime) minimums and maximums of the files
+        self.minimums = None
+        self.maximums = None
+        # (size, mtime, ctime) of a uniform sample of the files
+        self.samples = []
+        # (path, size, mtime, ctime) of the first files, for `filegauges`
+        self.first_files = []
+
+    def add_file(self, path, file_stat, keep_path):
+        self.files += 1
+        self.bytes += file_stat.st_size
+        values = (file_stat.st_size, file_stat.st_mtime, file_stat.st_ctime)
+        if self.minimums is None:
+            self.minimums = self.maximums = values
+        else:
+            self.minimums = tuple(map(min, self.minimums, values))
+            self.maximums = tuple(map(max, self.maximums, values))
+        if keep_path and len(self.first_files) < MAX_FILEGAUGES:
+            self.first_files.append((path,) + values)
+        # Reservoir sampling
+        if len(self.samples) < MAX_SAMPLES_PER_DIRECTORY:
+            self.samples.append(values)
+        else:
+            index = random.randint(0, self.files - 1)
+            if index < MAX_SAMPLES_PER_DIRECTORY:
+                self.samples[index] = values
+
+    def is_fresh(self, dir_stat):
+        # A change in the same second as the scan may not have changed the
+        # mtime on filesystems with a 1 second resolution
+        return dir_stat.st_mtime == self.mtime and self.mtime < self.scanned_at - 1
+
 
 class DirectoryCheck(AgentCheck):
     """This check is for monitoring and reporting metrics on the files for a provided directory
@@ -22,10 +82,16 @@ class DirectoryCheck(AgentCheck):
         "filegauges" - boolean, when true stats will be an individual gauge per file (max. 20 files!) and not a histogram of the whole directory. default False
         "pattern" - string, the `fnmatch` pattern to use when reading the "directory"'s files. default "*"
         "recursive" - boolean, when true the stats will recurse into directories. default False
+        "incremental" - boolean, when true only the directories whose mtime changed since the last run are read again. default False
     """
 
     SOURCE_TYPE_NAME = 'system'
 
+    def __init__(self, name, init_config, agentConfig, instances=None):
+        AgentCheck.__init__(self, name, init_config, agentConfig, instances)
+        # (directory, pattern, recursive, filegauges) -> {path: DirectorySummary}
+        self._indexes = {}
+
     def check(self, instance):
         if "directory" not in instance:
             raise Exception('DirectoryCheck: missing "directory" in config')
@@ -38,49 +104,170 @@ class DirectoryCheck(AgentCheck):
         dirtagname = instance.get("dirtagname", "name")
         filetagname = instance.get("filetagname", "filename")
         filegauges = _is_affirmative(instance.get("filegauges", False))
+        incremental = _is_affirmative(instance.get("incremental", False))
 
         if not exists(abs_directory):
             raise Exception("DirectoryCheck: the directory (%s) does not exist" % abs_directory)
 
-        self._get_stats(abs_directory, name, dirtagname, filetagname, filegauges, pattern, recursive)
+        self._get_stats(abs_directory, name, dirtagname, filetagname, filegauges, pattern, recursive, incremental)
 
-    def _get_stats(self, directory, name, dirtagname, filetagname, filegauges, pattern, recursive):
+    def _get_stats(self, directory, name, dirtagname, filetagname, filegauges, pattern, recursive, incremental):
         dirtags = [dirtagname + ":%s" % name]
-        directory_bytes = 0
-        directory_files = 0
-        for root, dirs, files in walk(directory):
-            for filename in files:
-                filename = join(root, filename)
-                # check if it passes our filter
-                if not fnmatch(filename, pattern):
-                    continue
-                try:
-                    file_stat = stat(filename)
+        key = (directory, pattern, recursive, filegauges)
+        summaries = self._update_index(key, incremental)
 
-                except OSError, ose:
-                    self.warning("DirectoryCheck: could not stat file %s - %s" % (filename, ose))
-                else:
-                    # file specific metrics
-                    directory_files += 1
-                    directory_bytes += file_stat.st_size
-                    if filegauges and directory_files <= 20:
-                        filetags = list(dirtags)
-                        filetags.append(filetagname + ":%s" % filename)
-                        self.gauge("system.disk.directory.file.bytes", file_stat.st_size, tags=filetags)
-                        self.gauge("system.disk.directory.file.modified_sec_ago", time.time() - file_stat.st_mtime, tags=filetags)
-                        self.gauge("system.disk.directory.file.created_sec_ago", time.time() - file_stat.st_ctime, tags=filetags)
-                    elif not filegauges:
-                        self.histogram("system.disk.directory.file.bytes", file_stat.st_size, tags=dirtags)
-                        self.histogram("system.disk.directory.file.modified_sec_ago", time.time() - file_stat.st_mtime, tags=dirtags)
-                        self.histogram("system.disk.directory.file.created_sec_ago", time.time() - file_stat.st_ctime, tags=dirtags)
-
-            # os.walk gives us all sub-directories and their files
-            # if we do not want to do this recursively and just want
-            # the top level directory we gave it, then break
-            if not recursive:
-                break
+        directory_bytes = sum(summary.bytes for summary in summaries)
+        directory_files = sum(summary.files for summary in summaries)
+
+        now = time.time()
+        if filegauges:
+            first_files = []
+            for summary in summaries:
+                first_files.extend(summary.first_files[:MAX_FILEGAUGES - len(first_files)])
+            for filename, size, mtime, ctime in first_files:
+                filetags = list(dirtags)
+                filetags.append(filetagname + ":%s" % filename)
+                self.gauge("system.disk.directory.file.bytes", size, tags=filetags)
+                self.gauge("system.disk.directory.file.modified_sec_ago", now - mtime, tags=filetags)
+                self.gauge("system.disk.directory.file.created_sec_ago", now - ctime, tags=filetags)
+        elif directory_files:
+            metrics = [
+                ("system.disk.directory.file.bytes", lambda size: size),
+                ("system.disk.directory.file.modified_sec_ago", lambda mtime: now - mtime),
+                ("system.disk.directory.file.created_sec_ago", lambda ctime: now - ctime),
+            ]
+            for i, values in enumerate(self._histogram_values(summaries, directory_files)):
+                metric, convert = metrics[i]
+                for value, weight in values:
+                    self.histogram(metric, convert(value), tags=dirtags, sample_rate=1.0 / weight)
 
         # number of files
         self.gauge("system.disk.directory.files", directory_files, tags=dirtags)
         # total file size
         self.gauge("system.disk.directory.bytes", directory_bytes, tags=dirtags)
+
+    def _update_index(self, key, incremental):
+        """
+        Walk the directory like `os.walk` does, reusing the summary of the
+        directories which didn't change since the last run when
+        `incremental` is set.
+
+        Return the summaries of the directories, in walk order.
+        """
+        directory, pattern, recursive, filegauges = key
+        previous = self._indexes.get(key, {}) if incremental else {}
+        index = {}
+        summaries = []
+
+        # Depth-first, a directory's files come before the ones of its sub-directories
+        to_visit = [directory]
+        while to_visit:
+            path = to_visit.pop()
+            try:
+                dir_stat = stat(path)
+            except OSError, ose:
+                self.warning("DirectoryCheck: could not stat directory %s - %s" % (path, ose))
+                continue
+
+            summary = previous.get(path)
+            if summary is None or not summary.is_fresh(dir_stat):
+                summary = self._scan(path, dir_stat, pattern, filegauges)
+                if summary is None:
+                    continue
+
+            index[path] = summary
+            summaries.append(summary)
+            if recursive:
+                to_visit.extend(reversed(summary.subdirs))
+
+        if incremental:
+            self._indexes[key] = index
+        return summaries
+
+    def _scan(self, path, dir_stat, pattern, filegauges):
+        summary = DirectorySummary(dir_stat.st_mtime, time.time())
+        try:
+            names = listdir(path)
+        except OSError, ose:
+            self.warning("DirectoryCheck: could not list directory %s - %s" % (path, ose))
+            return None
+
+        for name in names:
+            filename = join(path, name)
+            try:
+                file_stat = stat(filename)
+            except OSError, ose:
+                # check if it passes our filter
+                if fnmatch(filename, pattern):
+                    self.warning("DirectoryCheck: could not stat file %s - %s" % (filename, ose))
+                continue
+
+            if S_ISDIR(file_stat.st_mode):
+                # Like os.walk, don't follow symlinks to directories
+                if not islink(filename):
+                    summary.subdirs.append(filename)
+            elif fnmatch(filename, pattern):
+                summary.add_file(filename, file_stat, filegauges)
+
+        return summary
+
+    @classmethod
+    def _histogram_values(cls, summaries, total):
+        """
+        Return, for each of the size, mtime and ctime, the `(value, weight)`
+        pairs to submit to its histogram.
+
+        Without sampling, every file is submitted once. Otherwise the exact
+        minimum and maximum are submitted once each, and the sampled files
+        stand for the other ones: the weights (powers of 2, see `_resample`)
+        add up to the number of files, so the count is exact too.
+        """
+        step, samples = cls._resample(summaries, total)
+        if step == 1 and all(len(summary.samples) == summary.files for summary in summaries):
+            return [[(sample[i], 1) for sample in samples] for i in range(3)]
+
+        minimums = [summary.minimums for summary in summaries if summary.files]
+        maximums = [summary.maximums for summary in summaries if summary.files]
+        # Weights of the samples, each one stands for `step` files and
+        # the remainder is split in powers of 2
+        remaining = total - 2
+        weights = [step] * (remaining // step)
+        bit = 1
+        while bit < step:
+            if remaining % step & bit:
+                weights.append(bit)
+            bit *= 2
+
+        histograms = []
+        for i in range(3):
+            values = [(min(m[i] for m in minimums), 1), (max(m[i] for m in maximums), 1)]
+            values.extend((samples[j % len(samples)][i], weight) for j, weight in enumerate(weights))
+            histograms.append(values)
+        return histograms
+
+    @staticmethod
+    def _resample(summaries, total):
+        """
+        Pick at most about `MAX_HISTOGRAM_SAMPLES` file stats from the
+        samples of the directories, each one standing for
+        `directory files / directory samples` files.
+
+        Return `(step, samples)`, each picked sample stands for `step` files.
+        `step` is a power of 2 so that `1 / (1.0 / step)` is exactly `step`.
+        """
+        step = 1
+        if total > MAX_HISTOGRAM_SAMPLES:
+            step = 2 ** int(math.ceil(math.log(float(total) / MAX_HISTOGRAM_SAMPLES, 2)))
+        picked = []
+        position = step / 2.0
+        cumulated = 0.0
+        for summary in summaries:
+            if not summary.samples:
+                continue
+            weight = float(summary.files) / len(summary.samples)
+            for sample in summary.samples:
+                cumulated += weight
+                while position < cumulated:
+                    picked.append(sample)
+                    position += step
+        return step, picked
@@ -1,7 +1,6 @@
 # stdlib
 import os
 import re
-import requests
 import time
 import socket
 import urllib2
@@ -401,7 +400,7 @@ class DockerDaemon(AgentCheck):
         port = ports.keys()[0].split('/')[0] if ports else None
         ecs_tags = {}
         if ip and port:
-            tasks = requests.get('http://%s:%s/v1/tasks' % (ip, port)).json()
+            tasks = self.http_get('http://%s:%s/v1/tasks' % (ip, port)).json()
             for task in tasks.get('Tasks', []):
                 for container in task.get('Containers', []):
                     tags = ['task_name:%s' % task['Family'], 'task_version:%s' % task['Version']]
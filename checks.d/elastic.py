@@ -3,9 +3,6 @@ from collections import defaultdict, namedtuple
 import time
 import urlparse
 
-# 3p
-import requests
-
 # project
 from checks import AgentCheck
 from config import _is_affirmative
@@ -380,7 +377,7 @@ class ESCheck(AgentCheck):
             auth = None
 
         try:
-            resp = requests.get(
+            resp = self.http_get(
                 url,
                 timeout=config.timeout,
                 headers=headers(self.agentConfig),
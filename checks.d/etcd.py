@@ -161,7 +161,7 @@ class Etcd(AgentCheck):
             if 'ssl_certfile' in ssl_params and 'ssl_keyfile' in ssl_params:
                 certificate = (ssl_params['ssl_certfile'], ssl_params['ssl_keyfile'])
             verify = ssl_params.get('ssl_ca_certs', True) if ssl_params['ssl_cert_validation'] else False
-            r = requests.get(url, verify=verify, cert=certificate, timeout=timeout, headers=headers(self.agentConfig))
+            r = self.http_get(url, verify=verify, cert=certificate, timeout=timeout, headers=headers(self.agentConfig))
         except requests.exceptions.Timeout:
             # If there's a timeout
             self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.CRITICAL,
@@ -1,9 +1,6 @@
 # stdlib
 import urlparse
 
-# 3rd party
-import requests
-
 # project
 from checks import AgentCheck
 from util import headers
@@ -40,7 +37,7 @@ class Fluentd(AgentCheck):
             service_check_tags = ['fluentd_host:%s' % monitor_agent_host, 'fluentd_port:%s'
                                   % monitor_agent_port]
 
-            r = requests.get(url, headers=headers(self.agentConfig))
+            r = self.http_get(url, headers=headers(self.agentConfig))
             r.raise_for_status()
             status = r.json()
 
@@ -2,9 +2,6 @@
 from collections import defaultdict
 import re
 
-# 3rd party
-import requests
-
 # project
 from checks import AgentCheck
 
@@ -57,7 +54,7 @@ class GoExpvar(AgentCheck):
         self._last_gc_count = defaultdict(int)
 
     def _get_data(self, url):
-        r = requests.get(url)
+        r = self.http_get(url)
         r.raise_for_status()
         return r.json()
 
@@ -3,9 +3,6 @@ from collections import defaultdict
 import re
 import time
 
-# 3rd party
-import requests
-
 # project
 from checks import AgentCheck
 from config import _is_affirmative
@@ -110,7 +107,7 @@ class HAProxy(AgentCheck):
 
         self.log.debug("HAProxy Fetching haproxy search data from: %s" % url)
 
-        r = requests.get(url, auth=auth, headers=headers(self.agentConfig))
+        r = self.http_get(url, auth=auth, headers=headers(self.agentConfig))
         r.raise_for_status()
 
         return r.content.splitlines()
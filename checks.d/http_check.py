@@ -10,6 +10,7 @@ from urlparse import urlparse
 # 3rd party
 import requests
 import tornado
+from tornado.httpclient import HTTPRequest
 
 # project
 from checks.network_checks import EventType, NetworkCheck, Status
@@ -112,31 +113,108 @@ class HTTPCheck(NetworkCheck):
             raise
 
         # Only report this metric if the site is not down
-        if response_time and not service_checks:
+        if not service_checks:
             # Stop the timer as early as possible
             running_time = time.time() - start
+            service_checks = self._check_response(addr, running_time, r.status_code, r.content,
+                                                  http_response_status_code, content_match,
+                                                  response_time, tags)
+
+        if ssl_expire and urlparse(addr)[0] == "https":
+            status, msg = self.check_cert_expiration(instance, timeout, instance_ca_certs)
+            service_checks.append((
+                self.SC_SSL_CERT, status, msg
+            ))
+
+        return service_checks
+
+    def _can_probe(self, instance):
+        # The HTTP client of the probe engine doesn't go through proxies
+        return not requests.utils.get_environ_proxies(instance.get('url') or '')
+
+    def _probe(self, instance, engine, done):
+        addr, username, password, http_response_status_code, timeout, include_content, headers,\
+            response_time, content_match, tags, disable_ssl_validation,\
+            ssl_expire, instance_ca_certs = self._load_conf(instance)
+        start = time.time()
+
+        self.log.debug("Connecting to %s" % addr)
+        if disable_ssl_validation and urlparse(addr)[0] == "https":
+            self.warning("Skipping SSL certificate validation for %s based on configuration"
+                         % addr)
+
+        if username is None or password is None:
+            username = password = None
+
+        request = HTTPRequest(addr, headers=headers,
+                              auth_username=username, auth_password=password,
+                              connect_timeout=timeout, request_timeout=timeout,
+                              validate_cert=not disable_ssl_validation,
+                              ca_certs=instance_ca_certs)
+
+        def on_cert(service_checks, error, cert):
+            if error is not None:
+                status, msg = Status.DOWN, "%s" % (str(error))
+            else:
+                status, msg = self.get_cert_status(instance, cert)
+            service_checks.append((
+                self.SC_SSL_CERT, status, msg
+            ))
+            done(service_checks)
+
+        def on_response(response):
+            running_time = time.time() - start
+            if response.code == 599:
+                # No HTTP response, tornado's code for connection errors and timeouts
+                length = int(running_time * 1000)
+                self.log.info("%s is DOWN, error: %s. Connection failed after %s ms"
+                              % (addr, str(response.error), length))
+                service_checks = [(
+                    self.SC_STATUS,
+                    Status.DOWN,
+                    "%s. Connection failed after %s ms" % (str(response.error), length)
+                )]
+            else:
+                service_checks = self._check_response(addr, running_time, response.code,
+                                                      response.body or '',
+                                                      http_response_status_code, content_match,
+                                                      response_time, tags)
+
+            if ssl_expire and urlparse(addr)[0] == "https":
+                o = urlparse(addr)
+                engine.get_peer_cert(o.hostname, o.port or 443, timeout, instance_ca_certs,
+                                     lambda error, cert: on_cert(service_checks, error, cert))
+            else:
+                done(service_checks)
+
+        engine.fetch(request, on_response)
+
+    def _check_response(self, addr, running_time, status_code, content,
+                        http_response_status_code, content_match, response_time, tags):
+        service_checks = []
+
+        if response_time:
             # Store tags in a temporary list so that we don't modify the global tags data structure
             tags_list = list(tags)
             tags_list.append('url:%s' % addr)
             self.gauge('network.http.response_time', running_time, tags=tags_list)
 
         # Check HTTP response status code
-        if not (service_checks or re.match(http_response_status_code, str(r.status_code))):
+        if not re.match(http_response_status_code, str(status_code)):
             self.log.info("Incorrect HTTP return code. Expected %s, got %s"
-                          % (http_response_status_code, str(r.status_code)))
+                          % (http_response_status_code, str(status_code)))
 
             service_checks.append((
                 self.SC_STATUS,
                 Status.DOWN,
                 "Incorrect HTTP return code. Expected %s, got %s"
-                % (http_response_status_code, str(r.status_code))
+                % (http_response_status_code, str(status_code))
             ))
 
-        if not service_checks:
+        else:
             # Host is UP
             # Check content matching is set
             if content_match:
-                content = r.content
                 if re.search(content_match, content):
                     self.log.debug("%s is found in return content" % content_match)
                     service_checks.append((
@@ -156,12 +234,6 @@ class HTTPCheck(NetworkCheck):
                     self.SC_STATUS, Status.UP, "UP"
                 ))
 
-        if ssl_expire and urlparse(addr)[0] == "https":
-            status, msg = self.check_cert_expiration(instance, timeout, instance_ca_certs)
-            service_checks.append((
-                self.SC_SSL_CERT, status, msg
-            ))
-
         return service_checks
 
     # FIXME: 5.3 drop this function
@@ -264,7 +336,6 @@ class HTTPCheck(NetworkCheck):
                            )
 
     def check_cert_expiration(self, instance, timeout, instance_ca_certs):
-        warning_days = int(instance.get('days_warning', 14))
         url = instance.get('url')
 
         o = urlparse(url)
@@ -283,6 +354,10 @@ class HTTPCheck(NetworkCheck):
         except Exception as e:
             return Status.DOWN, "%s" % (str(e))
 
+        return self.get_cert_status(instance, cert)
+
+    def get_cert_status(self, instance, cert):
+        warning_days = int(instance.get('days_warning', 14))
         exp_date = datetime.strptime(cert['notAfter'], "%b %d %H:%M:%S %Y %Z")
         days_left = exp_date - datetime.utcnow()
 
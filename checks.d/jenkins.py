@@ -2,12 +2,29 @@
 from collections import defaultdict
 from glob import glob
 import os
+import tempfile
 import time
-from xml.etree.ElementTree import ElementTree
+from xml.etree.cElementTree import iterparse
 
 # project
 from checks import AgentCheck
-from util import get_hostname
+from config import _windows_commondata_path
+from util import get_hostname, json, Platform
+from utils.pidfile import PidFile
+
+# Path of the git branch of the build in build.xml, under its root element
+# (build, matrix-build, maven2-moduleset-build...)
+BRANCH_PATH = (
+    'actions',
+    'hudson.plugins.git.util.BuildData',
+    'buildsByBranchName',
+    'entry',
+    'hudson.plugins.git.util.Build',
+    'revision',
+    'branches',
+    'hudson.plugins.git.Branch',
+    'name',
+)
 
 
 class Skip(Exception):
@@ -21,18 +38,90 @@ class Skip(Exception):
 
 
 class Jenkins(AgentCheck):
+    """
+    Sends an event and metrics for each new build result.
+
+    The check keeps an index of the job and build directories keyed on
+    their mtime, with the last build seen for each job: a job whose
+    `builds` directory didn't change since the last run isn't looked at,
+    and only the builds newer than the last one seen get their `build.xml`
+    parsed. The index and the high watermarks are saved to a state file,
+    so that the builds that ran while the agent was stopped are reported
+    when it starts again.
+    """
     datetime_format = '%Y-%m-%d_%H-%M-%S'
 
     def __init__(self, name, init_config, agentConfig):
         AgentCheck.__init__(self, name, init_config, agentConfig)
         self.high_watermarks = {}
+        # instance name -> {'jenkins_home', 'jobs_mtime', 'jobs_scanned_at', 'job_names', 'jobs'}
+        # with {job name: {'mtime', 'scanned_at', 'pending', 'number'}} in 'jobs'
+        self._indexes = {}
+        self.state_path = self._get_state_path()
+        self._saved_state = None
 
-    def _timestamp_from_build_file(self, dir_name, tree):
-        timestamp = tree.find('timestamp')
-        if timestamp is None or not timestamp.text:
-            raise Skip('the timestamp cannot be found', dir_name)
+    @classmethod
+    def _get_state_path(cls):
+        if Platform.is_win32():
+            path = os.path.join(_windows_commondata_path(), 'Datadog')
+        elif os.path.isdir(PidFile.get_dir()):
+            path = PidFile.get_dir()
         else:
-            return int(timestamp.text) / 1000.0
+            path = tempfile.gettempdir()
+        return os.path.join(path, 'jenkins_state.json')
+
+    def _read_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.loads(f.read())
+        except IOError:
+            return {}
+        except Exception:
+            self.log.warning("Ignoring invalid Jenkins state file %s", self.state_path, exc_info=True)
+            return {}
+
+    def _load_state(self, instance_key, jenkins_home):
+        """
+        Restore the index and the high watermarks of an instance saved by
+        a previous run of the agent, return False if there aren't any.
+        """
+        state = self._read_state().get(instance_key)
+        if not state or state.get('jenkins_home') != jenkins_home:
+            return False
+
+        watermarks = state.pop('watermarks', {})
+        self.high_watermarks[instance_key] = defaultdict(lambda: 0, watermarks)
+        self._indexes[instance_key] = state
+        return True
+
+    def _save_state(self):
+        state = {}
+        for instance_key, index in self._indexes.iteritems():
+            state[instance_key] = dict(index, watermarks=dict(self.high_watermarks.get(instance_key, {})))
+
+        serialized = json.dumps(state, sort_keys=True)
+        if serialized == self._saved_state:
+            return
+
+        # Other instances may not have run yet in this agent
+        saved = self._read_state()
+        saved.update(state)
+
+        # Write then rename, a crash must not leave a truncated file behind
+        tmp_path = self.state_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(json.dumps(saved))
+            os.rename(tmp_path, self.state_path)
+            self._saved_state = serialized
+        except Exception:
+            self.log.warning("Unable to save the Jenkins state to %s", self.state_path, exc_info=True)
+
+    @staticmethod
+    def _is_fresh(entry, mtime):
+        # A change in the same second as the scan may not have changed the
+        # mtime on filesystems with a 1 second resolution
+        return entry is not None and entry.get('mtime') == mtime and mtime < entry.get('scanned_at', 0) - 1
 
     def _timestamp_from_dirname(self, dir_name):
         if not os.path.isdir(dir_name):
@@ -46,6 +135,36 @@ class Jenkins(AgentCheck):
         except ValueError:
             return None
 
+    def _parse_build_file(self, build_metadata, needed):
+        """
+        Read the fields of build.xml we're interested in, stopping as soon
+        as the `needed` ones are found: `actions`, which holds the git
+        branch, comes first and everything after the result is skipped.
+        """
+        d = {}
+        path = []
+        needed = set(needed)
+        with open(build_metadata) as f:
+            for event, elem in iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    path.append(elem.tag)
+                    continue
+
+                if len(path) == 2 and path[1] in ('result', 'number', 'duration', 'timestamp'):
+                    if elem.text:
+                        d[path[1]] = elem.text
+                        needed.discard(path[1])
+                        if not needed:
+                            break
+                elif tuple(path[1:]) == BRANCH_PATH and 'branch' not in d:
+                    d['branch'] = elem.text
+
+                path.pop()
+                if len(path) == 1:
+                    # Done with this top-level element, free it
+                    elem.clear()
+        return d
+
     def _get_build_metadata(self, dir_name, watermark):
         if os.path.exists(os.path.join(dir_name, 'jenkins_build.tar.gz')):
             raise Skip('the build has already been archived', dir_name)
@@ -60,62 +179,104 @@ class Jenkins(AgentCheck):
             self.log.debug("Can't read build file at %s" % (build_metadata))
             raise Exception("Can't access build.xml at %s" % (build_metadata))
         else:
-            tree = ElementTree()
-            tree.parse(build_metadata)
+            needed = ['result', 'duration']
+            if timestamp is None:
+                needed.append('timestamp')
+            if not os.path.basename(dir_name).isdigit():
+                # Before Jenkins v1.597 the number isn't the name of the directory
+                needed.append('number')
+
+            d = self._parse_build_file(build_metadata, needed)
             if timestamp is None:
+                if not d.get('timestamp'):
+                    raise Skip('the timestamp cannot be found', dir_name)
                 try:
-                    timestamp = self._timestamp_from_build_file(dir_name, tree)
-                    # This is not the latest build
-                    if timestamp <= watermark:
-                        return None
+                    timestamp = int(d['timestamp']) / 1000.0
                 except ValueError:
                     return None
-            keys = ['result', 'number', 'duration']
-
-            kv_pairs = ((k, tree.find(k)) for k in keys)
-            d = dict([(k, v.text) for k, v in kv_pairs if v is not None])
+                # This is not the latest build
+                if timestamp <= watermark:
+                    return None
             d['timestamp'] = timestamp
-
-            try:
-                d['branch'] = tree.find('actions')\
-                    .find('hudson.plugins.git.util.BuildData')\
-                    .find('buildsByBranchName')\
-                    .find('entry')\
-                    .find('hudson.plugins.git.util.Build')\
-                    .find('revision')\
-                    .find('branches')\
-                    .find('hudson.plugins.git.Branch')\
-                    .find('name')\
-                    .text
-            except Exception:
-                pass
             return d
 
+    def _get_job_names(self, index, jenkins_home):
+        jobs_dir = os.path.join(jenkins_home, 'jobs')
+        try:
+            mtime = os.stat(jobs_dir).st_mtime
+        except OSError:
+            return []
+
+        if self._is_fresh({'mtime': index.get('jobs_mtime'), 'scanned_at': index.get('jobs_scanned_at')}, mtime):
+            return index['job_names']
+
+        job_names = sorted(os.path.basename(job_dir) for job_dir in glob(os.path.join(jobs_dir, '*')))
+        index['jobs_mtime'] = mtime
+        index['jobs_scanned_at'] = time.time()
+        index['job_names'] = job_names
+        # Forget about the jobs which were removed
+        index['jobs'] = dict((name, job) for name, job in index.get('jobs', {}).iteritems()
+                             if name in job_names)
+        return job_names
+
     def _get_build_results(self, instance_key, job_dir):
         job_name = os.path.basename(job_dir)
+        jobs_index = self._indexes[instance_key].setdefault('jobs', {})
+        job_index = jobs_index.get(job_name)
         try:
-            dirs = glob(os.path.join(job_dir, 'builds', '*_*'))
+            builds_dir = os.path.join(job_dir, 'builds')
+            try:
+                mtime = os.stat(builds_dir).st_mtime
+            except OSError:
+                return
+
+            # Nothing new since the last run
+            if self._is_fresh(job_index, mtime) and not job_index.get('pending'):
+                return
+
+            last_number = job_index.get('number') if job_index else None
+            job_index = jobs_index[job_name] = {
+                'mtime': mtime,
+                'scanned_at': time.time(),
+                'pending': False,
+                'number': last_number,
+            }
+
+            dirs = glob(os.path.join(builds_dir, '*_*'))
             # Before Jenkins v1.597 the build folders were named with a timestamp (eg: 2015-03-10_19-59-29)
             # Starting from Jenkins v1.597 they are named after the build ID (1, 2, 3...)
             # So we need try both format when trying to find the latest build and parsing build.xml
             if len(dirs) == 0:
-                dirs = glob(os.path.join(job_dir, 'builds', '[0-9]*'))
+                dirs = glob(os.path.join(builds_dir, '[0-9]*'))
             if len(dirs) > 0:
                 # versions of Jenkins > 1.597 need to be sorted by build number (integer)
                 try:
                     dirs = sorted(dirs, key=lambda x: int(x.split('/')[-1]), reverse=True)
                 except ValueError:
                     dirs = sorted(dirs, reverse=True)
-                # We try to get the last valid build
+                # Report the builds newer than the watermark, newest first.
+                # A job seen for the first time only reports its latest one.
+                watermark = self.high_watermarks[instance_key][job_name]
+                reported = False
                 for dir_name in dirs:
-                    watermark = self.high_watermarks[instance_key][job_name]
+                    build_name = dir_name.split('/')[-1]
+                    # Already seen, no need to read its build.xml
+                    if build_name.isdigit() and last_number is not None and int(build_name) <= last_number:
+                        break
+
                     try:
                         build_metadata = self._get_build_metadata(dir_name, watermark)
+                    except Skip:
+                        build_metadata = None
                     except Exception:
+                        # Maybe still being written, try again on the next run
+                        job_index['pending'] = True
                         build_metadata = None
                     if build_metadata is not None:
                         build_result = build_metadata.get('result')
                         if build_result is None:
+                            # Still running
+                            job_index['pending'] = True
                             break
 
                         output = {
@@ -125,10 +286,16 @@ class Jenkins(AgentCheck):
 
                         output.update(build_metadata)
                         if 'number' not in output:
-                            output['number'] = dir_name.split('/')[-1]
-                        self.high_watermarks[instance_key][job_name] = output.get('timestamp')
+                            output['number'] = build_name
+                        if not reported:
+                            self.high_watermarks[instance_key][job_name] = output.get('timestamp')
+                            if build_name.isdigit():
+                                job_index['number'] = int(build_name)
+                            reported = True
                         self.log.debug("Processing %s results '%s'" % (job_name, output))
                         yield output
+                        if not watermark:
+                            break
 
                     # If it not a new build, stop here
                     else:
@@ -137,30 +304,35 @@ class Jenkins(AgentCheck):
             self.log.error("Error while working on job %s, exception: %s" % (job_name, e))
 
     def check(self, instance, create_event=True):
-        if self.high_watermarks.get(instance.get('name'), None) is None:
-            # On the first run of check(), prime the high_watermarks dict
-            # so that we only send events that occured after the agent
-            # started.
-            # (Setting high_watermarks in the next statement prevents
-            #  any kind of infinite loop (assuming nothing ever sets
-            #  high_watermarks to None again!))
-            self.high_watermarks[instance.get('name')] = defaultdict(lambda: 0)
-            self.check(instance, create_event=False)
-
+        instance_key = instance.get('name')
         jenkins_home = instance.get('jenkins_home')
 
+        if self.high_watermarks.get(instance_key, None) is None:
+            if not self._load_state(instance_key, jenkins_home):
+                # On the first run of check(), prime the high_watermarks dict
+                # so that we only send events that occured after the agent
+                # started.
+                # (Setting high_watermarks in the next statement prevents
+                #  any kind of infinite loop (assuming nothing ever sets
+                #  high_watermarks to None again!))
+                self.high_watermarks[instance_key] = defaultdict(lambda: 0)
+                self.check(instance, create_event=False)
+
         if not jenkins_home:
             raise Exception("No jenkins_home directory set in the config file")
 
-        jenkins_jobs_dir = os.path.join(jenkins_home, 'jobs', '*')
-        job_dirs = glob(jenkins_jobs_dir)
+        index = self._indexes.get(instance_key)
+        if index is None or index.get('jenkins_home') != jenkins_home:
+            index = self._indexes[instance_key] = {'jenkins_home': jenkins_home}
 
-        if not job_dirs:
+        job_names = self._get_job_names(index, jenkins_home)
+        if not job_names:
             raise Exception('No jobs found in `%s`! '
-                            'Check `jenkins_home` in your config' % (jenkins_jobs_dir))
+                            'Check `jenkins_home` in your config' % (os.path.join(jenkins_home, 'jobs', '*')))
 
-        for job_dir in job_dirs:
-            for output in self._get_build_results(instance.get('name'), job_dir):
+        for job_name in job_names:
+            job_dir = os.path.join(jenkins_home, 'jobs', job_name)
+            for output in self._get_build_results(instance_key, job_dir):
                 output['host'] = get_hostname(self.agentConfig)
                 if create_event:
                     self.log.debug("Creating event for job: %s" % output['job_name'])
@@ -180,3 +352,5 @@ class Jenkins(AgentCheck):
                         self.increment('jenkins.job.success', tags=tags)
                     else:
                         self.increment('jenkins.job.failure', tags=tags)
+
+        self._save_state()
@@ -1,5 +1,6 @@
 # stdlib
 from collections import defaultdict
+import time
 
 # 3p
 from kafka.client import KafkaClient
@@ -24,6 +25,102 @@ class KafkaCheck(AgentCheck):
             init_config.get('zk_timeout', DEFAULT_ZK_TIMEOUT))
         self.kafka_timeout = int(
             init_config.get('kafka_timeout', DEFAULT_KAFKA_TIMEOUT))
+        # Long-lived connections, by connection string
+        self.zk_conns = {}
+        self.kafka_conns = {}
+
+    def stop(self):
+        for zk_connect_str in self.zk_conns.keys():
+            self._close_zk_conn(zk_connect_str)
+        for kafka_host_ports in self.kafka_conns.keys():
+            self._close_kafka_conn(kafka_host_ports)
+
+    def _get_zk_conn(self, zk_connect_str):
+        """
+        Get and memoize a started Zookeeper client. Kazoo takes care
+        of reconnecting it if the connection is lost.
+        """
+        if zk_connect_str not in self.zk_conns:
+            zk_conn = KazooClient(zk_connect_str, timeout=self.zk_timeout)
+            zk_conn.start(timeout=self.zk_timeout)
+            self.zk_conns[zk_connect_str] = zk_conn
+        return self.zk_conns[zk_connect_str]
+
+    def _close_zk_conn(self, zk_connect_str):
+        zk_conn = self.zk_conns.pop(zk_connect_str, None)
+        if zk_conn is None:
+            return
+        try:
+            zk_conn.stop()
+            zk_conn.close()
+        except Exception:
+            self.log.exception('Error cleaning up Zookeeper connection')
+
+    def _get_kafka_conn(self, kafka_host_ports):
+        if kafka_host_ports not in self.kafka_conns:
+            self.kafka_conns[kafka_host_ports] = KafkaClient(
+                kafka_host_ports, timeout=self.kafka_timeout)
+        return self.kafka_conns[kafka_host_ports]
+
+    def _close_kafka_conn(self, kafka_host_ports):
+        kafka_conn = self.kafka_conns.pop(kafka_host_ports, None)
+        if kafka_conn is None:
+            return
+        try:
+            kafka_conn.close()
+        except Exception:
+            self.log.exception('Error cleaning up Kafka connection')
+
+    def _get_consumer_offsets(self, zk_conn, consumer_groups, zk_path_tmpl):
+        """
+        Read all the consumer offsets from Zookeeper. All the reads are sent
+        at once, without waiting for the previous ones to complete.
+        Return the consumer offsets and the partitions of each topic.
+        """
+        topics = defaultdict(set)
+        async_reads = []
+        for consumer_group, topic_partitions in consumer_groups.iteritems():
+            for topic, partitions in topic_partitions.iteritems():
+                # Remember the topic partitions that we've see so that we can
+                # look up their broker offsets later
+                topics[topic].update(set(partitions))
+                for partition in partitions:
+                    zk_path = zk_path_tmpl % (consumer_group, topic, partition)
+                    key = (consumer_group, topic, partition)
+                    async_reads.append((key, zk_path, zk_conn.get_async(zk_path)))
+
+        consumer_offsets = {}
+        for key, zk_path, async_read in async_reads:
+            try:
+                consumer_offsets[key] = int(async_read.get(timeout=self.zk_timeout)[0])
+            except NoNodeError:
+                self.log.warn('No zookeeper node at %s' % zk_path)
+            except Exception:
+                self.log.exception('Could not read consumer offset from %s' % zk_path)
+
+        return consumer_offsets, topics
+
+    def _get_broker_offsets(self, kafka_conn, topics):
+        """
+        Query Kafka for the broker offsets of all the partitions, in a
+        single offset request per leader broker.
+        """
+        requests = [OffsetRequest(topic, p, -1, 1)
+                    for topic, partitions in topics.iteritems()
+                    for p in partitions]
+        offset_responses = kafka_conn.send_offset_request(requests, fail_on_error=False)
+
+        broker_offsets = {}
+        for resp in offset_responses:
+            if resp.error:
+                # The leader may have moved, refresh the metadata on the next run
+                kafka_conn.reset_topic_metadata(resp.topic)
+                self.log.warn('Could not fetch the broker offset of partition %s of topic %s: error %s'
+                              % (resp.partition, resp.topic, resp.error))
+                continue
+            broker_offsets[(resp.topic, resp.partition)] = resp.offsets[0]
+
+        return broker_offsets
 
     def check(self, instance):
         consumer_groups = self.read_config(instance, 'consumer_groups',
@@ -35,53 +132,30 @@ class KafkaCheck(AgentCheck):
         zk_prefix = instance.get('zk_prefix', '')
         zk_path_tmpl = zk_prefix + '/consumers/%s/offsets/%s/%s'
 
-        # Connect to Zookeeper
-        zk_conn = KazooClient(zk_connect_str, timeout=self.zk_timeout)
-        zk_conn.start()
-
+        # Query Zookeeper for consumer offsets
+        start = time.time()
         try:
-            # Query Zookeeper for consumer offsets
-            consumer_offsets = {}
-            topics = defaultdict(set)
-            for consumer_group, topic_partitions in consumer_groups.iteritems():
-                for topic, partitions in topic_partitions.iteritems():
-                    # Remember the topic partitions that we've see so that we can
-                    # look up their broker offsets later
-                    topics[topic].update(set(partitions))
-                    for partition in partitions:
-                        zk_path = zk_path_tmpl % (consumer_group, topic, partition)
-                        try:
-                            consumer_offset = int(zk_conn.get(zk_path)[0])
-                            key = (consumer_group, topic, partition)
-                            consumer_offsets[key] = consumer_offset
-                        except NoNodeError:
-                            self.log.warn('No zookeeper node at %s' % zk_path)
-                        except Exception:
-                            self.log.exception('Could not read consumer offset from %s' % zk_path)
-        finally:
-            try:
-                zk_conn.stop()
-                zk_conn.close()
-            except Exception:
-                self.log.exception('Error cleaning up Zookeeper connection')
-
-        # Connect to Kafka
-        kafka_conn = KafkaClient(kafka_host_ports, timeout=self.kafka_timeout)
-
+            zk_conn = self._get_zk_conn(zk_connect_str)
+            consumer_offsets, topics = self._get_consumer_offsets(
+                zk_conn, consumer_groups, zk_path_tmpl)
+        except Exception:
+            # Start from a new connection on the next run
+            self._close_zk_conn(zk_connect_str)
+            raise
+        zk_time = time.time() - start
+
+        # Query Kafka for the broker offsets
+        start = time.time()
         try:
-            # Query Kafka for the broker offsets
-            broker_offsets = {}
-            for topic, partitions in topics.items():
-                offset_responses = kafka_conn.send_offset_request([
-                    OffsetRequest(topic, p, -1, 1) for p in partitions])
-
-                for resp in offset_responses:
-                    broker_offsets[(resp.topic, resp.partition)] = resp.offsets[0]
-        finally:
-            try:
-                kafka_conn.close()
-            except Exception:
-                self.log.exception('Error cleaning up Kafka connection')
+            kafka_conn = self._get_kafka_conn(kafka_host_ports)
+            broker_offsets = self._get_broker_offsets(kafka_conn, topics)
+        except Exception:
+            self._close_kafka_conn(kafka_host_ports)
+            raise
+        kafka_time = time.time() - start
+
+        self.log.debug('Fetched %s consumer offsets in %.3fs and %s broker offsets in %.3fs'
+                       % (len(consumer_offsets), zk_time, len(broker_offsets), kafka_time))
 
         # Report the broker data
         for (topic, partition), broker_offset in broker_offsets.items():
@@ -99,8 +173,9 @@ class KafkaCheck(AgentCheck):
             tags = ['topic:%s' % topic, 'partition:%s' % partition,
                     'consumer_group:%s' % consumer_group]
             self.gauge('kafka.consumer_offset', consumer_offset, tags=tags)
-            self.gauge('kafka.consumer_lag', broker_offset - consumer_offset,
-                       tags=tags)
+            if broker_offset is not None:
+                self.gauge('kafka.consumer_lag', broker_offset - consumer_offset,
+                           tags=tags)
 
     # Private config validation/marshalling functions
 
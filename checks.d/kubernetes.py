@@ -9,9 +9,6 @@ from urlparse import urljoin
 from fnmatch import fnmatch
 import re
 
-# 3rd party
-import requests
-
 # project
 from checks import AgentCheck
 from config import _is_affirmative
@@ -73,7 +70,7 @@ class Kubernetes(AgentCheck):
         service_check_base = NAMESPACE + '.kubelet.check'
         is_ok = True
         try:
-            r = requests.get(url)
+            r = self.http_get(url)
             for line in r.iter_lines():
 
                 # avoid noise; this check is expected to fail since we override the container hostname
@@ -105,7 +102,7 @@ class Kubernetes(AgentCheck):
 
     def _perform_master_checks(self, url):
         try:
-            r = requests.get(url)
+            r = self.http_get(url)
             r.raise_for_status()
             for nodeinfo in r.json()['items']:
                 nodename = nodeinfo['name']
@@ -179,7 +176,7 @@ class Kubernetes(AgentCheck):
             self._publish_raw_metrics(metric, dat[-1], tags, depth + 1)
 
     def _retrieve_json(self, url):
-        r = requests.get(url)
+        r = self.http_get(url)
         r.raise_for_status()
         return r.json()
 
@@ -2,9 +2,6 @@
 import re
 import urlparse
 
-# 3rd party
-import requests
-
 # project
 from checks import AgentCheck
 from util import headers
@@ -89,7 +86,7 @@ class Lighttpd(AgentCheck):
         lighttpd_port = parsed_url.port or 80
         service_check_tags = ['host:%s' % lighttpd_url, 'port:%s' % lighttpd_port]
         try:
-            r = requests.get(url, auth=auth, headers=headers(self.agentConfig))
+            r = self.http_get(url, auth=auth, headers=headers(self.agentConfig))
             r.raise_for_status()
         except Exception:
             self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.CRITICAL,
@@ -84,7 +84,7 @@ class Mesos(AgentCheck):
         msg = None
         status = None
         try:
-            r = requests.get(url, timeout=timeout)
+            r = self.http_get(url, timeout=timeout)
             if r.status_code != 200:
                 self.status_code_event(url, r, aggregation_key)
                 status = AgentCheck.CRITICAL
@@ -95,7 +95,7 @@ class MesosSlave(AgentCheck):
         msg = None
         status = None
         try:
-            r = requests.get(url, timeout=timeout)
+            r = self.http_get(url, timeout=timeout)
             if r.status_code != 200:
                 status = AgentCheck.CRITICAL
                 msg = "Got %s when hitting %s" % (r.status_code, url)
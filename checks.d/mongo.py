@@ -1,19 +1,27 @@
 # stdlib
 import time
+import timeit
 
 # 3p
 import pymongo
 
 # project
 from checks import AgentCheck
+from checks.libs.thread_pool import Pool
 from config import _is_affirmative
 from util import get_hostname
 
 DEFAULT_TIMEOUT = 30
+# serverStatus, dbstats and replSetGetStatus are issued concurrently
+DEFAULT_THREADS_COUNT = 3
 GAUGE = AgentCheck.gauge
 RATE = AgentCheck.rate
 
 
+class MongoAuthenticationError(Exception):
+    pass
+
+
 class MongoDb(AgentCheck):
     SERVICE_CHECK_NAME = 'mongodb.can_connect'
     SOURCE_TYPE_NAME = 'mongodb'
@@ -132,6 +140,8 @@ class MongoDb(AgentCheck):
         AgentCheck.__init__(self, name, init_config, agentConfig, instances)
         self._last_state_by_server = {}
         self.metrics_to_collect_by_instance = {}
+        self._clients = {}
+        self.pool = None
 
     def get_library_versions(self):
         return {"pymongo": pymongo.version}
@@ -216,6 +226,171 @@ class MongoDb(AgentCheck):
 
         return self.normalize(metric_name.lower(), 'mongodb')
 
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        for server in set(key[0] for key in self._clients):
+            self._close_clients(server)
+
+    def _get_pool(self):
+        if self.pool is None:
+            self.pool = Pool(DEFAULT_THREADS_COUNT, name=self.name)
+        return self.pool
+
+    @staticmethod
+    def _timed(timings, step, func, *args, **kwargs):
+        """
+        Call `func` and store its run time in `timings[step]`.
+        """
+        start = timeit.default_timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[step] = timeit.default_timer() - start
+
+    def _get_client(self, server, timeout, ssl_params, db_name, do_auth,
+                    username, password, replica_set=None):
+        """
+        Get and memoize an authenticated MongoClient per server (and replica
+        set), so that topology discovery and authentication only happen once.
+        """
+        key = (server, replica_set)
+        if key in self._clients:
+            return self._clients[key]
+
+        if replica_set is None:
+            cli = pymongo.mongo_client.MongoClient(
+                server,
+                socketTimeoutMS=timeout,
+                read_preference=pymongo.ReadPreference.PRIMARY_PREFERRED,
+                **ssl_params)
+        else:
+            cli = pymongo.mongo_client.MongoClient(
+                server,
+                socketTimeoutMS=timeout,
+                replicaset=replica_set,
+                read_preference=pymongo.ReadPreference.NEAREST,
+                **ssl_params)
+
+        # Credentials are kept by the client, which authenticates
+        # its new sockets by itself
+        if do_auth and not cli[db_name].authenticate(username, password):
+            cli.close()
+            raise MongoAuthenticationError(
+                "Mongo: cannot connect with config %s" % server)
+
+        self._clients[key] = cli
+        return cli
+
+    def _close_clients(self, server):
+        for key in self._clients.keys():
+            if key[0] != server:
+                continue
+            cli = self._clients.pop(key)
+            try:
+                cli.close()
+            except Exception:
+                self.log.debug("Could not close MongoClient", exc_info=True)
+
+    def _collect_stats(self, cli, db, admindb, timings, server, clean_server_name,
+                       timeout, ssl_params, db_name, do_auth, username, password,
+                       collect_tcmalloc_metrics):
+        """
+        Issue `serverStatus`, `dbstats` and `replSetGetStatus` concurrently,
+        then `dbstats` on every database.
+        Return the status and the dbstats per database.
+        """
+        pool = self._get_pool()
+        status_res = pool.apply_async(
+            self._timed,
+            (timings, 'server_status', db["$cmd"].find_one,
+             {"serverStatus": 1, "tcmalloc": collect_tcmalloc_metrics}))
+        stats_res = pool.apply_async(
+            self._timed, (timings, 'dbstats', db.command, 'dbstats'))
+        repl_res = pool.apply_async(
+            self._timed, (timings, 'repl_set_status', admindb.command, 'replSetGetStatus'))
+
+        status = status_res.get()
+        if status['ok'] == 0:
+            raise Exception(status['errmsg'].__str__())
+
+        status['stats'] = stats_res.get()
+        dbstats = {}
+        dbstats[db_name] = {'stats': status['stats']}
+
+        # Handle replica data, if any
+        # See
+        # http://www.mongodb.org/display/DOCS/Replica+Set+Commands#ReplicaSetCommands-replSetGetStatus  # noqa
+        try:
+            data = {}
+
+            replSet = repl_res.get()
+            if replSet:
+                primary = None
+                current = None
+
+                # need a new connection to deal with replica sets
+                setname = replSet.get('set')
+                cli = self._timed(
+                    timings, 'connect_replica_set', self._get_client,
+                    server, timeout, ssl_params, db_name, do_auth, username,
+                    password, replica_set=setname)
+
+                # find nodes: master and current node (ourself)
+                for member in replSet.get('members'):
+                    if member.get('self'):
+                        current = member
+                    if int(member.get('state')) == 1:
+                        primary = member
+
+                # If we have both we can compute a lag time
+                if current is not None and primary is not None:
+                    lag = primary['optimeDate'] - current['optimeDate']
+                    # Python 2.7 has this built in, python < 2.7 don't...
+                    if hasattr(lag, 'total_seconds'):
+                        data['replicationLag'] = lag.total_seconds()
+                    else:
+                        data['replicationLag'] = (
+                            lag.microseconds +
+                            (lag.seconds + lag.days * 24 * 3600) * 10**6
+                        ) / 10.0**6
+
+                if current is not None:
+                    data['health'] = current['health']
+
+                data['state'] = replSet['myState']
+                self.check_last_state(
+                    data['state'],
+                    clean_server_name,
+                    self.agentConfig)
+                status['replSet'] = data
+
+        except Exception as e:
+            if "OperationFailure" in repr(e) and "replSetGetStatus" in str(e):
+                pass
+            else:
+                raise e
+
+        # If these keys exist, remove them for now as they cannot be serialized
+        try:
+            status['backgroundFlushing'].pop('last_finished')
+        except KeyError:
+            pass
+        try:
+            status.pop('localTime')
+        except KeyError:
+            pass
+
+        dbnames = self._timed(timings, 'database_names', cli.database_names)
+        start = timeit.default_timer()
+        all_stats = pool.map(lambda db_n: cli[db_n].command('dbstats'), dbnames)
+        timings['all_dbstats'] = timeit.default_timer() - start
+        for db_n, stats in zip(dbnames, all_stats):
+            dbstats[db_n] = {'stats': stats}
+
+        return status, dbstats
+
     def check(self, instance):
         """
         Returns a dictionary that looks a lot like what's sent back by
@@ -252,6 +427,9 @@ class MongoDb(AgentCheck):
         collect_tcmalloc_metrics = _is_affirmative(
             instance.get('collect_tcmalloc_metrics', False)
         )
+        collect_timing_metrics = _is_affirmative(
+            instance.get('collect_timing_metrics', False)
+        )
         metrics_to_collect = self._get_metrics_to_collect(
             server,
             collect_tcmalloc_metrics=collect_tcmalloc_metrics,
@@ -283,124 +461,69 @@ class MongoDb(AgentCheck):
             do_auth = False
 
         timeout = float(instance.get('timeout', DEFAULT_TIMEOUT)) * 1000
+        timings = {}
         try:
-            cli = pymongo.mongo_client.MongoClient(
-                server,
-                socketTimeoutMS=timeout,
-                read_preference=pymongo.ReadPreference.PRIMARY_PREFERRED,
-                **ssl_params)
+            cli = self._timed(
+                timings, 'connect', self._get_client,
+                server, timeout, ssl_params, db_name, do_auth, username, password)
             # some commands can only go against the admin DB
             admindb = cli['admin']
             db = cli[db_name]
-        except Exception:
+        except Exception, e:
+            message = None
+            if isinstance(e, MongoAuthenticationError):
+                message = str(e)
             self.service_check(
                 self.SERVICE_CHECK_NAME,
                 AgentCheck.CRITICAL,
-                tags=service_check_tags)
+                tags=service_check_tags,
+                message=message)
             raise
 
-        if do_auth and not db.authenticate(username, password):
-            message = "Mongo: cannot connect with config %s" % server
+        # A cached client doesn't talk to the server before the status
+        # commands, the server is only known to be up once they succeed
+        try:
+            status, dbstats = self._collect_stats(
+                cli, db, admindb, timings, server, clean_server_name, timeout,
+                ssl_params, db_name, do_auth, username, password,
+                collect_tcmalloc_metrics)
+        except MongoAuthenticationError, e:
+            # e.g. the replica set client
             self.service_check(
                 self.SERVICE_CHECK_NAME,
                 AgentCheck.CRITICAL,
                 tags=service_check_tags,
-                message=message)
-            raise Exception(message)
+                message=str(e))
+            raise
+        except pymongo.errors.ConnectionFailure, e:
+            # Drop the cached clients, they will be re-created on the next run
+            self._close_clients(server)
+            self.service_check(
+                self.SERVICE_CHECK_NAME,
+                AgentCheck.CRITICAL,
+                tags=service_check_tags,
+                message=str(e))
+            raise
+        except Exception:
+            # The server answered
+            self.service_check(
+                self.SERVICE_CHECK_NAME,
+                AgentCheck.OK,
+                tags=service_check_tags)
+            raise
 
         self.service_check(
             self.SERVICE_CHECK_NAME,
             AgentCheck.OK,
             tags=service_check_tags)
 
-        status = db["$cmd"].find_one({"serverStatus": 1, "tcmalloc": collect_tcmalloc_metrics})
-        if status['ok'] == 0:
-            raise Exception(status['errmsg'].__str__())
-
-        status['stats'] = db.command('dbstats')
-        dbstats = {}
-        dbstats[db_name] = {'stats': status['stats']}
-
-        # Handle replica data, if any
-        # See
-        # http://www.mongodb.org/display/DOCS/Replica+Set+Commands#ReplicaSetCommands-replSetGetStatus  # noqa
-        try:
-            data = {}
-            dbnames = []
-
-            replSet = admindb.command('replSetGetStatus')
-            if replSet:
-                primary = None
-                current = None
-
-                # need a new connection to deal with replica sets
-                setname = replSet.get('set')
-                cli = pymongo.mongo_client.MongoClient(
-                    server,
-                    socketTimeoutMS=timeout,
-                    replicaset=setname,
-                    read_preference=pymongo.ReadPreference.NEAREST,
-                    **ssl_params)
-                db = cli[db_name]
-
-                if do_auth and not db.authenticate(username, password):
-                    message = ("Mongo: cannot connect with config %s" % server)
-                    self.service_check(
-                        self.SERVICE_CHECK_NAME,
-                        AgentCheck.CRITICAL,
-                        tags=service_check_tags,
-                        message=message)
-                    raise Exception(message)
-
-                # find nodes: master and current node (ourself)
-                for member in replSet.get('members'):
-                    if member.get('self'):
-                        current = member
-                    if int(member.get('state')) == 1:
-                        primary = member
-
-                # If we have both we can compute a lag time
-                if current is not None and primary is not None:
-                    lag = primary['optimeDate'] - current['optimeDate']
-                    # Python 2.7 has this built in, python < 2.7 don't...
-                    if hasattr(lag, 'total_seconds'):
-                        data['replicationLag'] = lag.total_seconds()
-                    else:
-                        data['replicationLag'] = (
-                            lag.microseconds +
-                            (lag.seconds + lag.days * 24 * 3600) * 10**6
-                        ) / 10.0**6
-
-                if current is not None:
-                    data['health'] = current['health']
-
-                data['state'] = replSet['myState']
-                self.check_last_state(
-                    data['state'],
-                    clean_server_name,
-                    self.agentConfig)
-                status['replSet'] = data
-
-        except Exception as e:
-            if "OperationFailure" in repr(e) and "replSetGetStatus" in str(e):
-                pass
-            else:
-                raise e
-
-        # If these keys exist, remove them for now as they cannot be serialized
-        try:
-            status['backgroundFlushing'].pop('last_finished')
-        except KeyError:
-            pass
-        try:
-            status.pop('localTime')
-        except KeyError:
-            pass
-
-        dbnames = cli.database_names()
-        for db_n in dbnames:
-            db_aux = cli[db_n]
-            dbstats[db_n] = {'stats': db_aux.command('dbstats')}
+        self.log.debug(
+            u"Collection time breakdown for %s: %s", clean_server_name,
+            ", ".join("%s=%.3fs" % (step, t) for step, t in sorted(timings.iteritems()))
+        )
+        if collect_timing_metrics:
+            for step, t in timings.iteritems():
+                self.gauge('mongodb.collection_time.%s' % step, t, tags=tags)
 
         # Go through the metrics and save the values
         for metric_name, submit_method in metrics_to_collect.iteritems():
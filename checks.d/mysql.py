@@ -6,6 +6,7 @@ import traceback
 
 # 3p
 import pymysql
+from pymysql.constants import CLIENT
 
 # project
 from checks import AgentCheck
@@ -57,8 +58,10 @@ class MySql(AgentCheck):
 
     def __init__(self, name, init_config, agentConfig, instances=None):
         AgentCheck.__init__(self, name, init_config, agentConfig, instances)
+        self.dbs = {}
         self.mysql_version = {}
         self.greater_502 = {}
+        self.server_pids = {}
 
     def get_library_versions(self):
         return {"pymysql": pymysql.__version__}
@@ -72,18 +75,25 @@ class MySql(AgentCheck):
         if (not host or not user) and not defaults_file:
             raise Exception("Mysql host and user are needed.")
 
-        db = self._connect(host, port, mysql_sock, user, password, defaults_file)
+        key = (host, port, mysql_sock, user, defaults_file)
+        db = self._get_connection(key, host, port, mysql_sock, user, password, defaults_file)
 
         # Metadata collection
-        self._collect_metadata(db, host)
+        self._collect_metadata(db, key)
 
         # Metric collection
-        self._collect_metrics(host, db, tags, options, queries)
-        if Platform.is_linux():
-            self._collect_system_metrics(host, db, tags)
+        try:
+            self._collect_metrics(key, host, db, tags, options, queries)
+        except Exception, e:
+            if self._is_connection_error(e):
+                # The cached connection went away between the health check
+                # and the queries: drop it, it will be re-established next run
+                self._close_connection(key)
+            raise
 
-        # Close connection
-        db.close()
+    def stop(self):
+        for key in self.dbs.keys():
+            self._close_connection(key)
 
     def _get_config(self, instance):
         host = instance.get('server', '')
@@ -98,57 +108,164 @@ class MySql(AgentCheck):
 
         return host, port, user, password, mysql_sock, defaults_file, tags, options, queries
 
-    def _connect(self, host, port, mysql_sock, user, password, defaults_file):
-        service_check_tags = [
+    def _get_service_check_tags(self, host, port, mysql_sock):
+        if mysql_sock != '':
+            return [
+                'host:%s' % mysql_sock,
+                'port:unix_socket'
+            ]
+        return [
             'host:%s' % host,
             'port:%s' % port
         ]
 
-        try:
-            if defaults_file != '':
-                db = pymysql.connect(read_default_file=defaults_file)
-            elif mysql_sock != '':
-                db = pymysql.connect(
-                    unix_socket=mysql_sock,
-                    user=user,
-                    passwd=password
-                )
-                service_check_tags = [
-                    'host:%s' % mysql_sock,
-                    'port:unix_socket'
-                ]
-            elif port:
-                db = pymysql.connect(
-                    host=host,
-                    port=port,
-                    user=user,
-                    passwd=password
-                )
-            else:
-                db = pymysql.connect(
-                    host=host,
-                    user=user,
-                    passwd=password
-                )
-            self.log.debug("Connected to MySQL")
-            self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.OK,
-                               tags=service_check_tags)
-        except Exception:
-            self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.CRITICAL,
-                               tags=service_check_tags)
-            raise
+    def _get_connection(self, key, host, port, mysql_sock, user, password, defaults_file):
+        """
+        Get and memoize connections to instances.
+        A cached connection is health-checked with a ping and re-established
+        if the server went away.
+        """
+        service_check_tags = self._get_service_check_tags(host, port, mysql_sock)
+
+        db = self.dbs.get(key)
+        if db is not None:
+            try:
+                db.ping(False)
+            except Exception:
+                self.log.info("Resetting the MySQL connection")
+                self._close_connection(key)
+                db = None
 
+        if db is None:
+            try:
+                db = self._connect(host, port, mysql_sock, user, password, defaults_file)
+            except Exception:
+                self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.CRITICAL,
+                                   tags=service_check_tags)
+                raise
+            self.dbs[key] = db
+
+        self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.OK,
+                           tags=service_check_tags)
         return db
 
-    def _collect_metrics(self, host, db, tags, options, queries):
+    def _close_connection(self, key):
+        """
+        Close and forget the connection for `key`, along with what was cached
+        about the server behind it: a new connection may reach a restarted
+        or upgraded server.
+        """
+        db = self.dbs.pop(key, None)
+        self.mysql_version.pop(key, None)
+        self.greater_502.pop(key, None)
+        self.server_pids.pop(key, None)
+        if db is not None:
+            try:
+                db.close()
+            except Exception:
+                self.log.debug("Could not close MySQL connection", exc_info=True)
+
+    @staticmethod
+    def _is_connection_error(error):
+        """
+        Client-side errors (2xxx codes, e.g. "server has gone away") and
+        interface errors mean the connection is unusable, unlike server-side
+        errors on a given statement (permissions, syntax...).
+        """
+        if isinstance(error, pymysql.InterfaceError):
+            return True
+        if isinstance(error, pymysql.OperationalError):
+            try:
+                return int(error.args[0]) >= 2000
+            except (IndexError, TypeError, ValueError):
+                return False
+        return False
+
+    def _connect(self, host, port, mysql_sock, user, password, defaults_file):
+        # Allow several statements per query to batch the status queries
+        # in a single round trip
+        client_flag = CLIENT.MULTI_STATEMENTS
+
+        if defaults_file != '':
+            db = pymysql.connect(read_default_file=defaults_file,
+                                 client_flag=client_flag)
+        elif mysql_sock != '':
+            db = pymysql.connect(
+                unix_socket=mysql_sock,
+                user=user,
+                passwd=password,
+                client_flag=client_flag
+            )
+        elif port:
+            db = pymysql.connect(
+                host=host,
+                port=port,
+                user=user,
+                passwd=password,
+                client_flag=client_flag
+            )
+        else:
+            db = pymysql.connect(
+                host=host,
+                user=user,
+                passwd=password,
+                client_flag=client_flag
+            )
+        self.log.debug("Connected to MySQL")
+
+        return db
+
+    def _run_batch(self, db, queries):
+        """
+        Run `queries` in a single round trip and return the list of
+        `(rows, description)` result sets, in the same order.
+
+        If a statement fails, the server doesn't run the following ones:
+        the result sets collected so far are returned along with the error.
+        """
+        results = []
+        error = None
         cursor = db.cursor()
-        cursor.execute("SHOW /*!50002 GLOBAL */ STATUS;")
-        status_results = dict(cursor.fetchall())
+        try:
+            cursor.execute(";\n".join(queries))
+            results.append((cursor.fetchall(), cursor.description))
+            while len(results) < len(queries):
+                if not cursor.nextset():
+                    break
+                results.append((cursor.fetchall(), cursor.description))
+        except Exception, e:
+            # Connection-level errors are handled by the caller
+            if self._is_connection_error(e):
+                raise
+            error = e
+        finally:
+            cursor.close()
+            del cursor
+
+        return results, error
+
+    def _collect_metrics(self, key, host, db, tags, options, queries):
+        replication = 'replication' in options and options['replication']
+
+        # Status, variables and slave status are fetched in one round trip.
+        # The server pid file is only needed until the pid is known.
+        batch = [
+            "SHOW /*!50002 GLOBAL */ STATUS",
+            "SHOW VARIABLES LIKE 'Key%'",
+        ]
+        if Platform.is_linux() and key not in self.server_pids:
+            batch.append("SHOW VARIABLES LIKE 'pid_file'")
+        if replication:
+            batch.append("SHOW SLAVE STATUS")
+
+        results, error = self._run_batch(db, batch)
+        if len(results) < 2:
+            raise error or Exception("Unable to fetch MySQL status and variables")
+        results = dict(zip(batch, results))
+
+        status_results = dict(results[batch[0]][0])
         self._rate_or_gauge_statuses(STATUS_VARS, status_results, tags)
-        cursor.execute("SHOW VARIABLES LIKE 'Key%';")
-        variables_results = dict(cursor.fetchall())
-        cursor.close()
-        del cursor
+        variables_results = dict(results[batch[1]][0])
 
         # Compute key cache utilization metric
         key_blocks_unused = self._collect_scalar('Key_blocks_unused', status_results)
@@ -184,7 +301,7 @@ class MySql(AgentCheck):
             value = self._collect_scalar('wsrep_cluster_size', status_results)
             self.gauge('mysql.galera.wsrep_cluster_size', value, tags=tags)
 
-        if 'replication' in options and options['replication']:
+        if replication:
             # get slave running form global status page
             slave_running = self._collect_string('Slave_running', status_results)
             if slave_running is not None:
@@ -193,11 +310,22 @@ class MySql(AgentCheck):
                 else:
                     slave_running = 0
                 self.gauge("mysql.replication.slave_running", slave_running, tags=tags)
-            self._collect_dict(
-                GAUGE,
-                {"Seconds_behind_master": "mysql.replication.seconds_behind_master"},
-                "SHOW SLAVE STATUS", db, tags=tags
-            )
+
+            if "SHOW SLAVE STATUS" in results:
+                rows, description = results["SHOW SLAVE STATUS"]
+                self._submit_fields(
+                    GAUGE,
+                    {"Seconds_behind_master": "mysql.replication.seconds_behind_master"},
+                    rows[0] if rows else None, description, tags
+                )
+            else:
+                self.warning("Error while running SHOW SLAVE STATUS\n%s" % error)
+
+        if Platform.is_linux():
+            pid_file = None
+            if "SHOW VARIABLES LIKE 'pid_file'" in results:
+                pid_file = dict(results["SHOW VARIABLES LIKE 'pid_file'"][0]).get('pid_file')
+            self._collect_system_metrics(key, host, db, tags, pid_file)
 
         # Collect custom query metrics
         # Max of 20 queries allowed
@@ -210,8 +338,8 @@ class MySql(AgentCheck):
                              % self.MAX_CUSTOM_QUERIES)
 
 
-    def _collect_metadata(self, db, host):
-        self._get_version(db, host)
+    def _collect_metadata(self, db, key):
+        self._get_version(db, key)
 
     def _rate_or_gauge_statuses(self, statuses, dbResults, tags):
         for status, metric in statuses.iteritems():
@@ -223,16 +351,16 @@ class MySql(AgentCheck):
                 elif metric_type == GAUGE:
                     self.gauge(metric_name, value, tags=tags)
 
-    def _version_greater_502(self, db, host):
+    def _version_greater_502(self, db, key):
         # show global status was introduced in 5.0.2
         # some patch version numbers contain letters (e.g. 5.0.51a)
         # so let's be careful when we compute the version number
-        if host in self.greater_502:
-            return self.greater_502[host]
+        if key in self.greater_502:
+            return self.greater_502[key]
 
         greater_502 = False
         try:
-            mysql_version = self._get_version(db, host)
+            mysql_version = self._get_version(db, key)
             self.log.debug("MySQL version %s" % mysql_version)
 
             major = int(mysql_version[0])
@@ -246,27 +374,23 @@ class MySql(AgentCheck):
             self.warning("Cannot compute mysql version, assuming older than 5.0.2: %s"
                          % str(exception))
 
-        self.greater_502[host] = greater_502
+        self.greater_502[key] = greater_502
 
         return greater_502
 
-    def _get_version(self, db, host):
-        if host in self.mysql_version:
-            version = self.mysql_version[host]
+    def _get_version(self, db, key):
+        if key in self.mysql_version:
+            version = self.mysql_version[key]
             self.service_metadata('version', ".".join(version))
             return version
 
-        # Get MySQL version
-        cursor = db.cursor()
-        cursor.execute('SELECT VERSION()')
-        result = cursor.fetchone()
-        cursor.close()
-        del cursor
+        # Get MySQL version, as announced by the server in the connection
+        # handshake: no need for a `SELECT VERSION()` round trip
         # Version might include a description e.g. 4.1.26-log.
         # See http://dev.mysql.com/doc/refman/4.1/en/information-functions.html#function_version
-        version = result[0].split('-')
+        version = db.get_server_info().split('-')
         version = version[0].split('.')
-        self.mysql_version[host] = version
+        self.mysql_version[key] = version
         self.service_metadata('version', ".".join(version))
         return version
 
@@ -297,40 +421,58 @@ class MySql(AgentCheck):
             cursor = db.cursor()
             cursor.execute(query)
             result = cursor.fetchone()
-            if result is not None:
-                for field in field_metric_map.keys():
-                    # Get the agent metric name from the column name
-                    metric = field_metric_map[field]
-                    # Find the column name in the cursor description to identify the column index
-                    # http://www.python.org/dev/peps/pep-0249/
-                    # cursor.description is a tuple of (column_name, ..., ...)
-                    try:
-                        col_idx = [d[0].lower() for d in cursor.description].index(field.lower())
-                        self.log.debug("Collecting metric: %s" % metric)
-                        if result[col_idx] is not None:
-                            self.log.debug("Collecting done, value %s" % result[col_idx])
-                            if metric_type == GAUGE:
-                                self.gauge(metric, float(result[col_idx]), tags=tags)
-                            elif metric_type == RATE:
-                                self.rate(metric, float(result[col_idx]), tags=tags)
-                            else:
-                                self.gauge(metric, float(result[col_idx]), tags=tags)
-                        else:
-                            self.log.debug("Received value is None for index %d" % col_idx)
-                    except ValueError:
-                        self.log.exception("Cannot find %s in the columns %s"
-                                           % (field, cursor.description))
+            self._submit_fields(metric_type, field_metric_map, result, cursor.description, tags)
             cursor.close()
             del cursor
-        except Exception:
+        except Exception, e:
+            if self._is_connection_error(e):
+                raise
             self.warning("Error while running %s\n%s" % (query, traceback.format_exc()))
             self.log.exception("Error while running %s" % query)
 
-    def _collect_system_metrics(self, host, db, tags):
+    def _submit_fields(self, metric_type, field_metric_map, result, description, tags):
+        """
+        Extract each field out of a result row
+        and stuff it in the corresponding metric.
+
+        result: the row, a tuple of values
+        description: the cursor description of the row
+        """
+        if result is None:
+            return
+
+        for field in field_metric_map.keys():
+            # Get the agent metric name from the column name
+            metric = field_metric_map[field]
+            # Find the column name in the cursor description to identify the column index
+            # http://www.python.org/dev/peps/pep-0249/
+            # cursor.description is a tuple of (column_name, ..., ...)
+            try:
+                col_idx = [d[0].lower() for d in description].index(field.lower())
+                self.log.debug("Collecting metric: %s" % metric)
+                if result[col_idx] is not None:
+                    self.log.debug("Collecting done, value %s" % result[col_idx])
+                    if metric_type == GAUGE:
+                        self.gauge(metric, float(result[col_idx]), tags=tags)
+                    elif metric_type == RATE:
+                        self.rate(metric, float(result[col_idx]), tags=tags)
+                    else:
+                        self.gauge(metric, float(result[col_idx]), tags=tags)
+                else:
+                    self.log.debug("Received value is None for index %d" % col_idx)
+            except ValueError:
+                self.log.exception("Cannot find %s in the columns %s"
+                                   % (field, description))
+
+    def _collect_system_metrics(self, key, host, db, tags, pid_file):
         pid = None
         # The server needs to run locally, accessed by TCP or socket
         if host in ["localhost", "127.0.0.1"] or db.port == long(0):
-            pid = self._get_server_pid(db)
+            pid = self.server_pids.get(key)
+            if pid is None:
+                pid = self._get_server_pid(pid_file)
+                if pid is not None:
+                    self.server_pids[key] = pid
 
         if pid:
             self.log.debug("pid: %s" % pid)
@@ -355,24 +497,18 @@ class MySql(AgentCheck):
                 self.rate("mysql.performance.kernel_time",
                           int((float(kcpu) / float(clk_tck)) * 100), tags=tags)
             except Exception:
+                # The server may have been restarted under a new pid
+                self.server_pids.pop(key, None)
                 self.warning("Error while reading mysql (pid: %s) procfs data\n%s"
                              % (pid, traceback.format_exc()))
 
-    def _get_server_pid(self, db):
+    def _get_server_pid(self, pid_file):
         pid = None
 
         # Try to get pid from pid file, it can fail for permission reason
-        pid_file = None
-        try:
-            cursor = db.cursor()
-            cursor.execute("SHOW VARIABLES LIKE 'pid_file'")
-            pid_file = cursor.fetchone()[1]
-            cursor.close()
-            del cursor
-        except Exception:
+        if pid_file is None:
             self.warning("Error while fetching pid_file variable of MySQL.")
-
-        if pid_file is not None:
+        else:
             self.log.debug("pid file: %s" % str(pid_file))
             try:
                 f = open(pid_file)
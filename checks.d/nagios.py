@@ -5,6 +5,7 @@ import re
 # project
 from checks import AgentCheck
 from utils.tailfile import TailFile
+from utils.timeparse import TimestampParser
 
 # fields order for each event type, as named tuples
 EVENT_FIELDS = {
@@ -194,6 +195,7 @@ class NagiosTailer(object):
         self._gauge = gauge_func
         self._line_parsed = 0
         self._freq = freq
+        self._timestamps = TimestampParser()
 
         if file_template is not None:
             self.compile_file_template(file_template)
@@ -345,7 +347,7 @@ class NagiosPerfDataTailer(NagiosTailer):
                 label = pair_data['label']
                 timestamp = data.get('TIMET', None)
                 if timestamp is not None:
-                    timestamp = (int(float(timestamp)) / self._freq) * self._freq
+                    timestamp = (self._timestamps.parse(timestamp) / self._freq) * self._freq
                 value = float(pair_data['value'])
                 device_name = None
 
@@ -2,6 +2,7 @@
 Collects network metrics.
 """
 # stdlib
+import os
 import re
 
 # project
@@ -52,9 +53,33 @@ class Network(AgentCheck):
             "LAST_ACK": "closing",
             "LISTEN": "listening",
             "CLOSING": "closing",
+        },
+        # Hex codes of the `st` column of /proc/net/tcp{,6}, see include/net/tcp_states.h
+        "proc": {
+            "01": "established",
+            "02": "opening",
+            "03": "opening",
+            "04": "closing",
+            "05": "closing",
+            "06": "time_wait",
+            "07": "closing",
+            "08": "closing",
+            "09": "closing",
+            "0A": "listening",
+            "0B": "closing",
+            "0C": "opening",
         }
     }
 
+    PROC_NET_PATH = '/proc/net'
+    PROC_READ_SIZE = 64 * 1024
+
+    # Length of the hex local/remote addresses in /proc/net/{tcp,udp}{,6}
+    PROC_ADDRESS_LENGTH = {
+        '4': len('0100007F:0CEA'),
+        '6': len('00000000000000000000000001000000:0CEA'),
+    }
+
     CX_STATE_GAUGE = {
         ('udp4', 'connections') : 'system.net.udp4.connections',
         ('udp6', 'connections') : 'system.net.udp6.connections',
@@ -138,44 +163,13 @@ class Network(AgentCheck):
     def _check_linux(self, instance):
         if self._collect_cx_state:
             try:
-                self.log.debug("Using `ss` to collect connection state")
-                # Try using `ss` for increased performance over `netstat`
-                for ip_version in ['4', '6']:
-                    # Call `ss` for each IP version because there's no built-in way of distinguishing
-                    # between the IP versions in the output
-                    output, _, _ = get_subprocess_output(["ss", "-n", "-u", "-t", "-a", "-{0}".format(ip_version)], self.log)
-                    lines = output.splitlines()
-                    # Netid  State      Recv-Q Send-Q     Local Address:Port       Peer Address:Port
-                    # udp    UNCONN     0      0              127.0.0.1:8125                  *:*
-                    # udp    ESTAB      0      0              127.0.0.1:37036         127.0.0.1:8125
-                    # udp    UNCONN     0      0        fe80::a00:27ff:fe1c:3c4:123          :::*
-                    # tcp    TIME-WAIT  0      0          90.56.111.177:56867        46.105.75.4:143
-                    # tcp    LISTEN     0      0       ::ffff:127.0.0.1:33217  ::ffff:127.0.0.1:7199
-                    # tcp    ESTAB      0      0       ::ffff:127.0.0.1:58975  ::ffff:127.0.0.1:2181
-
-                    metrics = self._parse_linux_cx_state(lines[1:], self.TCP_STATES['ss'], 1, ip_version=ip_version)
-                    # Only send the metrics which match the loop iteration's ip version
-                    for stat, metric in self.CX_STATE_GAUGE.iteritems():
-                        if stat[0].endswith(ip_version):
-                            self.gauge(metric, metrics.get(metric))
-
-            except OSError:
-                self.log.info("`ss` not found: using `netstat` as a fallback")
-                output, _, _ = get_subprocess_output(["netstat", "-n", "-u", "-t", "-a"], self.log)
-                lines = output.splitlines()
-                # Active Internet connections (w/o servers)
-                # Proto Recv-Q Send-Q Local Address           Foreign Address         State
-                # tcp        0      0 46.105.75.4:80          79.220.227.193:2032     SYN_RECV
-                # tcp        0      0 46.105.75.4:143         90.56.111.177:56867     ESTABLISHED
-                # tcp        0      0 46.105.75.4:50468       107.20.207.175:443      TIME_WAIT
-                # tcp6       0      0 46.105.75.4:80          93.15.237.188:58038     FIN_WAIT2
-                # tcp6       0      0 46.105.75.4:80          79.220.227.193:2029     ESTABLISHED
-                # udp        0      0 0.0.0.0:123             0.0.0.0:*
-                # udp6       0      0 :::41458                :::*
-
-                metrics = self._parse_linux_cx_state(lines[2:], self.TCP_STATES['netstat'], 5)
+                self.log.debug("Using %s to collect connection state" % self.PROC_NET_PATH)
+                metrics = self._parse_proc_cx_state(self.PROC_NET_PATH)
                 for metric, value in metrics.iteritems():
                     self.gauge(metric, value)
+            except IOError:
+                self.log.info("Unable to read connections from %s: using `ss` or `netstat` as a fallback" % self.PROC_NET_PATH)
+                self._check_linux_cx_state_subprocess()
 
         proc = open('/proc/net/dev', 'r')
         try:
@@ -264,6 +258,103 @@ class Network(AgentCheck):
             # On Openshift, /proc/net/snmp is only readable by root
             self.log.debug("Unable to read /proc/net/snmp.")
 
+    def _check_linux_cx_state_subprocess(self):
+        try:
+            self.log.debug("Using `ss` to collect connection state")
+            # Try using `ss` for increased performance over `netstat`
+            for ip_version in ['4', '6']:
+                # Call `ss` for each IP version because there's no built-in way of distinguishing
+                # between the IP versions in the output
+                output, _, _ = get_subprocess_output(["ss", "-n", "-u", "-t", "-a", "-{0}".format(ip_version)], self.log)
+                lines = output.splitlines()
+                # Netid  State      Recv-Q Send-Q     Local Address:Port       Peer Address:Port
+                # udp    UNCONN     0      0              127.0.0.1:8125                  *:*
+                # udp    ESTAB      0      0              127.0.0.1:37036         127.0.0.1:8125
+                # udp    UNCONN     0      0        fe80::a00:27ff:fe1c:3c4:123          :::*
+                # tcp    TIME-WAIT  0      0          90.56.111.177:56867        46.105.75.4:143
+                # tcp    LISTEN     0      0       ::ffff:127.0.0.1:33217  ::ffff:127.0.0.1:7199
+                # tcp    ESTAB      0      0       ::ffff:127.0.0.1:58975  ::ffff:127.0.0.1:2181
+
+                metrics = self._parse_linux_cx_state(lines[1:], self.TCP_STATES['ss'], 1, ip_version=ip_version)
+                # Only send the metrics which match the loop iteration's ip version
+                for stat, metric in self.CX_STATE_GAUGE.iteritems():
+                    if stat[0].endswith(ip_version):
+                        self.gauge(metric, metrics.get(metric))
+
+        except OSError:
+            self.log.info("`ss` not found: using `netstat` as a fallback")
+            output, _, _ = get_subprocess_output(["netstat", "-n", "-u", "-t", "-a"], self.log)
+            lines = output.splitlines()
+            # Active Internet connections (w/o servers)
+            # Proto Recv-Q Send-Q Local Address           Foreign Address         State
+            # tcp        0      0 46.105.75.4:80          79.220.227.193:2032     SYN_RECV
+            # tcp        0      0 46.105.75.4:143         90.56.111.177:56867     ESTABLISHED
+            # tcp        0      0 46.105.75.4:50468       107.20.207.175:443      TIME_WAIT
+            # tcp6       0      0 46.105.75.4:80          93.15.237.188:58038     FIN_WAIT2
+            # tcp6       0      0 46.105.75.4:80          79.220.227.193:2029     ESTABLISHED
+            # udp        0      0 0.0.0.0:123             0.0.0.0:*
+            # udp6       0      0 :::41458                :::*
+
+            metrics = self._parse_linux_cx_state(lines[2:], self.TCP_STATES['netstat'], 5)
+            for metric, value in metrics.iteritems():
+                self.gauge(metric, value)
+
+    def _parse_proc_cx_state(self, proc_net_path):
+        """
+        Count connections per state from /proc/net/{tcp,udp}{,6}.
+        Returns a dict metric_name -> value
+        """
+        metrics = dict.fromkeys(self.CX_STATE_GAUGE.values(), 0)
+        tcp_states = self.TCP_STATES['proc']
+
+        for ip_version in ['4', '6']:
+            suffix = '6' if ip_version == '6' else ''
+
+            tcp_path = os.path.join(proc_net_path, 'tcp' + suffix)
+            counts = self._count_proc_tcp_states(tcp_path, self.PROC_ADDRESS_LENGTH[ip_version])
+            for state, count in counts.iteritems():
+                if state in tcp_states:
+                    metrics[self.CX_STATE_GAUGE['tcp' + ip_version, tcp_states[state]]] += count
+
+            # Every UDP socket is counted, whatever its state
+            udp_path = os.path.join(proc_net_path, 'udp' + suffix)
+            metrics[self.CX_STATE_GAUGE['udp' + ip_version, 'connections']] = self._count_proc_lines(udp_path)
+
+        return metrics
+
+    def _count_proc_tcp_states(self, path, address_length):
+        """
+        Returns a dict hex state -> number of sockets in it.
+        Lines look like:
+          sl  local_address rem_address   st tx_queue rx_queue ...
+           0: 0100007F:0CEA 00000000:0000 0A 00000000:00000000 ...
+        The state is at a fixed offset from the colon following `sl`, whose
+        width varies with the number of sockets.
+        """
+        offset = 2 + 2 * (address_length + 1)
+        counts = {}
+        with open(path, 'r') as f:
+            f.readline()
+            for line in f:
+                start = line.find(':') + offset
+                state = line[start:start + 2]
+                counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    def _count_proc_lines(self, path):
+        """
+        Returns the number of sockets listed in a /proc/net file, i.e. its
+        number of lines minus the header, without splitting it in lines.
+        """
+        count = 0
+        with open(path, 'r') as f:
+            while True:
+                data = f.read(self.PROC_READ_SIZE)
+                if not data:
+                    break
+                count += data.count('\n')
+        return max(count - 1, 0)
+
     # Parse the output of the command that retrieves the connection state (either `ss` or `netstat`)
     # Returns a dict metric_name -> value
     def _parse_linux_cx_state(self, lines, tcp_states, state_col, ip_version=None):
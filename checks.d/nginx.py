@@ -3,7 +3,6 @@ import re
 import urlparse
 
 # 3rd party
-import requests
 import simplejson as json
 
 # project
@@ -68,7 +67,7 @@ class Nginx(AgentCheck):
         service_check_tags = ['host:%s' % nginx_host, 'port:%s' % nginx_port]
         try:
             self.log.debug(u"Querying URL: {0}".format(url))
-            r = requests.get(url, auth=auth, headers=headers(self.agentConfig),
+            r = self.http_get(url, auth=auth, headers=headers(self.agentConfig),
                              verify=ssl_validation)
             r.raise_for_status()
         except Exception:
@@ -1,6 +1,3 @@
-# 3p
-import requests
-
 # project
 from checks import AgentCheck
 from util import headers
@@ -66,7 +63,7 @@ class PHPFPMCheck(AgentCheck):
         try:
             # TODO: adding the 'full' parameter gets you per-process detailed
             # informations, which could be nice to parse and output as metrics
-            resp = requests.get(status_url, auth=auth,
+            resp = self.http_get(status_url, auth=auth,
                                 headers=headers(self.agentConfig),
                                 params={'json': True})
             resp.raise_for_status()
@@ -103,7 +100,7 @@ class PHPFPMCheck(AgentCheck):
         try:
             # TODO: adding the 'full' parameter gets you per-process detailed
             # informations, which could be nice to parse and output as metrics
-            resp = requests.get(ping_url, auth=auth,
+            resp = self.http_get(ping_url, auth=auth,
                                 headers=headers(self.agentConfig))
             resp.raise_for_status()
 
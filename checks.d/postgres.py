@@ -14,6 +14,10 @@ from checks import AgentCheck, CheckException
 from config import _is_affirmative
 
 MAX_CUSTOM_RESULTS = 100
+# Number of relations to collect per run, when many relations are configured
+DEFAULT_MAX_RELATIONS_PER_RUN = 500
+# Number of tag lists to keep per instance
+MAX_CACHED_TAGS = 10000
 
 
 class ShouldRestartException(Exception):
@@ -260,6 +264,9 @@ SELECT relname,
         self.db_bgw_metrics = []
         self.replication_metrics = {}
         self.custom_metrics = {}
+        self.query_plans = {}
+        self.relation_offsets = {}
+        self.tags_cache = {}
 
     def _get_version(self, key, db):
         if key not in self.versions:
@@ -377,12 +384,41 @@ SELECT relname,
                 self.log.warn('Failed to parse config element=%s, check syntax' % str(element))
         return config
 
-    def _collect_stats(self, key, db, instance_tags, relations, custom_metrics):
-        """Query pg_stat_* for various metrics
-        If relations is not an empty list, gather per-relation metrics
-        on top of that.
-        If custom_metrics is not an empty list, gather custom metrics defined in postgres.yaml
+    def _compile_query(self, scope, log_func, custom=False):
+        """Build, once, the SQL of a metric scope along with what is needed
+        to parse its results
         """
+        # list of metrics to query, in some order
+        # we must remember that order to parse results
+        cols = scope['metrics'].keys()
+        if scope['relation']:
+            # Keep the last %s intact for the list of relations
+            query = scope['query'] % (", ".join(cols), "%s")
+        else:
+            query = scope['query'] % (", ".join(cols))
+
+        return {
+            'scope': scope,
+            'query': query,
+            'cols': cols,
+            'desc': [d[1] for d in scope['descriptors']],
+            # [(metric_name, submit_function), ...] in the order of the columns
+            'submit': [scope['metrics'][c] for c in cols],
+            'relation': scope['relation'],
+            'custom': custom,
+            'log_func': log_func,
+        }
+
+    def _get_query_plan(self, key, db, relations, custom_metrics):
+        """Compile the queries to run against a server, once per server version.
+
+        Queries that return a single row without descriptors are merged into
+        a single statement. The SQL strings don't change from run to run, so
+        they are only parsed once by the server: pg8000 keeps them as
+        prepared statements on the connection.
+        """
+        if key in self.query_plans:
+            return self.query_plans[key]
 
         metric_scope = [
             self.CONNECTION_METRICS,
@@ -395,16 +431,13 @@ SELECT relname,
         bgw_instance_metrics = self._get_bgw_metrics(key, db)
 
         if db_instance_metrics is not None:
-            # FIXME: constants shouldn't be modified
-            self.DB_METRICS['metrics'] = db_instance_metrics
-            metric_scope.append(self.DB_METRICS)
+            metric_scope.append(dict(self.DB_METRICS, metrics=db_instance_metrics))
 
         if bgw_instance_metrics is not None:
-            # FIXME: constants shouldn't be modified
-            self.BGW_METRICS['metrics'] = bgw_instance_metrics
-            metric_scope.append(self.BGW_METRICS)
+            metric_scope.append(dict(self.BGW_METRICS, metrics=bgw_instance_metrics))
 
         # Do we need relation-specific metrics?
+        relations_config = {}
         if relations:
             metric_scope += [
                 self.REL_METRICS,
@@ -414,102 +447,155 @@ SELECT relname,
             ]
             relations_config = self._build_relations_config(relations)
 
+        replication_scope = None
         replication_metrics = self._get_replication_metrics(key, db)
         if replication_metrics is not None:
-            # FIXME: constants shouldn't be modified
-            self.REPLICATION_METRICS['metrics'] = replication_metrics
-            metric_scope.append(self.REPLICATION_METRICS)
+            replication_scope = dict(self.REPLICATION_METRICS, metrics=replication_metrics)
+            metric_scope.append(replication_scope)
+
+        above_9_0 = self._is_above(key, db, [9,0,0])
+
+        queries = []
+        for scope in metric_scope:
+            if scope is replication_scope or not above_9_0:
+                log_func = self.log.debug
+            else:
+                log_func = self.log.warning
+            query = self._compile_query(scope, log_func)
+            query['db_metrics'] = scope['query'] == self.DB_METRICS['query']
+            queries.append(query)
+
+        for scope in custom_metrics:
+            log_func = self.log.warning if above_9_0 else self.log.debug
+            queries.append(self._compile_query(scope, log_func, custom=True))
+
+        # Relation-specific queries can only run if relations are configured
+        queries = [q for q in queries if not q['relation'] or relations_config]
+
+        single_row = [q for q in queries if self._is_single_row(q)]
+        plan = {
+            'queries': [q for q in queries if not self._is_single_row(q)],
+            'single_row': single_row,
+            'single_row_query': self._merge_single_row_queries(single_row),
+            'relations_config': relations_config,
+            'relnames': sorted(relations_config.keys()),
+        }
+        self.query_plans[key] = plan
+        return plan
+
+    @staticmethod
+    def _is_single_row(query):
+        return not query['desc'] and not query['relation'] and not query['custom']
+
+    @staticmethod
+    def _merge_single_row_queries(queries):
+        """Merge queries returning at most one row in a single statement.
+        Each query becomes a subquery, LEFT JOINed so that a query returning no
+        row (e.g. replication metrics on a primary) yields NULLs.
+        """
+        if len(queries) < 2:
+            return None
+
+        select = ", ".join("s%d.*" % i for i in range(len(queries)))
+        joins = "\n".join("LEFT JOIN (%s) AS s%d ON true" % (q['query'], i)
+                          for i, q in enumerate(queries))
+        return "SELECT %s\n  FROM (SELECT 1) AS dummy\n%s" % (select, joins)
+
+    def _get_relations_to_collect(self, key, relnames, max_relations):
+        """Return the relations to collect in this run: if there are more than
+        `max_relations`, go through them in turn, `max_relations` per run.
+        """
+        if not max_relations or len(relnames) <= max_relations:
+            return relnames
+
+        offset = self.relation_offsets.get(key, 0) % len(relnames)
+        batch = relnames[offset:offset + max_relations]
+        if len(batch) < max_relations:
+            batch += relnames[:max_relations - len(batch)]
+        self.relation_offsets[key] = offset + max_relations
+        return batch
+
+    def _get_tags_cache(self, key, instance_tags):
+        """Cache of the tags of each result row, per (query, descriptor values).
+        Reset when the instance tags change or when it grows too big.
+        """
+        instance_tags = tuple(instance_tags)
+        cached_tags, cache = self.tags_cache.get(key, (None, None))
+        if cached_tags != instance_tags or len(cache) > MAX_CACHED_TAGS:
+            cache = {}
+            self.tags_cache[key] = (instance_tags, cache)
+        return cache
+
+    def _collect_stats(self, key, db, instance_tags, relations, custom_metrics,
+                       max_relations=None):
+        """Query pg_stat_* for various metrics
+        If relations is not an empty list, gather per-relation metrics
+        on top of that.
+        If custom_metrics is not an empty list, gather custom metrics defined in postgres.yaml
+        """
+        plan = self._get_query_plan(key, db, relations, custom_metrics)
+        relations_config = plan['relations_config']
+        relnames = self._get_relations_to_collect(key, plan['relnames'], max_relations)
+        tags_cache = self._get_tags_cache(key, instance_tags)
 
-        full_metric_scope = list(metric_scope) + custom_metrics
         try:
             cursor = db.cursor()
 
-            for scope in full_metric_scope:
-                if scope == self.REPLICATION_METRICS or not self._is_above(key, db, [9,0,0]):
-                    log_func = self.log.debug
+            single_row_queries = plan['single_row']
+            if plan['single_row_query'] is not None:
+                try:
+                    self.log.debug("Running query: %s" % plan['single_row_query'])
+                    cursor.execute(plan['single_row_query'].replace(r'%', r'%%'))
+                    row = cursor.fetchone()
+                except ProgrammingError, e:
+                    # One of the merged queries can't run on this server:
+                    # stop merging them, they will run one by one
+                    self.log.debug("Cannot run merged queries, running them one by one: %s" % str(e))
+                    db.rollback()
+                    cursor = db.cursor()
+                    plan['single_row_query'] = None
                 else:
-                    log_func = self.log.warning
-
-                # build query
-                cols = scope['metrics'].keys()  # list of metrics to query, in some order
-                # we must remember that order to parse results
-
+                    single_row_queries = []
+                    offset = 0
+                    for query in plan['single_row']:
+                        values = row[offset:offset + len(query['cols'])]
+                        offset += len(query['cols'])
+                        # A query that returned no row only yields NULLs
+                        if any(v is not None for v in values):
+                            self._submit_rows(query, [values], instance_tags,
+                                              relations_config, tags_cache)
+
+            for query in single_row_queries + plan['queries']:
                 try:
                     # if this is a relation-specific query, we need to list all relations last
-                    if scope['relation'] and len(relations) > 0:
-                        relnames = relations_config.keys()
-                        query = scope['query'] % (", ".join(cols), "%s")  # Keep the last %s intact
-                        self.log.debug("Running query: %s with relations: %s" % (query, relnames))
-                        cursor.execute(query, (relnames, ))
+                    if query['relation']:
+                        self.log.debug("Running query: %s with relations: %s" % (query['query'], relnames))
+                        cursor.execute(query['query'], (relnames, ))
                     else:
-                        query = scope['query'] % (", ".join(cols))
-                        self.log.debug("Running query: %s" % query)
-                        cursor.execute(query.replace(r'%', r'%%'))
+                        self.log.debug("Running query: %s" % query['query'])
+                        cursor.execute(query['query'].replace(r'%', r'%%'))
 
                     results = cursor.fetchall()
                 except ProgrammingError, e:
-                    log_func("Not all metrics may be available: %s" % str(e))
+                    query['log_func']("Not all metrics may be available: %s" % str(e))
                     continue
 
                 if not results:
                     continue
 
-                if scope in custom_metrics and len(results) > MAX_CUSTOM_RESULTS:
+                if query['custom'] and len(results) > MAX_CUSTOM_RESULTS:
                     self.warning(
                         "Query: {0} returned more than {1} results ({2}). Truncating"
-                        .format(query, MAX_CUSTOM_RESULTS, len(results))
+                        .format(query['query'], MAX_CUSTOM_RESULTS, len(results))
                     )
                     results = results[:MAX_CUSTOM_RESULTS]
 
                 # FIXME this cramps my style
-                if scope == self.DB_METRICS:
+                if query.get('db_metrics'):
                     self.gauge("postgresql.db.count", len(results),
                         tags=[t for t in instance_tags if not t.startswith("db:")])
 
-                desc = scope['descriptors']
-
-                # parse & submit results
-                # A row should look like this
-                # (descriptor, descriptor, ..., value, value, value, value, ...)
-                # with descriptor a PG relation or index name, which we use to create the tags
-                for row in results:
-                    # Check that all columns will be processed
-                    assert len(row) == len(cols) + len(desc)
-
-                    # build a map of descriptors and their values
-                    desc_map = dict(zip([x[1] for x in desc], row[0:len(desc)]))
-                    if 'schema' in desc_map:
-                        try:
-                            relname = desc_map['table']
-                            config_schemas = relations_config[relname]['schemas']
-                            if config_schemas and desc_map['schema'] not in config_schemas:
-                                continue
-                        except KeyError:
-                            pass
-
-                    # Build tags
-                    # descriptors are: (pg_name, dd_tag_name): value
-                    # Special-case the "db" tag, which overrides the one that is passed as instance_tag
-                    # The reason is that pg_stat_database returns all databases regardless of the
-                    # connection.
-                    if not scope['relation']:
-                        tags = [t for t in instance_tags if not t.startswith("db:")]
-                    else:
-                        tags = [t for t in instance_tags]
-
-                    tags += [("%s:%s" % (k,v)) for (k,v) in desc_map.iteritems()]
-
-                    # [(metric-map, value), (metric-map, value), ...]
-                    # metric-map is: (dd_name, "rate"|"gauge")
-                    # shift the results since the first columns will be the "descriptors"
-                    values = zip([scope['metrics'][c] for c in cols], row[len(desc):])
-
-                    # To submit simply call the function for each value v
-                    # v[0] == (metric_name, submit_function)
-                    # v[1] == the actual value
-                    # tags are
-                    for v in values:
-                        v[0][1](self, v[0][0], v[1], tags=tags)
+                self._submit_rows(query, results, instance_tags, relations_config, tags_cache)
 
             cursor.close()
         except InterfaceError, e:
@@ -519,6 +605,63 @@ SELECT relname,
             self.log.error("Connection error: %s" % str(e))
             raise ShouldRestartException
 
+    def _submit_rows(self, query, results, instance_tags, relations_config, tags_cache):
+        """Parse & submit the result rows of a query
+        A row should look like this
+        (descriptor, descriptor, ..., value, value, value, value, ...)
+        with descriptor a PG relation or index name, which we use to create the tags
+        """
+        desc = query['desc']
+        n_desc = len(desc)
+        n_cols = len(query['cols'])
+        submit = query['submit']
+        query_id = id(query)
+
+        for row in results:
+            # Check that all columns will be processed
+            assert len(row) == n_cols + n_desc
+
+            desc_values = tuple(row[0:n_desc])
+            cache_key = (query_id, desc_values)
+            tags = tags_cache.get(cache_key)
+            if tags is None:
+                # build a map of descriptors and their values
+                desc_map = dict(zip(desc, desc_values))
+                if 'schema' in desc_map:
+                    try:
+                        relname = desc_map['table']
+                        config_schemas = relations_config[relname]['schemas']
+                        if config_schemas and desc_map['schema'] not in config_schemas:
+                            # Remember that this row is filtered out
+                            tags_cache[cache_key] = False
+                            continue
+                    except KeyError:
+                        pass
+
+                # Build tags
+                # descriptors are: (pg_name, dd_tag_name): value
+                # Special-case the "db" tag, which overrides the one that is passed as instance_tag
+                # The reason is that pg_stat_database returns all databases regardless of the
+                # connection.
+                if not query['relation']:
+                    tags = [t for t in instance_tags if not t.startswith("db:")]
+                else:
+                    tags = [t for t in instance_tags]
+
+                tags += [("%s:%s" % (k,v)) for (k,v) in desc_map.iteritems()]
+                tags_cache[cache_key] = tags
+            elif tags is False:
+                continue
+
+            # [(metric-map, value), (metric-map, value), ...]
+            # metric-map is: (dd_name, "rate"|"gauge")
+            # shift the results since the first columns will be the "descriptors"
+            # To submit simply call the function for each value v
+            # v[0] == (metric_name, submit_function)
+            # v[1] == the actual value
+            for v in zip(submit, row[n_desc:]):
+                v[0][1](self, v[0][0], v[1], tags=tags)
+
     def _get_service_check_tags(self, host, port, dbname):
         service_check_tags = [
             "host:%s" % host,
@@ -593,6 +736,7 @@ SELECT relname,
         tags = instance.get('tags', [])
         dbname = instance.get('dbname', None)
         relations = instance.get('relations', [])
+        max_relations = int(instance.get('max_relations_per_run', DEFAULT_MAX_RELATIONS_PER_RUN))
         ssl = _is_affirmative(instance.get('ssl', False))
 
         if relations and not dbname:
@@ -626,11 +770,11 @@ SELECT relname,
             db = self.get_connection(key, host, port, user, password, dbname, ssl)
             version = self._get_version(key, db)
             self.log.debug("Running check against version %s" % version)
-            self._collect_stats(key, db, tags, relations, custom_metrics)
+            self._collect_stats(key, db, tags, relations, custom_metrics, max_relations)
         except ShouldRestartException:
             self.log.info("Resetting the connection")
             db = self.get_connection(key, host, port, user, password, dbname, ssl, use_cached=False)
-            self._collect_stats(key, db, tags, relations, custom_metrics)
+            self._collect_stats(key, db, tags, relations, custom_metrics, max_relations)
 
         if db is not None:
             service_check_tags = self._get_service_check_tags(host, port, dbname)
@@ -18,6 +18,20 @@ MAX_SLOW_ENTRIES_KEY = "slowlog-max-len"
 REPL_KEY = 'master_link_status'
 LINK_DOWN_KEY = 'master_link_down_since_seconds'
 
+# Command used to get the length of a key, by key type
+LENGTH_COMMANDS = {
+    'list': 'llen',
+    'set': 'scard',
+    'zset': 'zcard',
+    'hash': 'hlen',
+}
+
+# Keys containing one of these are patterns, expanded with SCAN
+GLOB_CHARS = '*?['
+DEFAULT_KEYS_SCAN_COUNT = 1000
+DEFAULT_KEYS_SCAN_BUDGET = 10
+DEFAULT_MAX_KEYS_PER_PATTERN = 1000
+
 
 class Redis(AgentCheck):
     db_key_pattern = re.compile(r'^db\d+')
@@ -91,6 +105,11 @@ class Redis(AgentCheck):
         AgentCheck.__init__(self, name, init_config, agentConfig, instances)
         self.connections = {}
         self.last_timestamp_seen = defaultdict(int)
+        self.max_slow_entries = {}
+        # (instance key, key) -> type of the key seen on the last run
+        self.key_types = {}
+        # (instance key, pattern) -> state of the incremental SCAN
+        self.scan_states = {}
 
     def get_library_versions(self):
         return {"redis": redis.__version__}
@@ -157,15 +176,35 @@ class Redis(AgentCheck):
 
     def _check_db(self, instance, custom_tags=None):
         conn = self._get_conn(instance)
+        instance_key = self._generate_instance_key(instance)
 
         tags, tags_to_add = self._get_tags(custom_tags, instance)
 
-        # Ping the database for info, and track the latency.
+        key_list = instance.get('keys')
+        if key_list is not None and (not isinstance(key_list, list) or len(key_list) == 0):
+            self.warning("keys in redis configuration is either not a list or empty")
+            key_list = None
+
+        # INFO, SLOWLOG and the key lengths all go through one pipeline.
+        # Ping the database for info, and track the latency of this round trip.
         # Process the service check: the check passes if we can connect to Redis
-        start = time.time()
         info = None
         try:
-            info = conn.info()
+            max_slow_entries = self._get_max_slow_entries(conn, instance, instance_key)
+            keys = []
+            if key_list is not None:
+                keys = self._get_keys_to_check(conn, instance, instance_key, key_list)
+            pipe = conn.pipeline(transaction=False)
+            pipe.info()
+            pipe.slowlog_get(max_slow_entries)
+            for key in keys:
+                self._queue_key_length(pipe, key, self.key_types.get((instance_key, key)))
+            start = time.time()
+            results = pipe.execute(raise_on_error=False)
+            latency_ms = round((time.time() - start) * 1000, 2)
+            info, slowlogs = results[0], results[1]
+            if isinstance(info, Exception):
+                raise info
             status = AgentCheck.OK
             self.service_check('redis.can_connect', status, tags=tags_to_add)
             self._collect_metadata(info)
@@ -178,7 +217,6 @@ class Redis(AgentCheck):
             self.service_check('redis.can_connect', status, tags=tags_to_add)
             raise
 
-        latency_ms = round((time.time() - start) * 1000, 2)
         self.gauge('redis.info.latency_ms', latency_ms, tags=tags)
 
         # Save the database statistics.
@@ -218,33 +256,120 @@ class Redis(AgentCheck):
                   tags=tags)
 
         # Check some key lengths if asked
-        key_list = instance.get('keys')
-        if key_list is not None:
-            if not isinstance(key_list, list) or len(key_list) == 0:
-                self.warning("keys in redis configuration is either not a list or empty")
-            else:
-                l_tags = list(tags)
-                for key in key_list:
-                    key_type = conn.type(key)
-                    key_tags = l_tags + ['key:' + key]
-
-                    if key_type == 'list':
-                        self.gauge('redis.key.length', conn.llen(key), tags=key_tags)
-                    elif key_type == 'set':
-                        self.gauge('redis.key.length', conn.scard(key), tags=key_tags)
-                    elif key_type == 'zset':
-                        self.gauge('redis.key.length', conn.zcard(key), tags=key_tags)
-                    elif key_type == 'hash':
-                        self.gauge('redis.key.length', conn.hlen(key), tags=key_tags)
-                    else:
-                        # If the type is unknown, it might be because the key doesn't exist,
-                        # which can be because the list is empty. So always send 0 in that case.
-                        if instance.get("warn_on_missing_keys", True):
-                            self.warning("{0} key not found in redis".format(key))
-                        self.gauge('redis.key.length', 0, tags=key_tags)
+        if keys:
+            self._check_key_lengths(conn, instance, instance_key, tags, keys, results[2:])
 
         self._check_replication(info, tags)
 
+        if isinstance(slowlogs, Exception):
+            self.warning("Unable to fetch the slow query log: {0}".format(slowlogs))
+        else:
+            self._check_slowlog(instance_key, slowlogs, tags)
+
+    @staticmethod
+    def _is_pattern(key):
+        return any(c in key for c in GLOB_CHARS)
+
+    def _get_keys_to_check(self, conn, instance, instance_key, key_list):
+        """
+        Return the keys to measure, with wildcard patterns expanded.
+
+        Patterns are expanded with an incremental SCAN, resumed from run to run:
+        each run issues at most `keys_scan_budget` SCAN calls per pattern.
+        Until a full iteration completes, the keys found so far are measured.
+        """
+        scan_count = int(instance.get('keys_scan_count', DEFAULT_KEYS_SCAN_COUNT))
+        scan_budget = int(instance.get('keys_scan_budget', DEFAULT_KEYS_SCAN_BUDGET))
+        max_keys = int(instance.get('max_keys_per_pattern', DEFAULT_MAX_KEYS_PER_PATTERN))
+
+        keys = []
+        seen = set()
+        for key in key_list:
+            if not self._is_pattern(key):
+                if key not in seen:
+                    keys.append(key)
+                    seen.add(key)
+                continue
+
+            scan_key = (instance_key, key)
+            state = self.scan_states.get(scan_key)
+            if state is None:
+                state = {'cursor': 0, 'current': set(), 'known': set()}
+                self.scan_states[scan_key] = state
+
+            for _ in xrange(scan_budget):
+                cursor, found = conn.scan(state['cursor'], match=key, count=scan_count)
+                state['cursor'] = int(cursor)
+                state['current'].update(found)
+                if state['cursor'] == 0:
+                    # Full iteration done: forget keys that went away
+                    state['known'], state['current'] = state['current'], set()
+                    break
+
+            matched = state['known'] | state['current']
+            if len(matched) > max_keys:
+                self.warning("{0} keys match the pattern {1}, only checking the first {2}"
+                             .format(len(matched), key, max_keys))
+                matched = sorted(matched)[:max_keys]
+            for k in sorted(matched):
+                if k not in seen:
+                    keys.append(k)
+                    seen.add(k)
+
+        return keys
+
+    @staticmethod
+    def _queue_key_length(pipe, key, key_type):
+        """
+        Queue the TYPE of `key` and, if its type was seen on a previous run,
+        its type-specific length command. Keys rarely change type, so the
+        length comes back in the same round trip.
+        """
+        pipe.type(key)
+        if key_type in LENGTH_COMMANDS:
+            getattr(pipe, LENGTH_COMMANDS[key_type])(key)
+
+    def _check_key_lengths(self, conn, instance, instance_key, tags, keys, results):
+        l_tags = list(tags)
+        results = iter(results)
+        lengths = {}
+        retype = []
+        for key in keys:
+            cached_type = self.key_types.get((instance_key, key))
+            key_type = next(results)
+            length = None
+            if cached_type in LENGTH_COMMANDS:
+                length = next(results)
+            if key_type in LENGTH_COMMANDS:
+                self.key_types[(instance_key, key)] = key_type
+                if key_type == cached_type and not isinstance(length, Exception):
+                    lengths[key] = length
+                else:
+                    retype.append((key, key_type))
+            else:
+                self.key_types.pop((instance_key, key), None)
+                lengths[key] = None
+
+        # New keys, or keys whose type changed: one more round trip for all of them
+        if retype:
+            pipe = conn.pipeline(transaction=False)
+            for key, key_type in retype:
+                getattr(pipe, LENGTH_COMMANDS[key_type])(key)
+            for (key, _), length in zip(retype, pipe.execute(raise_on_error=False)):
+                lengths[key] = None if isinstance(length, Exception) else length
+
+        for key in keys:
+            key_tags = l_tags + ['key:' + key]
+            length = lengths.get(key)
+            if length is not None:
+                self.gauge('redis.key.length', length, tags=key_tags)
+            elif not self._is_pattern(key):
+                # If the type is unknown, it might be because the key doesn't exist,
+                # which can be because the list is empty. So always send 0 in that case.
+                if instance.get("warn_on_missing_keys", True):
+                    self.warning("{0} key not found in redis".format(key))
+                self.gauge('redis.key.length', 0, tags=key_tags)
+
     def _check_replication(self, info, tags):
 
         # Save the replication delay for each slave
@@ -273,18 +398,15 @@ class Redis(AgentCheck):
             self.service_check('redis.replication.master_link_status', status, tags=tags)
             self.gauge('redis.replication.master_link_down_since_seconds', down_seconds, tags=tags)
 
-    def _check_slowlog(self, instance, custom_tags):
-        """Retrieve length and entries from Redis' SLOWLOG
-
-        This will parse through all entries of the SLOWLOG and select ones
-        within the time range between the last seen entries and now
-
+    def _get_max_slow_entries(self, conn, instance, instance_key):
         """
-        conn = self._get_conn(instance)
-
-        tags, _ = self._get_tags(custom_tags, instance)
+        Return the number of SLOWLOG entries to fetch, read from the redis
+        config on the first run if not set in the check config.
+        """
+        if instance.get(MAX_SLOW_ENTRIES_KEY):
+            return int(instance.get(MAX_SLOW_ENTRIES_KEY))
 
-        if not instance.get(MAX_SLOW_ENTRIES_KEY):
+        if instance_key not in self.max_slow_entries:
             try:
                 max_slow_entries = int(conn.config_get(MAX_SLOW_ENTRIES_KEY)[MAX_SLOW_ENTRIES_KEY])
                 if max_slow_entries > DEFAULT_MAX_SLOW_ENTRIES:
@@ -295,16 +417,18 @@ class Redis(AgentCheck):
             # No config on AWS Elasticache
             except redis.ResponseError:
                 max_slow_entries = DEFAULT_MAX_SLOW_ENTRIES
-        else:
-            max_slow_entries = int(instance.get(MAX_SLOW_ENTRIES_KEY))
+            self.max_slow_entries[instance_key] = max_slow_entries
 
-        # Generate a unique id for this instance to be persisted across runs
-        ts_key = self._generate_instance_key(instance)
+        return self.max_slow_entries[instance_key]
 
-        # Get all slowlog entries
+    def _check_slowlog(self, ts_key, slowlogs, tags):
+        """Process the entries of Redis' SLOWLOG
 
-        slowlogs = conn.slowlog_get(max_slow_entries)
+        This will parse through all entries of the SLOWLOG and select ones
+        within the time range between the last seen entries and now
 
+        `ts_key` is a unique id for this instance, persisted across runs
+        """
         # Find slowlog entries between last timestamp and now using start_time
         slowlogs = [s for s in slowlogs if s['start_time'] >
             self.last_timestamp_seen[ts_key]]
@@ -331,7 +455,6 @@ class Redis(AgentCheck):
         custom_tags = instance.get('tags', [])
 
         self._check_db(instance, custom_tags)
-        self._check_slowlog(instance, custom_tags)
 
     def _collect_metadata(self, info):
         if info and 'redis_version' in info:
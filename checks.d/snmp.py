@@ -1,12 +1,14 @@
 # std
 from collections import defaultdict
-from functools import wraps
+import time
 
 # 3rd party
+from pyasn1.type import univ
 from pysnmp.entity.rfc3413.oneliner import cmdgen
+from pysnmp.proto import errind
 import pysnmp.proto.rfc1902 as snmp_type
 from pysnmp.smi import builder
-from pysnmp.smi.exval import noSuchInstance, noSuchObject
+from pysnmp.smi.exval import endOfMibView, noSuchInstance, noSuchObject
 
 # project
 from checks import AgentCheck
@@ -34,6 +36,8 @@ SNMP_GAUGES = frozenset([
     snmp_type.Integer32.__name__])
 
 DEFAULT_OID_BATCH_SIZE = 10
+# Number of rows of a table fetched by each GETBULK request
+DEFAULT_BULK_MAX_REPETITIONS = 10
 
 
 def reply_invalid(oid):
@@ -41,6 +45,55 @@ def reply_invalid(oid):
         noSuchObject.isSameTypeWith(oid)
 
 
+class OIDQuery(object):
+    '''
+    Requests made to one device for a list of OIDs: snmpget by batches,
+    then a walk of the OIDs that aren't leaves, with GETBULK requests
+    (GETNEXT in SNMP v1).
+
+    Queries are run concurrently by `SnmpCheck.run_queries`, each callback
+    sending the next request of its query.
+    '''
+
+    def __init__(self, instance, oids, lookup_names, timeout, retries):
+        self.instance = instance
+        self.oids = oids
+        self.lookup_names = lookup_names
+        self.transport_target = SnmpCheck.get_transport_target(instance, timeout, retries)
+        self.auth_data = SnmpCheck.get_auth_data(instance)
+        self.snmp_v1 = getattr(self.auth_data, 'mpModel', None) == 0
+
+        self.next_oid = 0
+        self.var_binds = []
+        self.service_check_error = None
+        self.error = None
+
+    def fail(self, error, service_check_error=None):
+        self.error = error
+        if service_check_error is not None:
+            self.service_check_error = service_check_error
+
+    def get_results(self):
+        '''
+        Returns a dictionary:
+        dict[oid/metric_name][row index] = value
+        In case of scalar objects, the row index is just 0
+        '''
+        if self.error is not None:
+            raise self.error
+
+        results = defaultdict(dict)
+        for result_oid, value in self.var_binds:
+            if self.lookup_names:
+                _, metric, indexes = result_oid.getMibSymbol()
+                results[metric][indexes] = value
+            else:
+                oid = result_oid.asTuple()
+                matching = ".".join([str(i) for i in oid])
+                results[matching] = value
+        return results
+
+
 class SnmpCheck(AgentCheck):
 
     cmd_generator = None
@@ -62,21 +115,15 @@ class SnmpCheck(AgentCheck):
         # Create SNMP command generator and aliases
         self.create_command_generator(mibs_path, ignore_nonincreasing_oid)
 
+        self.ignore_nonincreasing_oid = ignore_nonincreasing_oid
+
         # Set OID batch size
         self.oid_batch_size = int(init_config.get("oid_batch_size", DEFAULT_OID_BATCH_SIZE))
+        self.bulk_max_repetitions = int(init_config.get("bulk_max_repetitions",
+                                                        DEFAULT_BULK_MAX_REPETITIONS))
 
-    def snmp_logger(self, func):
-        """
-        Decorator to log, with DEBUG level, SNMP commands
-        """
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            self.log.debug("Running SNMP command {0} on OIDS {1}"
-                           .format(func.__name__, args[2:]))
-            result = func(*args, **kwargs)
-            self.log.debug("Returned vars: {0}".format(result[-1]))
-            return result
-        return wrapper
+        # Results of the devices polled at the beginning of the run, by instance index
+        self._prefetched = {}
 
     def create_command_generator(self, mibs_path, ignore_nonincreasing_oid):
         '''
@@ -84,7 +131,10 @@ class SnmpCheck(AgentCheck):
         If mibs_path is not None, load the mibs present in the custom mibs
         folder. (Need to be in pysnmp format)
         '''
-        self.cmd_generator = cmdgen.CommandGenerator()
+        # All the requests are sent asynchronously by `async_cmd_generator`
+        # and handled by the dispatcher of its engine
+        self.async_cmd_generator = cmdgen.AsynCommandGenerator()
+        self.cmd_generator = cmdgen.CommandGenerator(asynCmdGen=self.async_cmd_generator)
         self.cmd_generator.ignoreNonIncreasingOid = ignore_nonincreasing_oid
         if mibs_path is not None:
             mib_builder = self.cmd_generator.snmpEngine.msgAndPduDsp.\
@@ -93,10 +143,6 @@ class SnmpCheck(AgentCheck):
                 (builder.DirMibSource(mibs_path), )
             mib_builder.setMibSources(*mib_sources)
 
-        # Set aliases for snmpget and snmpgetnext with logging
-        self.snmpget = self.snmp_logger(self.cmd_generator.getCmd)
-        self.snmpgetnext = self.snmp_logger(self.cmd_generator.nextCmd)
-
     @classmethod
     def get_auth_data(cls, instance):
         '''
@@ -150,13 +196,6 @@ class SnmpCheck(AgentCheck):
         port = int(instance.get("port", 161)) # Default SNMP port
         return cmdgen.UdpTransportTarget((ip_address, port), timeout=timeout, retries=retries)
 
-    def raise_on_error_indication(self, error_indication, instance):
-        if error_indication:
-            message = "{0} for instance {1}".format(error_indication,
-                                                    instance["ip_address"])
-            instance["service_check_error"] = message
-            raise Exception(message)
-
     def check_table(self, instance, oids, lookup_names, timeout, retries):
         '''
         Perform a snmpwalk on the domain specified by the oids, on the device
@@ -168,37 +207,61 @@ class SnmpCheck(AgentCheck):
         dict[oid/metric_name][row index] = value
         In case of scalar objects, the row index is just 0
         '''
-        # UPDATE: We used to perform only a snmpgetnext command to fetch metric values.
-        # It returns the wrong value when the OID passeed is referring to a specific leaf.
-        # For example:
-        # snmpgetnext -v2c -c public localhost:11111 1.36.1.2.1.25.4.2.1.7.222
-        # iso.3.6.1.2.1.25.4.2.1.7.224 = INTEGER: 2
-        # SOLUTION: perform a snmget command and fallback with snmpgetnext if not found
-        transport_target = self.get_transport_target(instance, timeout, retries)
-        auth_data = self.get_auth_data(instance)
-
-        first_oid = 0
-        all_binds = []
-        results = defaultdict(dict)
-
-        while first_oid < len(oids):
+        query = OIDQuery(instance, oids, lookup_names, timeout, retries)
+        self.run_queries([query])
+        if query.service_check_error is not None:
+            instance["service_check_error"] = query.service_check_error
+        results = query.get_results()
+        self.log.debug("Raw results: {0}".format(results))
+        return results
 
-            # Start with snmpget command
-            error_indication, error_status, error_index, var_binds = self.snmpget(
-                auth_data,
-                transport_target,
-                *(oids[first_oid:first_oid + self.oid_batch_size]),
-                lookupValues=lookup_names,
-                lookupNames=lookup_names)
+    def run_queries(self, queries):
+        '''
+        Send the requests of all the queries at once and wait for them to
+        complete, each device failing on its own timeout.
+        '''
+        for query in queries:
+            self._send_get(query)
+        # No dispatcher until a first request is sent
+        dispatcher = self.async_cmd_generator.snmpEngine.transportDispatcher
+        if dispatcher is not None:
+            dispatcher.runDispatcher()
+
+    # UPDATE: We used to perform only a snmpgetnext command to fetch metric values.
+    # It returns the wrong value when the OID passeed is referring to a specific leaf.
+    # For example:
+    # snmpgetnext -v2c -c public localhost:11111 1.36.1.2.1.25.4.2.1.7.222
+    # iso.3.6.1.2.1.25.4.2.1.7.224 = INTEGER: 2
+    # SOLUTION: perform a snmget command and fallback with a walk if not found
+    def _send_get(self, query):
+        if query.next_oid >= len(query.oids):
+            return
 
-            first_oid = first_oid + self.oid_batch_size
+        oids = query.oids[query.next_oid:query.next_oid + self.oid_batch_size]
+        query.next_oid += self.oid_batch_size
+        self.log.debug("Running SNMP command getCmd on OIDS {0}".format(oids))
+        try:
+            self.async_cmd_generator.getCmd(
+                query.auth_data,
+                query.transport_target,
+                oids,
+                (self._on_get, query),
+                lookupNames=query.lookup_names,
+                lookupValues=query.lookup_names)
+        except Exception as e:
+            query.fail(e)
 
-            # Raise on error_indication
-            self.raise_on_error_indication(error_indication, instance)
+    def _on_get(self, send_request_handle, error_indication, error_status,
+                error_index, var_binds, query):
+        try:
+            self.log.debug("Returned vars: {0}".format(var_binds))
+            if error_indication:
+                message = "{0} for instance {1}".format(error_indication,
+                                                        query.instance["ip_address"])
+                query.fail(Exception(message), message)
+                return
 
             missing_results = []
-            complete_results = []
-
             for var in var_binds:
                 result_oid, value = var
                 if reply_invalid(value):
@@ -206,53 +269,85 @@ class SnmpCheck(AgentCheck):
                     oid = ".".join([str(i) for i in oid_tuple])
                     missing_results.append(oid)
                 else:
-                    complete_results.append(var)
+                    query.var_binds.append(var)
 
             if missing_results:
-                # If we didn't catch the metric using snmpget, try snmpnext
-                error_indication, error_status, error_index, var_binds_table = self.snmpgetnext(
-                    auth_data,
-                    transport_target,
-                    *missing_results,
-                    lookupValues=lookup_names,
-                    lookupNames=lookup_names)
-
-                # Raise on error_indication
-                self.raise_on_error_indication(error_indication, instance)
-
-                if error_status:
-                    message = "{0} for instance {1}".format(error_status.prettyPrint(),
-                                                            instance["ip_address"])
-                    instance["service_check_error"] = message
-                    self.log.warning(message)
+                # If we didn't catch the metric using snmpget, walk it
+                self._send_walk(query, missing_results)
+            else:
+                self._send_get(query)
+        except Exception as e:
+            query.fail(e)
 
-                for table_row in var_binds_table:
-                    complete_results.extend(table_row)
+    def _send_walk(self, query, oids):
+        # The walk of a column stops at the first OID out of its subtree
+        heads = [univ.ObjectIdentifier(oid) for oid in oids]
+        kwargs = dict(lookupNames=query.lookup_names, lookupValues=query.lookup_names)
+        try:
+            if query.snmp_v1:
+                # No GETBULK in SNMP v1
+                self.log.debug("Running SNMP command nextCmd on OIDS {0}".format(oids))
+                self.async_cmd_generator.nextCmd(
+                    query.auth_data, query.transport_target, oids,
+                    (self._on_walk, (query, heads)), **kwargs)
+            else:
+                self.log.debug("Running SNMP command bulkCmd on OIDS {0}".format(oids))
+                self.async_cmd_generator.bulkCmd(
+                    query.auth_data, query.transport_target,
+                    0, self.bulk_max_repetitions, oids,
+                    (self._on_walk, (query, heads)), **kwargs)
+        except Exception as e:
+            query.fail(e)
 
-            all_binds.extend(complete_results)
+    def _on_walk(self, send_request_handle, error_indication, error_status,
+                 error_index, var_bind_table, cb_ctx):
+        '''
+        Keep the rows of the walked subtrees, return True to request the
+        next rows.
+        '''
+        query, heads = cb_ctx
+        try:
+            self.log.debug("Returned vars: {0}".format(var_bind_table))
+            if error_indication and not (self.ignore_nonincreasing_oid and
+                                         isinstance(error_indication, errind.OidNotIncreasing)):
+                message = "{0} for instance {1}".format(error_indication,
+                                                        query.instance["ip_address"])
+                query.fail(Exception(message), message)
+                return False
+
+            if error_status:
+                # SNMP v1 agents answer noSuchName at the end of the MIB
+                if not (query.snmp_v1 and error_status == 2):
+                    message = "{0} for instance {1}".format(error_status.prettyPrint(),
+                                                            query.instance["ip_address"])
+                    query.service_check_error = message
+                    self.log.warning(message)
 
-        for result_oid, value in all_binds:
-            if lookup_names:
-                _, metric, indexes = result_oid.getMibSymbol()
-                results[metric][indexes] = value
             else:
-                oid = result_oid.asTuple()
-                matching = ".".join([str(i) for i in oid])
-                results[matching] = value
-        self.log.debug("Raw results: {0}".format(results))
-        return results
+                in_subtree = False
+                for row in var_bind_table:
+                    in_subtree = False
+                    for head, (result_oid, value) in zip(heads, row):
+                        if endOfMibView.isSameTypeWith(value) or \
+                                not head.isPrefixOf(univ.ObjectIdentifier(result_oid.asTuple())):
+                            continue
+                        query.var_binds.append((result_oid, value))
+                        in_subtree = True
+                if in_subtree:
+                    return True
+
+            self._send_get(query)
+        except Exception as e:
+            query.fail(e)
+        return False
 
-    def check(self, instance):
+    def get_oids(self, instance):
         '''
-        Perform two series of SNMP requests, one for all that have MIB asociated
-        and should be looked up and one for those specified by oids
+        Split the metrics of the instance in OIDs to look up in their MIB
+        and raw OIDs
         '''
-        tags = instance.get("tags", [])
-        ip_address = instance["ip_address"]
         table_oids = []
         raw_oids = []
-        timeout = int(instance.get('timeout', self.DEFAULT_TIMEOUT))
-        retries = int(instance.get('retries', self.DEFAULT_RETRIES))
 
         # Check the metrics completely defined
         for metric in instance.get('metrics', []):
@@ -268,15 +363,79 @@ class SnmpCheck(AgentCheck):
                 raw_oids.append(metric['OID'])
             else:
                 raise Exception('Unsupported metric in config file: %s' % metric)
+
+        return table_oids, raw_oids
+
+    def get_queries(self, instance):
+        timeout = int(instance.get('timeout', self.DEFAULT_TIMEOUT))
+        retries = int(instance.get('retries', self.DEFAULT_RETRIES))
+        table_oids, raw_oids = self.get_oids(instance)
+
+        table_query = raw_query = None
+        if table_oids:
+            table_query = OIDQuery(instance, table_oids, True, timeout, retries)
+        if raw_oids:
+            raw_query = OIDQuery(instance, raw_oids, False, timeout, retries)
+        return table_query, raw_query
+
+    def run(self):
+        '''
+        Poll all the devices due for collection at once, `check` then
+        reports the results of each instance.
+        '''
+        now = time.time()
+        queries = []
+        for i, instance in enumerate(self.instances):
+            if now - self.last_collection_time[i] < self.get_min_collection_interval(instance):
+                continue
+            try:
+                instance_queries = self.get_queries(instance)
+            except Exception:
+                # check() fails with the same error
+                continue
+            self._prefetched[i] = instance_queries
+            queries.extend(q for q in instance_queries if q is not None)
+
         try:
-            if table_oids:
-                self.log.debug("Querying device %s for %s oids", ip_address, len(table_oids))
-                table_results = self.check_table(instance, table_oids, True, timeout, retries)
+            if queries:
+                self.log.debug("Querying %s devices", len(self._prefetched))
+                start = time.time()
+                self.run_queries(queries)
+                self.log.debug("Queried %s devices in %.3fs", len(self._prefetched), time.time() - start)
+            return AgentCheck.run(self)
+        finally:
+            self._prefetched = {}
+
+    def check(self, instance):
+        '''
+        Perform two series of SNMP requests, one for all that have MIB asociated
+        and should be looked up and one for those specified by oids
+        '''
+        ip_address = instance["ip_address"]
+
+        queries = self._prefetched.pop(self._instance_index, None)
+        polled = queries is not None
+        if not polled:
+            queries = self.get_queries(instance)
+        table_query, raw_query = queries
+
+        try:
+            if not polled:
+                self.log.debug("Querying device %s", ip_address)
+                self.run_queries([q for q in queries if q is not None])
+
+            for query in queries:
+                if query is not None and query.service_check_error is not None:
+                    instance["service_check_error"] = query.service_check_error
+
+            if table_query is not None:
+                table_results = table_query.get_results()
+                self.log.debug("Raw results: {0}".format(table_results))
                 self.report_table_metrics(instance, table_results)
 
-            if raw_oids:
-                self.log.debug("Querying device %s for %s oids", ip_address, len(raw_oids))
-                raw_results = self.check_table(instance, raw_oids, False, timeout, retries)
+            if raw_query is not None:
+                raw_results = raw_query.get_results()
+                self.log.debug("Raw results: {0}".format(raw_results))
                 self.report_raw_metrics(instance, raw_results)
         except Exception as e:
             if "service_check_error" not in instance:
@@ -15,8 +15,8 @@ class TCPCheck(NetworkCheck):
     SOURCE_TYPE_NAME = 'system'
     SERVICE_CHECK_NAME = 'tcp.can_connect'
 
-    def _load_conf(self, instance):
-        # Fetches the conf
+    def _parse_conf(self, instance):
+        # Fetches the conf, the host is resolved later
 
         port = instance.get('port', None)
         timeout = float(instance.get('timeout', 10))
@@ -39,13 +39,18 @@ class TCPCheck(NetworkCheck):
                 if len(block) != 4:
                     raise BadConfException("%s is not a correct IPv6 address." % url)
 
-            addr = url
             # It's a correct IP V6 address
             socket_type = socket.AF_INET6
 
+        return url, port, socket_type, timeout, response_time
+
+    def _load_conf(self, instance):
+        # Fetches the conf
+        addr, port, socket_type, timeout, response_time = self._parse_conf(instance)
+
         if socket_type is None:
             try:
-                addr = socket.gethostbyname(url)
+                addr = socket.gethostbyname(addr)
                 socket_type = socket.AF_INET
             except Exception:
                 raise BadConfException("URL: %s is not a correct IPv4, IPv6 or hostname" % addr)
@@ -55,6 +60,7 @@ class TCPCheck(NetworkCheck):
     def _check(self, instance):
         addr, port, socket_type, timeout, response_time = self._load_conf(instance)
         start = time.time()
+        error = None
         try:
             self.log.debug("Connecting to %s %s" % (addr, port))
             sock = socket.socket(socket_type)
@@ -63,34 +69,47 @@ class TCPCheck(NetworkCheck):
                 sock.connect((addr, port))
             finally:
                 sock.close()
+        except Exception, e:
+            error = e
+
+        return self._get_status(instance, addr, port, error, time.time() - start, response_time)
 
-        except socket.timeout, e:
+    def _probe(self, instance, engine, done):
+        host, port, socket_type, timeout, response_time = self._parse_conf(instance)
+
+        def on_connected(error, stream, elapsed):
+            if isinstance(error, socket.gaierror):
+                raise BadConfException("URL: %s is not a correct IPv4, IPv6 or hostname" % host)
+            done(self._get_status(instance, host, port, error, elapsed, response_time))
+
+        self.log.debug("Connecting to %s %s" % (host, port))
+        if socket_type is None:
+            engine.resolve_and_connect(host, port, socket.AF_INET, timeout, on_connected)
+        else:
+            engine.connect((host, port), socket_type, timeout, on_connected)
+
+    def _get_status(self, instance, addr, port, error, elapsed, response_time):
+        length = int(elapsed * 1000)
+
+        if isinstance(error, socket.timeout):
             # The connection timed out because it took more time than the specified value in the yaml config file
-            length = int((time.time() - start) * 1000)
-            self.log.info("%s:%s is DOWN (%s). Connection failed after %s ms" % (addr, port, str(e), length))
-            return Status.DOWN, "%s. Connection failed after %s ms" % (str(e), length)
-
-        except socket.error, e:
-            length = int((time.time() - start) * 1000)
-            if "timed out" in str(e):
-
-                # The connection timed out becase it took more time than the system tcp stack allows
-                self.log.warning("The connection timed out because it took more time than the system tcp stack allows. You might want to change this setting to allow longer timeouts")
-                self.log.info("System tcp timeout. Assuming that the checked system is down")
-                return Status.DOWN, """Socket error: %s.
+            self.log.info("%s:%s is DOWN (%s). Connection failed after %s ms" % (addr, port, str(error), length))
+            return Status.DOWN, "%s. Connection failed after %s ms" % (str(error), length)
+
+        elif isinstance(error, socket.error) and "timed out" in str(error):
+            # The connection timed out becase it took more time than the system tcp stack allows
+            self.log.warning("The connection timed out because it took more time than the system tcp stack allows. You might want to change this setting to allow longer timeouts")
+            self.log.info("System tcp timeout. Assuming that the checked system is down")
+            return Status.DOWN, """Socket error: %s.
                  The connection timed out after %s ms because it took more time than the system tcp stack allows.
-                 You might want to change this setting to allow longer timeouts""" % (str(e), length)
-            else:
-                self.log.info("%s:%s is DOWN (%s). Connection failed after %s ms" % (addr, port, str(e), length))
-                return Status.DOWN, "%s. Connection failed after %s ms" % (str(e), length)
+                 You might want to change this setting to allow longer timeouts""" % (str(error), length)
 
-        except Exception, e:
-            length = int((time.time() - start) * 1000)
-            self.log.info("%s:%s is DOWN (%s). Connection failed after %s ms" % (addr, port, str(e), length))
-            return Status.DOWN, "%s. Connection failed after %s ms" % (str(e), length)
+        elif error is not None:
+            self.log.info("%s:%s is DOWN (%s). Connection failed after %s ms" % (addr, port, str(error), length))
+            return Status.DOWN, "%s. Connection failed after %s ms" % (str(error), length)
 
         if response_time:
-            self.gauge('network.tcp.response_time', time.time() - start, tags=['url:%s:%s' % (instance.get('host', None), port)])
+            self.gauge('network.tcp.response_time', elapsed, tags=['url:%s:%s' % (instance.get('host', None), port)])
 
         self.log.debug("%s:%s is UP" % (addr, port))
         return Status.UP, "UP"
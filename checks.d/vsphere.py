@@ -1,9 +1,11 @@
 # stdlib
+from collections import deque
 from copy import deepcopy
 from datetime import datetime, timedelta
 from hashlib import md5
 from Queue import Empty, Queue
 import re
+import threading
 import time
 import traceback
 
@@ -28,6 +30,8 @@ REFRESH_MORLIST_INTERVAL = 3 * 60
 REFRESH_METRICS_METADATA_INTERVAL = 10 * 60
 # The amount of jobs batched at the same time in the queue to query available metrics
 BATCH_MORLIST_SIZE = 50
+# The amount of MORs whose metrics are fetched by a single QueryPerf call
+BATCH_QUERY_SIZE = 64
 
 # Time after which we reap the jobs that clog the queue
 # TODO: use it
@@ -308,6 +312,19 @@ class VSphereCheck(AgentCheck):
         self.time_started = time.time()
         self.pool_started = False
         self.exceptionq = Queue()
+        # Submissions from the pool threads, made by the check thread
+        self.submissionq = Queue()
+
+        # Number of QueryPerf batches not done yet, per instance
+        self._pending_queries = {}
+        self._pending_queries_lock = threading.Lock()
+        # QueryPerf batches not handed to the pool yet, as (instance, mors),
+        # and the number of batches in the pool, see `_submit_queries`
+        self._queued_queries = deque()
+        self._running_queries = 0
+        # Incremented when the pool is (re)started, the batches of an older
+        # pool are not counted anymore
+        self._query_generation = 0
 
         # Connections open to vCenter instances
         self.server_instances = {}
@@ -353,6 +370,15 @@ class VSphereCheck(AgentCheck):
         self.pool_started = True
         self.jobs_status = {}
 
+        # At most that many batches are in the pool at once, leaving
+        # workers to the other jobs
+        self.max_concurrent_queries = max(1, int(self.init_config.get('max_concurrent_queries', self.pool_size)))
+        with self._pending_queries_lock:
+            self._pending_queries.clear()
+            self._queued_queries.clear()
+            self._running_queries = 0
+            self._query_generation += 1
+
     def stop_pool(self):
         self.log.info("Stopping Thread Pool")
         if self.pool_started:
@@ -581,7 +607,7 @@ class VSphereCheck(AgentCheck):
             self.morlist_raw[i_key].append(watched_mor)
 
         ### <TEST-INSTRUMENTATION>
-        self.histogram('datadog.agent.vsphere.morlist_raw_atomic.time', t.total())
+        self._submit('histogram', 'datadog.agent.vsphere.morlist_raw_atomic.time', t.total())
         ### </TEST-INSTRUMENTATION>
 
     def _cache_morlist_raw(self, instance):
@@ -646,7 +672,7 @@ class VSphereCheck(AgentCheck):
         self.morlist[i_key][mor_name]['last_seen'] = time.time()
 
         ### <TEST-INSTRUMENTATION>
-        self.histogram('datadog.agent.vsphere.morlist_process_atomic.time', t.total())
+        self._submit('histogram', 'datadog.agent.vsphere.morlist_process_atomic.time', t.total())
         ### </TEST-INSTRUMENTATION>
 
     def _cache_morlist_process(self, instance):
@@ -708,7 +734,7 @@ class VSphereCheck(AgentCheck):
         self.metrics_metadata[i_key] = new_metadata
 
         ### <TEST-INSTRUMENTATION>
-        self.histogram('datadog.agent.vsphere.metric_metadata_collection.time', t.total())
+        self._submit('histogram', 'datadog.agent.vsphere.metric_metadata_collection.time', t.total())
         ### </TEST-INSTRUMENTATION>
 
     def _transform_value(self, instance, counter_id, value):
@@ -724,44 +750,97 @@ class VSphereCheck(AgentCheck):
         # Defaults to return the value without transformation
         return value
 
-    @atomic_method
-    def _collect_metrics_atomic(self, instance, mor):
-        """ Task that collects the metrics listed in the morlist for one MOR
+    def _submit(self, method, *args, **kwargs):
+        """ Queue a submission made from a pool thread, the aggregator
+        isn't thread-safe: see `_flush_submissions`.
         """
-        ### <TEST-INSTRUMENTATION>
-        t = Timer()
-        ### </TEST-INSTRUMENTATION>
+        self.submissionq.put((method, args, kwargs))
+
+    def _flush_submissions(self):
+        try:
+            while True:
+                method, args, kwargs = self.submissionq.get_nowait()
+                getattr(self, method)(*args, **kwargs)
+        except Empty:
+            pass
+
+    def _submit_queries(self):
+        """ Hand the queued QueryPerf batches to the pool, keeping at most
+        `max_concurrent_queries` of them there: a batch waiting in the pool
+        would delay the morlist and metadata jobs queued behind it. Each
+        batch done submits the next one.
+        """
+        with self._pending_queries_lock:
+            while self._queued_queries and self._running_queries < self.max_concurrent_queries:
+                instance, mors = self._queued_queries.popleft()
+                self._running_queries += 1
+                self.pool.apply_async(self._collect_metrics_atomic,
+                                      args=(instance, mors, self._query_generation))
+
+    def _query_done(self, i_key, generation):
+        with self._pending_queries_lock:
+            if generation != self._query_generation:
+                # The pool was restarted in the meantime
+                return
+            self._pending_queries[i_key] -= 1
+            self._running_queries -= 1
+        self._submit_queries()
 
+    @atomic_method
+    def _collect_metrics_atomic(self, instance, mors, generation):
+        """ Task that collects the metrics listed in the morlist for a batch
+        of MORs, with a single QueryPerf call
+        """
         i_key = self._instance_key(instance)
-        server_instance = self._get_server_instance(instance)
-        perfManager = server_instance.content.perfManager
-        query = vim.PerformanceManager.QuerySpec(maxSample=1,
-                                                 entity=mor['mor'],
-                                                 metricId=mor['metrics'],
-                                                 intervalId=20,
-                                                 format='normal')
-        results = perfManager.QueryPerf(querySpec=[query])
-        if results:
-            for result in results[0].value:
+        try:
+            ### <TEST-INSTRUMENTATION>
+            t = Timer()
+            ### </TEST-INSTRUMENTATION>
+
+            server_instance = self._get_server_instance(instance)
+            perfManager = server_instance.content.perfManager
+            queries = []
+            mors_by_name = {}
+            for mor in mors:
+                queries.append(vim.PerformanceManager.QuerySpec(maxSample=1,
+                                                                entity=mor['mor'],
+                                                                metricId=mor['metrics'],
+                                                                intervalId=20,
+                                                                format='normal'))
+                mors_by_name[str(mor['mor'])] = mor
+            results = perfManager.QueryPerf(querySpec=queries)
+
+            ### <TEST-INSTRUMENTATION>
+            self._submit('histogram', 'datadog.agent.vsphere.metric_colection.time', t.total(),
+                         tags=['vcenter_server:%s' % i_key])
+            self._submit('histogram', 'datadog.agent.vsphere.metric_colection.batch_size', len(mors),
+                         tags=['vcenter_server:%s' % i_key])
+            ### </TEST-INSTRUMENTATION>
+        finally:
+            self._query_done(i_key, generation)
+
+        for entity_result in results or []:
+            mor = mors_by_name.get(str(entity_result.entity))
+            if mor is None:
+                self.log.debug("Skipping the values of %s, it wasn't queried", entity_result.entity)
+                continue
+            for result in entity_result.value:
                 if result.id.counterId not in self.metrics_metadata[i_key]:
                     self.log.debug("Skipping this metric value, because there is no metadata about it")
                     continue
                 instance_name = result.id.instance or "none"
                 value = self._transform_value(instance, result.id.counterId, result.value[0])
-                self.gauge(
+                self._submit(
+                    'gauge',
                     "vsphere.%s" % self.metrics_metadata[i_key][result.id.counterId]['name'],
                     value,
                     hostname=mor['hostname'],
                     tags=['instance:%s' % instance_name]
                 )
 
-        ### <TEST-INSTRUMENTATION>
-        self.histogram('datadog.agent.vsphere.metric_colection.time', t.total())
-        ### </TEST-INSTRUMENTATION>
-
     def collect_metrics(self, instance):
-        """ Calls asynchronously _collect_metrics_atomic on all MORs, as the
-        job queue is processed the Aggregator will receive the metrics.
+        """ Calls asynchronously _collect_metrics_atomic on batches of MORs, as
+        the job queue is processed the metrics are queued for submission.
         """
         i_key = self._instance_key(instance)
         if i_key not in self.morlist:
@@ -772,6 +851,9 @@ class VSphereCheck(AgentCheck):
         self.log.debug("Collecting metrics of %d mors" % len(mors))
 
         vm_count = 0
+        batch_size = max(1, int(self.init_config.get('batch_query_size', BATCH_QUERY_SIZE)))
+        batches = []
+        batch = []
 
         for mor_name, mor in mors:
             if mor['mor_type'] == 'vm':
@@ -780,10 +862,26 @@ class VSphereCheck(AgentCheck):
                 # self.log.debug("Skipping entity %s collection because we didn't cache its metrics yet" % mor['hostname'])
                 continue
 
-            self.pool.apply_async(self._collect_metrics_atomic, args=(instance, mor))
+            batch.append(mor)
+            if len(batch) >= batch_size:
+                batches.append(batch)
+                batch = []
+        if batch:
+            batches.append(batch)
 
         self.gauge('vsphere.vm.count', vm_count, tags=["vcenter_server:%s" % instance.get('name')])
 
+        with self._pending_queries_lock:
+            pending = self._pending_queries.get(i_key, 0)
+            if pending:
+                self.log.warning("%s metric queries of the last run of %s are still pending, "
+                                 "skipping this run", pending, i_key)
+                return
+            self._pending_queries[i_key] = len(batches)
+            self._queued_queries.extend((instance, batch) for batch in batches)
+
+        self._submit_queries()
+
     def check(self, instance):
         if not self.pool_started:
             self.start_pool()
@@ -807,6 +905,9 @@ class VSphereCheck(AgentCheck):
         # For our own sanity
         self._clean()
 
+        # Submit what the pool threads collected so far
+        self._flush_submissions()
+
         thread_crashed = False
         try:
             while True:
@@ -25,6 +25,8 @@ import yaml
 # project
 from checks import check_status
 from util import get_hostname, get_next_id, LaconicFilter, yLoader
+from utils.httpclient import DEFAULT_MAX_CONNECTIONS_PER_HOST, HTTPClient
+from utils.lru_cache import LRUCache
 from utils.platform import Platform
 from utils.profile import pretty_statistics
 if Platform.is_windows():
@@ -37,6 +39,82 @@ DEFAULT_PSUTIL_METHODS = ['get_memory_info', 'get_io_counters']
 
 AGENT_METRICS_CHECK_NAME = 'agent_metrics'
 
+# Per-context state (saved samples, historates) not updated for that long is
+# dropped, like the aggregator does for its metrics
+CONTEXT_EXPIRY_SECONDS = 300
+# Stale contexts are looked for at most that often, not on every flush
+CONTEXT_SWEEP_INTERVAL = 60
+
+# Approximate memory used by the normalized metric names, in bytes
+NORMALIZATION_CACHE_SIZE = 1024 * 1024
+# Overhead of a cache entry (tuple, dict slot...), on top of its strings
+NORMALIZATION_CACHE_ENTRY_OVERHEAD = 200
+
+FIRST_CAP_RE = re.compile('(.)([A-Z][a-z]+)')
+ALL_CAP_RE = re.compile('([a-z0-9])([A-Z])')
+METRIC_REPLACEMENT = re.compile(r'([^a-zA-Z0-9_.]+)|(^[^a-zA-Z]+)')
+DOT_UNDERSCORE_CLEANUP = re.compile(r'_*\._*')
+
+ILLEGAL_CHARS_RE = re.compile(r"[,\+\*\-/()\[\]{}]")
+MULTIPLE_UNDERSCORES_RE = re.compile(r"__+")
+LEADING_UNDERSCORE_RE = re.compile(r"^_")
+TRAILING_UNDERSCORE_RE = re.compile(r"_$")
+DOT_UNDERSCORE_RE = re.compile(r"\._")
+UNDERSCORE_DOT_RE = re.compile(r"_\.")
+
+
+def _normalization_entry_size(key, value):
+    return sum(len(k) for k in key[1:3] if k) + len(value) + NORMALIZATION_CACHE_ENTRY_OVERHEAD
+
+# The checks normalize the same metric names on every run: the results are
+# cached for all of them
+normalization_cache = LRUCache(NORMALIZATION_CACHE_SIZE, sizeof=_normalization_entry_size)
+
+
+def _convert_to_underscore_separated(name):
+    metric_name = FIRST_CAP_RE.sub(r'\1_\2', name)
+    metric_name = ALL_CAP_RE.sub(r'\1_\2', metric_name).lower()
+    metric_name = METRIC_REPLACEMENT.sub('_', metric_name)
+    return DOT_UNDERSCORE_CLEANUP.sub('.', metric_name).strip('_')
+
+
+def _normalize(metric, prefix, fix_case):
+    if fix_case:
+        name = _convert_to_underscore_separated(metric)
+        if prefix is not None:
+            prefix = _convert_to_underscore_separated(prefix)
+    else:
+        name = ILLEGAL_CHARS_RE.sub("_", metric)
+    # Eliminate multiple _
+    name = MULTIPLE_UNDERSCORES_RE.sub("_", name)
+    # Don't start/end with _
+    name = LEADING_UNDERSCORE_RE.sub("", name)
+    name = TRAILING_UNDERSCORE_RE.sub("", name)
+    # Drop ._ and _.
+    name = DOT_UNDERSCORE_RE.sub(".", name)
+    name = UNDERSCORE_DOT_RE.sub(".", name)
+
+    if prefix is not None:
+        return prefix + "." + name
+    else:
+        return name
+
+
+def normalize(metric, prefix=None, fix_case=False):
+    """
+    Turn a metric into a well-formed metric name, see `AgentCheck.normalize`
+    """
+    return normalization_cache.get_or_compute(('n', metric, prefix, fix_case), _normalize,
+                                              metric, prefix, fix_case)
+
+
+def convert_to_underscore_separated(name):
+    """
+    Convert from CamelCase to camel_case
+    And substitute illegal metric characters
+    """
+    return normalization_cache.get_or_compute(('u', name, None), _convert_to_underscore_separated, name)
+
 
 # Konstants
 class CheckException(Exception):
@@ -81,6 +159,9 @@ class Check(object):
         #                 untagged values are indexed by None
         self._sample_store = {}
         self._counters = {}  # metric_name: bool
+        # (metric_name, (tags, device_name)) -> last time a sample was saved
+        self._sample_last_seen = {}
+        self._last_context_sweep = time.time()
         self.logger = logger
         try:
             self.logger.addFilter(LaconicFilter())
@@ -91,20 +172,7 @@ class Check(object):
         """Turn a metric into a well-formed metric name
         prefix.b.c
         """
-        name = re.sub(r"[,\+\*\-/()\[\]{}]", "_", metric)
-        # Eliminate multiple _
-        name = re.sub(r"__+", "_", name)
-        # Don't start/end with _
-        name = re.sub(r"^_", "", name)
-        name = re.sub(r"_$", "", name)
-        # Drop ._ and _.
-        name = re.sub(r"\._", ".", name)
-        name = re.sub(r"_\.", ".", name)
-
-        if prefix is not None:
-            return prefix + "." + name
-        else:
-            return name
+        return normalize(metric, prefix)
 
     def normalize_device_name(self, device_name):
         return device_name.strip().lower().replace(' ', '_')
@@ -168,6 +236,7 @@ class Check(object):
 
         # Data eviction rules
         key = (tags, device_name)
+        self._sample_last_seen[(metric, key)] = time.time()
         if self.is_gauge(metric):
             self._sample_store[metric][key] = ((timestamp, value, hostname, device_name), )
         elif self.is_counter(metric):
@@ -286,8 +355,33 @@ class Check(object):
                     metrics.append((m, int(ts), val, attributes))
             except Exception:
                 pass
+
+        self._expire_samples()
         return metrics
 
+    def _expire_samples(self, now=None):
+        """
+        Forget the samples of the contexts which weren't saved for
+        `CONTEXT_EXPIRY_SECONDS`, at most every `CONTEXT_SWEEP_INTERVAL`.
+        """
+        now = now or time.time()
+        if now - self._last_context_sweep < CONTEXT_SWEEP_INTERVAL:
+            return
+        self._last_context_sweep = now
+
+        expiry_timestamp = now - CONTEXT_EXPIRY_SECONDS
+        for context, last_seen in self._sample_last_seen.items():
+            if last_seen < expiry_timestamp:
+                metric, key = context
+                self._sample_store.get(metric, {}).pop(key, None)
+                del self._sample_last_seen[context]
+
+    def get_context_count(self):
+        """
+        Number of contexts whose samples are kept.
+        """
+        return len(self._sample_last_seen)
+
 
 class AgentCheck(object):
     OK, WARNING, CRITICAL, UNKNOWN = (0, 1, 2, 3)
@@ -340,7 +434,38 @@ class AgentCheck(object):
         self.last_collection_time = defaultdict(int)
         self._instance_metadata = []
         self.svc_metadata = []
+        # context -> (last value, last timestamp)
         self.historate_dict = {}
+        self._last_context_sweep = time.time()
+
+        self._http = None
+        # Index of the instance being run, its HTTP requests share a session
+        self._instance_index = None
+
+    @property
+    def http(self):
+        """
+        HTTP client kept for the lifetime of the check, see
+        `utils.httpclient.HTTPClient`.
+        """
+        if self._http is None:
+            self._http = HTTPClient(
+                default_headers={'User-Agent': 'Datadog Agent/%s' % self.agentConfig.get('version')},
+                max_connections_per_host=int(self.init_config.get(
+                    'max_connections_per_host', DEFAULT_MAX_CONNECTIONS_PER_HOST))
+            )
+        return self._http
+
+    def http_get(self, url, conditional=False, **kwargs):
+        """
+        GET `url` with a keep-alive session shared by the runs of the
+        current instance. Takes the same arguments as `requests.get`.
+
+        :param conditional: (optional) Send the validators of the last
+            response of `url` and return it again if the server answers
+            it's not modified
+        """
+        return self.http.get(url, key=self._instance_index, conditional=conditional, **kwargs)
 
     def instance_count(self):
         """ Return the number of instances that are configured for this check. """
@@ -426,7 +551,7 @@ class AgentCheck(object):
         """
         self.aggregator.rate(metric, value, tags, hostname, device_name)
 
-    def histogram(self, metric, value, tags=None, hostname=None, device_name=None):
+    def histogram(self, metric, value, tags=None, hostname=None, device_name=None, sample_rate=1):
         """
         Sample a histogram value, with optional tags, hostname and device name.
 
@@ -435,8 +560,9 @@ class AgentCheck(object):
         :param tags: (optional) A list of tags for this metric
         :param hostname: (optional) A hostname for this metric. Defaults to the current hostname.
         :param device_name: (optional) The device name for this metric
+        :param sample_rate: (optional) The value stands for `1 / sample_rate` samples
         """
-        self.aggregator.histogram(metric, value, tags, hostname, device_name)
+        self.aggregator.histogram(metric, value, tags, hostname, device_name, sample_rate=sample_rate)
 
     @classmethod
     def generate_historate_func(cls, excluding_tags):
@@ -588,7 +714,32 @@ class AgentCheck(object):
         @return the list of samples
         @rtype [(metric_name, timestamp, value, {"tags": ["tag1", "tag2"]}), ...]
         """
-        return self.aggregator.flush()
+        metrics = self.aggregator.flush()
+        self._expire_contexts()
+        return metrics
+
+    def _expire_contexts(self, now=None):
+        """
+        Forget the historate contexts which weren't updated for
+        `CONTEXT_EXPIRY_SECONDS`, at most every `CONTEXT_SWEEP_INTERVAL`.
+        The aggregator expires its own contexts on each flush.
+        """
+        now = now or time.time()
+        if now - self._last_context_sweep < CONTEXT_SWEEP_INTERVAL:
+            return
+        self._last_context_sweep = now
+
+        expiry_timestamp = now - CONTEXT_EXPIRY_SECONDS
+        for context, (_, last_ts) in self.historate_dict.items():
+            if last_ts < expiry_timestamp:
+                del self.historate_dict[context]
+
+    def get_context_count(self):
+        """
+        Number of contexts the check keeps some state for: metrics of the
+        aggregator and historates.
+        """
+        return len(self.aggregator.metrics) + len(self.historate_dict)
 
     def get_events(self):
         """
@@ -712,6 +863,14 @@ class AgentCheck(object):
         self._internal_profiling_stats = None
         return stats
 
+    def get_min_collection_interval(self, instance):
+        return instance.get(
+            'min_collection_interval', self.init_config.get(
+                'min_collection_interval',
+                self.DEFAULT_MIN_COLLECTION_INTERVAL
+            )
+        )
+
     def run(self):
         """ Run all instances. """
 
@@ -726,12 +885,7 @@ class AgentCheck(object):
         instance_statuses = []
         for i, instance in enumerate(self.instances):
             try:
-                min_collection_interval = instance.get(
-                    'min_collection_interval', self.init_config.get(
-                        'min_collection_interval',
-                        self.DEFAULT_MIN_COLLECTION_INTERVAL
-                    )
-                )
+                min_collection_interval = self.get_min_collection_interval(instance)
                 now = time.time()
                 if now - self.last_collection_time[i] < min_collection_interval:
                     self.log.debug("Not running instance #{0} of check {1} as it ran less than {2}s ago".format(i, self.name, min_collection_interval))
@@ -742,6 +896,7 @@ class AgentCheck(object):
                 check_start_time = None
                 if self.in_developer_mode:
                     check_start_time = timeit.default_timer()
+                self._instance_index = i
                 self.check(copy.deepcopy(instance))
 
                 instance_check_stats = None
@@ -765,6 +920,7 @@ class AgentCheck(object):
                     error=str(e), tb=traceback.format_exc()
                 )
             finally:
+                self._instance_index = None
                 self._roll_up_instance_metadata()
 
             instance_statuses.append(instance_status)
@@ -776,6 +932,8 @@ class AgentCheck(object):
                 log.info("\n \t %s %s" % (self.name, pretty_statistics(self._internal_profiling_stats)))
             except Exception:  # It's fine if we can't collect stats for the run, just log and proceed
                 self.log.debug("Failed to collect Agent Stats after check {0}".format(self.name))
+            if self._http is not None:
+                log.info("\n \t %s HTTP requests per host: %s" % (self.name, self._http.get_stats()))
 
         return instance_statuses
 
@@ -792,7 +950,8 @@ class AgentCheck(object):
         """
         To be executed when the agent is being stopped to clean ressources
         """
-        pass
+        if self._http is not None:
+            self._http.close()
 
     @classmethod
     def from_yaml(cls, path_to_yaml=None, agentConfig=None, yaml_text=None, check_name=None):
@@ -826,41 +985,22 @@ class AgentCheck(object):
         :param prefix A prefix to to add to the normalized name, default None
         :param fix_case A boolean, indicating whether to make sure that
                         the metric name returned is in underscore_case
-        """
-        if fix_case:
-            name = self.convert_to_underscore_separated(metric)
-            if prefix is not None:
-                prefix = self.convert_to_underscore_separated(prefix)
-        else:
-            name = re.sub(r"[,\+\*\-/()\[\]{}]", "_", metric)
-        # Eliminate multiple _
-        name = re.sub(r"__+", "_", name)
-        # Don't start/end with _
-        name = re.sub(r"^_", "", name)
-        name = re.sub(r"_$", "", name)
-        # Drop ._ and _.
-        name = re.sub(r"\._", ".", name)
-        name = re.sub(r"_\.", ".", name)
 
-        if prefix is not None:
-            return prefix + "." + name
-        else:
-            return name
+        Names are cached for all the checks, see `normalization_cache`.
+        """
+        return normalize(metric, prefix, fix_case)
 
-    FIRST_CAP_RE = re.compile('(.)([A-Z][a-z]+)')
-    ALL_CAP_RE = re.compile('([a-z0-9])([A-Z])')
-    METRIC_REPLACEMENT = re.compile(r'([^a-zA-Z0-9_.]+)|(^[^a-zA-Z]+)')
-    DOT_UNDERSCORE_CLEANUP = re.compile(r'_*\._*')
+    FIRST_CAP_RE = FIRST_CAP_RE
+    ALL_CAP_RE = ALL_CAP_RE
+    METRIC_REPLACEMENT = METRIC_REPLACEMENT
+    DOT_UNDERSCORE_CLEANUP = DOT_UNDERSCORE_CLEANUP
 
     def convert_to_underscore_separated(self, name):
         """
         Convert from CamelCase to camel_case
         And substitute illegal metric characters
         """
-        metric_name = self.FIRST_CAP_RE.sub(r'\1_\2', name)
-        metric_name = self.ALL_CAP_RE.sub(r'\1_\2', metric_name).lower()
-        metric_name = self.METRIC_REPLACEMENT.sub('_', metric_name)
-        return self.DOT_UNDERSCORE_CLEANUP.sub('.', metric_name).strip('_')
+        return convert_to_underscore_separated(name)
 
     @staticmethod
     def read_config(instance, key, message=None, cast=None):
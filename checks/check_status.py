@@ -4,17 +4,18 @@ of checks.
 """
 # stdlib
 from collections import defaultdict
-import cPickle as pickle
 import datetime
 import logging
 import os
 import platform
 import sys
 import tempfile
+import threading
 import time
 
 # 3p
 import ntplib
+import simplejson as json
 import yaml
 
 # project
@@ -34,6 +35,12 @@ STATUS_WARNING = 'WARNING'
 
 NTP_OFFSET_THRESHOLD = 60
 
+# Statuses persisted more often than this are held back, only the latest
+# one is written once the interval is elapsed
+MIN_PERSIST_INTERVAL = 5  # seconds
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
 
 log = logging.getLogger(__name__)
 
@@ -120,6 +127,14 @@ class AgentStatus(object):
 
     NAME = None
 
+    # Time of the last write of each status class by this process
+    _last_persisted = {}
+    # Latest status of each class held back by the rate limit, and the
+    # timer writing it once MIN_PERSIST_INTERVAL is elapsed
+    _pending = {}
+    _pending_timers = {}
+    _persist_lock = threading.RLock()
+
     def __init__(self):
         self.created_at = datetime.datetime.now()
         self.created_by_pid = os.getpid()
@@ -127,17 +142,70 @@ class AgentStatus(object):
     def has_error(self):
         raise NotImplementedError
 
-    def persist(self):
+    def persist(self, force=False):
+        """
+        Write the status to disk. If a status of the same class was written
+        less than MIN_PERSIST_INTERVAL seconds ago and `force` is False, it's
+        held back instead, and the latest status held back is written once
+        the interval is elapsed. Return whether it was written now.
+
+        The status is written to a temporary file renamed over the
+        previous one, so that readers never see a partial status.
+        """
+        cls = self.__class__
+        with AgentStatus._persist_lock:
+            now = time.time()
+            last_persisted = AgentStatus._last_persisted.get(cls)
+            if not force and last_persisted is not None \
+                    and 0 <= now - last_persisted < MIN_PERSIST_INTERVAL:
+                AgentStatus._pending[cls] = self
+                if cls not in AgentStatus._pending_timers:
+                    cls._schedule_pending(MIN_PERSIST_INTERVAL - (now - last_persisted))
+                return False
+
+            # Supersedes the status held back, if any
+            AgentStatus._pending.pop(cls, None)
+            return self._write(now)
+
+    @classmethod
+    def _schedule_pending(cls, delay):
+        timer = threading.Timer(delay, cls._persist_pending)
+        timer.daemon = True
+        AgentStatus._pending_timers[cls] = timer
+        timer.start()
+
+    @classmethod
+    def _persist_pending(cls):
+        with AgentStatus._persist_lock:
+            AgentStatus._pending_timers.pop(cls, None)
+            status = AgentStatus._pending.get(cls)
+            if status is None:
+                return
+            now = time.time()
+            elapsed = now - AgentStatus._last_persisted.get(cls, 0)
+            if 0 <= elapsed < MIN_PERSIST_INTERVAL:
+                # Another status was written in the meantime
+                cls._schedule_pending(MIN_PERSIST_INTERVAL - elapsed)
+                return
+            del AgentStatus._pending[cls]
+            status._write(now)
+
+    def _write(self, now):
         try:
-            path = self._get_pickle_path()
+            path = self._get_status_path()
             log.debug("Persisting status to %s" % path)
-            f = open(path, 'w')
-            try:
-                pickle.dump(self, f)
-            finally:
-                f.close()
+            tmp_path = "%s.%s.tmp" % (path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write(_dump_status(self))
+            if Platform.is_win32() and os.path.exists(path):
+                # rename doesn't replace files on Windows
+                os.remove(path)
+            os.rename(tmp_path, path)
+            AgentStatus._last_persisted[self.__class__] = now
+            return True
         except Exception:
             log.exception("Error persisting status")
+            return False
 
     def created_seconds_ago(self):
         td = datetime.datetime.now() - self.created_at
@@ -215,21 +283,27 @@ class AgentStatus(object):
     @classmethod
     def remove_latest_status(cls):
         log.debug("Removing latest status")
+        with AgentStatus._persist_lock:
+            AgentStatus._last_persisted.pop(cls, None)
+            AgentStatus._pending.pop(cls, None)
+            timer = AgentStatus._pending_timers.pop(cls, None)
+            if timer is not None:
+                timer.cancel()
         try:
-            os.remove(cls._get_pickle_path())
+            os.remove(cls._get_status_path())
         except OSError:
             pass
 
     @classmethod
     def load_latest_status(cls):
         try:
-            f = open(cls._get_pickle_path())
-            try:
-                return pickle.load(f)
-            finally:
-                f.close()
+            with open(cls._get_status_path()) as f:
+                return _load_status(f.read())
         except IOError:
             return None
+        except Exception:
+            log.exception("Unable to load the status of %s" % cls.NAME)
+            return None
 
     @classmethod
     def print_latest_status(cls, verbose=False):
@@ -257,14 +331,14 @@ class AgentStatus(object):
         return exit_code
 
     @classmethod
-    def _get_pickle_path(cls):
+    def _get_status_path(cls):
         if Platform.is_win32():
             path = os.path.join(_windows_commondata_path(), 'Datadog')
         elif os.path.isdir(PidFile.get_dir()):
             path = PidFile.get_dir()
         else:
             path = tempfile.gettempdir()
-        return os.path.join(path, cls.__name__ + '.pickle')
+        return os.path.join(path, cls.__name__ + '.json')
 
 
 class InstanceStatus(object):
@@ -344,11 +418,13 @@ class CollectorStatus(AgentStatus):
 
     NAME = 'Collector'
 
-    def __init__(self, check_statuses=None, emitter_statuses=None, metadata=None):
+    def __init__(self, check_statuses=None, emitter_statuses=None, metadata=None,
+                 checksd_load_stats=None):
         AgentStatus.__init__(self)
         self.check_statuses = check_statuses or []
         self.emitter_statuses = emitter_statuses or []
         self.host_metadata = metadata or []
+        self.checksd_load_stats = checksd_load_stats
 
     @property
     def status(self):
@@ -476,6 +552,10 @@ class CollectorStatus(AgentStatus):
 
         lines.append('  conf.d: ' + confd_path)
         lines.append('  checks.d: ' + checksd_path)
+        if self.checksd_load_stats:
+            lines.append('  checks.d loaded in %(duration)ss: %(initialized)s checks initialized '
+                         '(%(reused)s reused from the previous load), %(failed)s failed'
+                         % self.checksd_load_stats)
         lines.append('')
 
         # Hostnames
@@ -695,6 +775,7 @@ class CollectorStatus(AgentStatus):
             status_info['checksd_path'] = config.get_checksd_path(osname)
         except config.PathNotFound:
             status_info['checksd_path'] = 'Not found'
+        status_info['checksd_load_stats'] = self.checksd_load_stats
 
         # Clocks
         try:
@@ -764,7 +845,7 @@ class ForwarderStatus(AgentStatus):
         self.flush_count = flush_count
         self.transactions_received = transactions_received
         self.transactions_flushed = transactions_flushed
-        self.proxy_data = get_config(parse_args=False).get('proxy_settings')
+        self.proxy_data = self._get_proxy_data()
         self.hidden_username = None
         self.hidden_password = None
         if self.proxy_data and self.proxy_data.get('user'):
@@ -773,6 +854,13 @@ class ForwarderStatus(AgentStatus):
             self.hidden_username = '*' * 5 + username[hidden:]
             self.hidden_password = '*' * 10
 
+    @classmethod
+    def _get_proxy_data(cls):
+        # A status is built on every flush, don't parse datadog.conf each time
+        if '_proxy_data' not in cls.__dict__:
+            cls._proxy_data = get_config(parse_args=False).get('proxy_settings')
+        return cls._proxy_data
+
     def body_lines(self):
         lines = [
             "Queue Size: %s bytes" % self.queue_size,
@@ -816,6 +904,45 @@ class ForwarderStatus(AgentStatus):
         return status_info
 
 
+# Classes a persisted status can be made of
+STATUS_CLASSES = dict((klass.__name__, klass) for klass in [
+    CollectorStatus,
+    DogstatsdStatus,
+    ForwarderStatus,
+    CheckStatus,
+    InstanceStatus,
+    EmitterStatus,
+])
+
+
+def _encode_status_object(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'__datetime__': obj.strftime(DATETIME_FORMAT)}
+    if type(obj).__name__ in STATUS_CLASSES:
+        return {'__status__': type(obj).__name__, 'attributes': obj.__dict__}
+    # Anything else (e.g. a library version object) is only displayed
+    return repr(obj)
+
+
+def _decode_status_object(d):
+    if '__datetime__' in d:
+        return datetime.datetime.strptime(d['__datetime__'], DATETIME_FORMAT)
+    if '__status__' in d:
+        klass = STATUS_CLASSES[d['__status__']]
+        obj = klass.__new__(klass)
+        obj.__dict__.update(d['attributes'])
+        return obj
+    return d
+
+
+def _dump_status(status):
+    return json.dumps(status, default=_encode_status_object, separators=(',', ':'))
+
+
+def _load_status(data):
+    return json.loads(data, object_hook=_decode_status_object)
+
+
 def get_jmx_instance_status(instance_name, status, message, metric_count):
     if status == STATUS_ERROR:
         instance_status = InstanceStatus(instance_name, STATUS_ERROR, error=message, metric_count=metric_count)
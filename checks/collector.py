@@ -4,6 +4,7 @@ import logging
 import pprint
 import socket
 import sys
+import threading
 import time
 
 # project
@@ -26,7 +27,7 @@ from util import (
     EC2,
     GCE,
     get_os,
-    get_uuid,
+    HostIdentity,
     Timer,
 )
 from utils.debug import log_exceptions
@@ -42,6 +43,67 @@ FLUSH_LOGGING_INITIAL = 5
 DD_CHECK_TAG = 'dd_check:{0}'
 
 
+class MetadataRefresher(threading.Thread):
+    """
+    Collect the host metadata in the background every `interval` seconds,
+    so that slow providers (gohai, cloud metadata endpoints, EC2 tags...)
+    never delay a collection run.
+
+    `providers` is a list of (name, function) pairs. Each refresh produces
+    a new snapshot:
+        {
+            'version': incremented on each refresh,
+            'timestamp': end of the refresh,
+            'data': {name: value returned by the provider},
+            'timings': {name: seconds spent in the provider},
+        }
+    """
+    def __init__(self, providers, interval):
+        threading.Thread.__init__(self, name='MetadataRefresher')
+        self.daemon = True
+        self._providers = providers
+        self._interval = interval
+        self._stop_event = threading.Event()
+        self._snapshot = None
+
+    def run(self):
+        # The first snapshot is collected synchronously, before starting
+        if self._snapshot is None:
+            self.refresh()
+        while not self._stop_event.wait(self._interval):
+            self.refresh()
+
+    def refresh(self):
+        data = {}
+        timings = {}
+        for name, provider in self._providers:
+            start = time.time()
+            try:
+                data[name] = provider()
+            except Exception:
+                log.exception("Unable to collect %s host metadata" % name)
+            timings[name] = time.time() - start
+
+        version = self._snapshot['version'] + 1 if self._snapshot else 1
+        self._snapshot = {
+            'version': version,
+            'timestamp': time.time(),
+            'data': data,
+            'timings': timings,
+        }
+        log.debug("Host metadata #%s collected in %s" % (version, ', '.join(
+            "%s: %.2fs" % (name, duration) for name, duration in sorted(timings.iteritems()))))
+
+    def snapshot(self):
+        """
+        Return the latest snapshot, None until the first one is collected.
+        """
+        return self._snapshot
+
+    def stop(self):
+        self._stop_event.set()
+
+
 class AgentPayload(collections.MutableMapping):
     """
     AgentPayload offers a single payload interface but manages two payloads:
@@ -182,8 +244,11 @@ class Collector(object):
         self.run_count = 0
         self.continue_running = True
         self.hostname_metadata_cache = None
+        self._metadata_refresher = None
+        self._metadata_version = None
         self.initialized_checks_d = []
         self.init_failed_checks_d = {}
+        self.checksd_load_stats = None
 
         # Unix System Checks
         self._unix_system_checks = {
@@ -243,6 +308,27 @@ class Collector(object):
         self.continue_running = False
         for check in self.initialized_checks_d:
             check.stop()
+        if self._metadata_refresher is not None:
+            self._metadata_refresher.stop()
+        self._dogstream.stop()
+
+    def _stop_replaced_checks(self, checks):
+        """
+        Stop the checks which aren't part of the reloaded `checks` anymore,
+        the ones which didn't change are kept by `load_check_directory`.
+        """
+        kept = set(id(check) for check in checks)
+        previous_checks = list(self.initialized_checks_d)
+        if self._agent_metrics is not None:
+            previous_checks.append(self._agent_metrics)
+
+        for check in previous_checks:
+            if id(check) in kept:
+                continue
+            try:
+                check.stop()
+            except Exception:
+                log.exception("Error while stopping check %s", check.name)
 
     @staticmethod
     def _stats_for_display(raw_stats):
@@ -261,8 +347,11 @@ class Collector(object):
         log.debug("Starting collection run #%s" % self.run_count)
 
         if checksd:
+            if configs_reloaded:
+                self._stop_replaced_checks(checksd['initialized_checks'])
             self.initialized_checks_d = checksd['initialized_checks']  # is a list of AgentCheck instances
             self.init_failed_checks_d = checksd['init_failed_checks']  # is of type {check_name: {error, traceback}}
+            self.checksd_load_stats = checksd.get('load_stats')
 
         payload = AgentPayload()
 
@@ -460,6 +549,7 @@ class Collector(object):
                 metric = 'datadog.agent.check_run_time'
                 meta = {'tags': ["check:%s" % check.name]}
                 metrics.append((metric, time.time(), check_run_time, meta))
+                metrics.append(('datadog.agent.check_contexts', time.time(), check.get_context_count(), meta))
 
         for check_name, info in self.init_failed_checks_d.iteritems():
             if not self.continue_running:
@@ -508,7 +598,8 @@ class Collector(object):
         # Persist the status of the collection run.
         try:
             CollectorStatus(check_statuses, emitter_statuses,
-                            self.hostname_metadata_cache).persist()
+                            self.hostname_metadata_cache,
+                            self.checksd_load_stats).persist()
         except Exception:
             log.exception("Error persisting collector status")
 
@@ -605,7 +696,7 @@ class Collector(object):
         payload['service_checks'] = []
         payload['resources'] = {}
         payload['internalHostname'] = self.hostname
-        payload['uuid'] = get_uuid()
+        payload['uuid'] = HostIdentity.get_uuid()
         payload['host-tags'] = {}
         payload['external_host_tags'] = {}
 
@@ -627,50 +718,11 @@ class Collector(object):
                 'msg_text': 'Version %s' % get_version()
             }]
 
-        # Periodically send the host metadata.
-        if self._should_send_additional_data('host_metadata'):
-            # gather metadata with gohai
-            try:
-                if not Platform.is_windows():
-                    command = "gohai"
-                else:
-                    command = "gohai\gohai.exe"
-                gohai_metadata, gohai_err, _ = get_subprocess_output([command], log)
-                payload['gohai'] = gohai_metadata
-                if gohai_err:
-                    log.warning("GOHAI LOG | {0}".format(gohai_err))
-            except OSError as e:
-                if e.errno == 2:  # file not found, expected when install from source
-                    log.info("gohai file not found")
-                else:
-                    raise e
-            except Exception as e:
-                log.warning("gohai command failed with error %s" % str(e))
-
-            payload['systemStats'] = get_system_stats()
-            payload['meta'] = self._get_hostname_metadata()
-
-            self.hostname_metadata_cache = payload['meta']
-            # Add static tags from the configuration file
-            host_tags = []
-            if self.agentConfig['tags'] is not None:
-                host_tags.extend([unicode(tag.strip())
-                                 for tag in self.agentConfig['tags'].split(",")])
-
-            if self.agentConfig['collect_ec2_tags']:
-                host_tags.extend(EC2.get_tags(self.agentConfig))
-
-            if host_tags:
-                payload['host-tags']['system'] = host_tags
-
-            GCE_tags = GCE.get_tags(self.agentConfig)
-            if GCE_tags is not None:
-                payload['host-tags'][GCE.SOURCE_TYPE_NAME] = GCE_tags
-
-            # Log the metadata on the first run
-            if self._is_first_run():
-                log.info("Hostnames: %s, tags: %s" %
-                         (repr(self.hostname_metadata_cache), payload['host-tags']))
+        # Attach the host metadata each time the refresher collected a new snapshot
+        snapshot = self._get_metadata_refresher().snapshot()
+        if snapshot is not None and snapshot['version'] != self._metadata_version:
+            self._metadata_version = snapshot['version']
+            self._attach_host_metadata(payload, snapshot)
 
         # Periodically send extra hosts metadata (vsphere)
         # Metadata of hosts that are not the host where the agent runs, not all the checks use
@@ -715,7 +767,8 @@ class Collector(object):
                         )
                     )
             payload['agent_checks'] = agent_checks
-            payload['meta'] = self.hostname_metadata_cache  # add hostname metadata
+            if self.hostname_metadata_cache is not None:
+                payload['meta'] = self.hostname_metadata_cache  # add hostname metadata
 
         # If required by the user, let's create the dd_check:xxx host tags
         if self.agentConfig['create_dd_check_tags'] and \
@@ -729,6 +782,86 @@ class Collector(object):
 
             payload['host-tags']['system'].extend(app_tags_list)
 
+    def _get_metadata_refresher(self):
+        """
+        Collect the host metadata on the first run, so that it's part of the
+        first payload, then keep refreshing it in the background.
+        """
+        if self._metadata_refresher is None:
+            providers = [
+                ('gohai', self._get_gohai_metadata),
+                ('systemStats', get_system_stats),
+                ('meta', self._get_hostname_metadata),
+                ('host-tags', self._get_host_tags),
+            ]
+            self._metadata_refresher = MetadataRefresher(
+                providers, self.push_times['host_metadata']['interval'])
+            self._metadata_refresher.refresh()
+            self._metadata_refresher.start()
+        return self._metadata_refresher
+
+    def _attach_host_metadata(self, payload, snapshot):
+        data = snapshot['data']
+        for key in ('gohai', 'systemStats', 'meta'):
+            if data.get(key) is not None:
+                payload[key] = data[key]
+
+        # The lists may be extended with the dd_check tags, don't alter the snapshot
+        for source, tags in data.get('host-tags', {}).iteritems():
+            payload['host-tags'][source] = list(tags)
+
+        if data.get('meta') is not None:
+            self.hostname_metadata_cache = data['meta']
+
+        if self.check_timings:
+            for provider, duration in snapshot['timings'].iteritems():
+                payload['metrics'].append(('datadog.agent.metadata_collection_time', snapshot['timestamp'],
+                                           duration, {'tags': ["provider:%s" % provider]}))
+
+        # Log the metadata the first time it's sent
+        if snapshot['version'] == 1:
+            log.info("Hostnames: %s, tags: %s" %
+                     (repr(self.hostname_metadata_cache), payload['host-tags']))
+
+    def _get_gohai_metadata(self):
+        if not Platform.is_windows():
+            command = "gohai"
+        else:
+            command = "gohai\gohai.exe"
+        try:
+            gohai_metadata, gohai_err, _ = get_subprocess_output([command], log)
+            if gohai_err:
+                log.warning("GOHAI LOG | {0}".format(gohai_err))
+            return gohai_metadata
+        except OSError as e:
+            if e.errno == 2:  # file not found, expected when install from source
+                log.info("gohai file not found")
+            else:
+                raise e
+        except Exception as e:
+            log.warning("gohai command failed with error %s" % str(e))
+
+    def _get_host_tags(self):
+        host_tags = {}
+
+        # Add static tags from the configuration file
+        system_tags = []
+        if self.agentConfig['tags'] is not None:
+            system_tags.extend([unicode(tag.strip())
+                               for tag in self.agentConfig['tags'].split(",")])
+
+        if self.agentConfig['collect_ec2_tags']:
+            system_tags.extend(EC2.get_tags(self.agentConfig))
+
+        if system_tags:
+            host_tags['system'] = system_tags
+
+        GCE_tags = GCE.get_tags(self.agentConfig)
+        if GCE_tags is not None:
+            host_tags[GCE.SOURCE_TYPE_NAME] = GCE_tags
+
+        return host_tags
+
     def _get_hostname_metadata(self):
         """
         Returns a dictionnary that contains hostname metadata.
@@ -1,18 +1,22 @@
 # stdlib
-from datetime import datetime
+import calendar
 import glob
-from itertools import groupby
 import os
 import re
 import sys
+import tempfile
 import time
 import traceback
 
 # project
 from checks import LaconicFilter
+from checks.libs.thread_pool import Pool
+from config import _windows_commondata_path
 import modules
-from util import windows_friendly_colon_split
+from util import json, Platform, windows_friendly_colon_split
+from utils.pidfile import PidFile
 from utils.tailfile import TailFile
+from utils.timeparse import TimestampParser
 
 if hasattr('some string', 'partition'):
     def partition(s, sep):
@@ -26,6 +30,21 @@ else:
             return s[0:pos], sep, s[pos + len(sep):]
 
 
+# Upper bounds of what a single dogstream parses in one collector run,
+# whatever is left is parsed on the next runs
+DEFAULT_MAX_LINES_PER_RUN = 200000
+DEFAULT_MAX_BYTES_PER_RUN = 64 * 1024 * 1024
+
+# Logs are tailed and parsed concurrently by this many threads, the
+# collector waits for them at most DEFAULT_TIMEOUT seconds per run
+DEFAULT_THREADS = 4
+DEFAULT_TIMEOUT = 10
+
+# Points must be stamped after 1990 (local time) and before year 10000
+MIN_TIMESTAMP = time.mktime((1991, 1, 1, 0, 0, 0, 0, 0, -1))
+MAX_TIMESTAMP = calendar.timegm((9999, 12, 31, 23, 59, 59, 0, 0, 0))
+
+
 def point_sorter(p):
     # Sort and group by timestamp, metric name, host_name, device_name
     return (p[1], p[0], p[3].get('host_name', None), p[3].get('device_name', None))
@@ -47,11 +66,77 @@ class Dogstreams(object):
 
         logger.info("Dogstream parsers: %s" % repr(dogstreams))
 
-        return cls(logger, dogstreams)
+        offsets_path = None
+        if config.get('dogstream_persist_offsets'):
+            offsets_path = cls._get_offsets_path()
+
+        return cls(logger, dogstreams, offsets_path=offsets_path,
+                   threads=int(config.get('dogstream_threads', DEFAULT_THREADS)),
+                   timeout=float(config.get('dogstream_timeout', DEFAULT_TIMEOUT)))
 
-    def __init__(self, logger, dogstreams):
+    def __init__(self, logger, dogstreams, offsets_path=None, threads=1, timeout=DEFAULT_TIMEOUT):
         self.logger = logger
         self.dogstreams = dogstreams
+        self.offsets_path = offsets_path
+        self._offsets = {}
+
+        self.threads = min(threads, len(dogstreams))
+        self.timeout = timeout
+        self.pool = None
+        # Dogstream -> result of a run that didn't complete before the timeout
+        self._pending = {}
+
+        if self.offsets_path:
+            self._offsets = self._load_offsets()
+            for dogstream in self.dogstreams:
+                dogstream.checkpoint = self._offsets.get(dogstream.log_path)
+
+    @classmethod
+    def _get_offsets_path(cls):
+        if Platform.is_win32():
+            path = os.path.join(_windows_commondata_path(), 'Datadog')
+        elif os.path.isdir(PidFile.get_dir()):
+            path = PidFile.get_dir()
+        else:
+            path = tempfile.gettempdir()
+        return os.path.join(path, 'dogstream_offsets.json')
+
+    def _load_offsets(self):
+        """
+        Offsets are saved as {log_path: [inode, offset]}
+        """
+        try:
+            with open(self.offsets_path) as f:
+                return dict((path, tuple(pos)) for path, pos in json.loads(f.read()).iteritems())
+        except IOError:
+            return {}
+        except Exception:
+            self.logger.warning("Ignoring invalid dogstream offsets file %s", self.offsets_path, exc_info=True)
+            return {}
+
+    def _save_offsets(self):
+        offsets = {}
+        for dogstream in self.dogstreams:
+            if dogstream in self._pending:
+                # Its points haven't been collected yet
+                position = self._offsets.get(dogstream.log_path)
+            else:
+                position = dogstream.position()
+            if position is not None:
+                offsets[dogstream.log_path] = position
+
+        if offsets == self._offsets:
+            return
+
+        # Write then rename, a crash must not leave a truncated file behind
+        tmp_path = self.offsets_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(json.dumps(offsets))
+            os.rename(tmp_path, self.offsets_path)
+            self._offsets = offsets
+        except Exception:
+            self.logger.warning("Unable to save dogstream offsets to %s", self.offsets_path, exc_info=True)
 
     @classmethod
     def _instantiate_dogstreams(cls, logger, config, dogstreams_config):
@@ -103,21 +188,78 @@ class Dogstreams(object):
         if not self.dogstreams:
             return {}
 
+        if self.threads > 1:
+            results = self._run_parallel(agentConfig, move_end)
+        else:
+            results = self._run_serial(agentConfig, move_end)
+
         output = {}
+        for dogstream, result in results:
+            # result may contain {"dogstream": [new]}.
+            # If output contains {"dogstream": [old]}, that old value will get concatenated with the new value
+            if type(result) != type(output):
+                self.logger.error("Error in parsing %s: dogstream.check must return a dictionary" % dogstream.log_path)
+                continue
+            for k in result:
+                if k in output:
+                    output[k].extend(result[k])
+                else:
+                    output[k] = result[k]
+
+        if self.offsets_path:
+            self._save_offsets()
+
+        return output
+
+    def _run_serial(self, agentConfig, move_end):
+        results = []
         for dogstream in self.dogstreams:
             try:
-                result = dogstream.check(agentConfig, move_end)
-                # result may contain {"dogstream": [new]}.
-                # If output contains {"dogstream": [old]}, that old value will get concatenated with the new value
-                assert type(result) == type(output), "dogstream.check must return a dictionary"
-                for k in result:
-                    if k in output:
-                        output[k].extend(result[k])
-                    else:
-                        output[k] = result[k]
+                results.append((dogstream, dogstream.check(agentConfig, move_end)))
             except Exception:
                 self.logger.exception("Error in parsing %s" % (dogstream.log_path))
-        return output
+        return results
+
+    def _run_parallel(self, agentConfig, move_end):
+        """
+        Run every dogstream on the thread pool, each one tails and parses
+        its own log. A dogstream still running after `timeout` is left
+        alone: its result is collected on a later run and it isn't
+        scheduled again in the meantime.
+
+        Only the file reads overlap: parsing holds the GIL, so CPU-bound
+        parsers don't go faster with more threads.
+        """
+        if self.pool is None:
+            self.pool = Pool(self.threads)
+
+        for dogstream in self.dogstreams:
+            if dogstream not in self._pending:
+                self._pending[dogstream] = self.pool.apply_async(dogstream.check, args=(agentConfig, move_end))
+
+        deadline = time.time() + self.timeout
+        results = []
+        for dogstream in self.dogstreams:
+            result = self._pending[dogstream]
+            if not result.wait(max(deadline - time.time(), 0)):
+                self.logger.warning("Dogstream for %s is still running, will collect it on next run" % dogstream.log_path)
+                continue
+
+            del self._pending[dogstream]
+            try:
+                results.append((dogstream, result.get()))
+            except Exception:
+                self.logger.exception("Error in parsing %s" % (dogstream.log_path))
+
+        return results
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            self._pending = {}
+
 
 class Dogstream(object):
 
@@ -165,33 +307,77 @@ class Dogstream(object):
         self.parse_func = parse_func or self._default_line_parser
         self.parse_args = parse_args
 
+        # (inode, offset) reached by the last run, set by Dogstreams from
+        # saved offsets before the first one
+        self.checkpoint = None
+
+        self._tail = None
         self._gen = None
-        self._values = None
+        self._buckets = None
         self._freq = 15 # Will get updated on each check()
+        self._max_lines = DEFAULT_MAX_LINES_PER_RUN
+        self._max_bytes = DEFAULT_MAX_BYTES_PER_RUN
+        self._run_lines = 0
+        self._run_bytes = 0
         self._error_count = 0L
         self._line_count = 0L
         self.parser_state = {}
+        self._timestamps = TimestampParser()
+
+    def _start_position(self, move_end):
+        """
+        Where to start tailing: from the saved offset if it still applies
+        to the file, from its beginning if it was rotated since.
+        """
+        if self.checkpoint is None:
+            return {'move_end': move_end}
+
+        inode, offset = self.checkpoint
+        try:
+            stat = os.stat(self.log_path)
+        except OSError:
+            return {'move_end': move_end}
+
+        if stat.st_ino == inode and stat.st_size >= offset:
+            self.logger.debug("Resuming %s from offset %s", self.log_path, offset)
+            return {'pos': offset}
+
+        self.logger.debug("%s was rotated since its offset was saved, reading it from the start", self.log_path)
+        return {'move_end': False}
+
+    def position(self):
+        return self.checkpoint
 
     def check(self, agentConfig, move_end=True):
         if self.log_path:
             self._freq = int(agentConfig.get('check_freq', 15))
-            self._values = []
+            self._max_lines = int(agentConfig.get('dogstream_max_lines_per_run', DEFAULT_MAX_LINES_PER_RUN))
+            self._max_bytes = int(agentConfig.get('dogstream_max_bytes_per_run', DEFAULT_MAX_BYTES_PER_RUN))
+            self._run_lines = 0
+            self._run_bytes = 0
+            self._buckets = {}
             self._events = []
 
             # Build our tail -f
             if self._gen is None:
-                self._gen = TailFile(self.logger, self.log_path, self._line_parser).tail(line_by_line=False, move_end=move_end)
+                self._tail = TailFile(self.logger, self.log_path, self._line_parser)
+                self._gen = self._tail.tail(line_by_line=True, **self._start_position(move_end))
 
-            # read until the end of file
+            # read until the end of file, or until this run's budget is spent
             try:
                 self._gen.next()
+                if self._budget_spent():
+                    self.logger.info("Dogstream for {0} hit its budget of {1} lines/{2} bytes, "
+                                     "resuming on next run".format(self.log_path, self._max_lines, self._max_bytes))
+                self.checkpoint = self._tail.position()
                 self.logger.debug("Done dogstream check for file {0}".format(self.log_path))
-                self.logger.debug("Found {0} metric points".format(len(self._values)))
+                self.logger.debug("Found {0} metric buckets".format(len(self._buckets)))
             except StopIteration, e:
                 self.logger.exception(e)
                 self.logger.warn("Can't tail %s file" % self.log_path)
+                self._tail = self._gen = None
 
-            check_output = self._aggregate(self._values)
+            check_output = self._aggregate(self._buckets)
             if self._events:
                 check_output.update({"dogstreamEvents": self._events})
                 self.logger.debug("Found {0} events".format(len(self._events)))
@@ -199,7 +385,20 @@ class Dogstream(object):
         else:
             return {}
 
+    def _budget_spent(self):
+        return self._run_lines >= self._max_lines or self._run_bytes >= self._max_bytes
+
     def _line_parser(self, line):
+        """
+        Parse a line and add its points to the current buckets.
+        Return True when the budget of the run is spent to stop tailing.
+        """
+        self._run_lines += 1
+        self._run_bytes += len(line) + 1
+        self._parse_line(line)
+        return self._budget_spent()
+
+    def _parse_line(self, line):
         try:
             # alq - Allow parser state to be kept between invocations
             # This means a new argument can be passed the custom parsing function
@@ -258,9 +457,8 @@ class Dogstream(object):
                 invalid_reasons = []
                 try:
                     # Bucket points into 15 second buckets
-                    ts = (int(float(ts)) / self._freq) * self._freq
-                    date = datetime.fromtimestamp(ts)
-                    assert date.year > 1990
+                    ts = (self._timestamps.parse(ts) / self._freq) * self._freq
+                    assert MIN_TIMESTAMP <= ts <= MAX_TIMESTAMP
                 except Exception:
                     invalid_reasons.append('invalid timestamp')
 
@@ -273,7 +471,7 @@ class Dogstream(object):
                     self.logger.debug('Invalid parsed values %s (%s): "%s"',
                         repr(datum), ', '.join(invalid_reasons), line)
                 else:
-                    self._values.append((metric, ts, value, attrs))
+                    self._add_point(metric, ts, value, attrs)
         except Exception, e:
             self.logger.debug("Error while parsing line %s" % line, exc_info=True)
             self._error_count += 1
@@ -297,40 +495,40 @@ class Dogstream(object):
 
         return metric, timestamp, value, attributes
 
-    def _aggregate(self, values):
+    def _add_point(self, metric, ts, value, attrs):
+        """
+        Aggregate a point into its (timestamp, metric, host_name, device_name)
+        bucket, which keeps the last value, the sum of the values and the
+        merged attributes of its points.
+        """
+        key = point_sorter((metric, ts, value, attrs))
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._buckets[key] = [value, value, dict(attrs)]
+        else:
+            bucket[0] = value
+            bucket[1] += value
+            bucket[2].update(attrs)
+
+    def _aggregate(self, buckets):
         """ Aggregate values down to the second and store as:
             {
                 "dogstream": [(metric, timestamp, value, {key: val})]
             }
-            If there are many values per second for a metric, take the median
+            If there are many values per second for a metric, take the last
+            one, or their sum for counters
         """
         output = []
 
-        values.sort(key=point_sorter)
-
-        for (timestamp, metric, host_name, device_name), val_attrs in groupby(values, key=point_sorter):
-            attributes = {}
-            vals = []
-            for _metric, _timestamp, v, a in val_attrs:
-                try:
-                    v = float(v)
-                    vals.append(v)
-                    attributes.update(a)
-                except Exception:
-                    self.logger.debug("Could not convert %s into a float", v)
-
-            if len(vals) == 1:
-                val = vals[0]
-            elif len(vals) > 1:
-                val = vals[-1]
-            else: # len(vals) == 0
-                continue
+        for key in sorted(buckets):
+            timestamp, metric, _, _ = key
+            last, total, attributes = buckets[key]
 
             metric_type = str(attributes.get('metric_type', '')).lower()
-            if metric_type == 'gauge':
-                val = float(val)
-            elif metric_type == 'counter':
-                val = sum(vals)
+            if metric_type == 'counter':
+                val = total
+            else:
+                val = last
 
             output.append((metric, timestamp, val, attributes))
 
@@ -0,0 +1,237 @@
+"""
+Event-driven engine running network probes (TCP connections, HTTP requests,
+SSL handshakes) from a single thread, see `ProbeEngine`.
+"""
+# stdlib
+import functools
+import logging
+from Queue import Queue
+import socket
+import ssl
+import threading
+import time
+
+# 3p
+from tornado import stack_context
+from tornado.concurrent import TracebackFuture
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, SSLIOStream
+from tornado.netutil import Resolver
+
+log = logging.getLogger(__name__)
+
+# Probes taking longer than this are reported as failed, whatever they do
+DEFAULT_PROBE_TIMEOUT = 60
+# Number of HTTP requests in flight at the same time
+DEFAULT_MAX_CONCURRENT_REQUESTS = 500
+# Number of threads calling getaddrinfo
+DEFAULT_RESOLVER_THREADS = 4
+
+
+class ProbeTimeout(Exception):
+    pass
+
+
+class ProbeResolver(Resolver):
+    """
+    Non-blocking resolver: `getaddrinfo` is called by a few worker threads,
+    the results are handed back to the IOLoop.
+
+    Tornado's ThreadedResolver would need the `futures` backport.
+    """
+
+    def initialize(self, io_loop, num_threads=DEFAULT_RESOLVER_THREADS):
+        self.io_loop = io_loop
+        self._queue = Queue()
+        self._threads = []
+        for i in range(num_threads):
+            thread = threading.Thread(target=self._work, name="ProbeResolver-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self, timeout=5):
+        """
+        Stop the worker threads, waiting at most `timeout` seconds for each
+        of them: a thread stuck in `getaddrinfo` is left behind.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            host, port, family, future = job
+            try:
+                addrinfo = socket.getaddrinfo(host, port, family, socket.SOCK_STREAM)
+                result = [(af, address) for af, _, _, _, address in addrinfo]
+                self.io_loop.add_callback(future.set_result, result)
+            except Exception as e:
+                self.io_loop.add_callback(future.set_exception, e)
+
+    def resolve(self, host, port, family=socket.AF_UNSPEC, callback=None):
+        future = TracebackFuture()
+        if callback is not None:
+            self.io_loop.add_future(future, lambda future: callback(future.result()))
+        self._queue.put((host, port, family, future))
+        return future
+
+
+class ProbeEngine(object):
+    """
+    Runs probes in a single thread, driving their sockets with a private
+    tornado IOLoop (epoll/kqueue/select), instead of blocking one thread
+    per probe.
+
+    A probe is a function `probe(done)` started in the IOLoop thread: it
+    starts non-blocking operations with the helpers of the engine
+    (`connect`, `fetch`, `get_peer_cert`) and calls `done(result)` once
+    it's over. `submit` passes `(None, result)` to its callback, or
+    `(exception, None)` when the probe raised or went over its timeout.
+
+    Callbacks run in the IOLoop thread, they should only hand the results
+    over to another thread.
+    """
+
+    def __init__(self, max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS,
+                 resolver_threads=DEFAULT_RESOLVER_THREADS):
+        self.io_loop = IOLoop()
+        self.resolver = ProbeResolver(io_loop=self.io_loop, num_threads=resolver_threads)
+        self.http_client = AsyncHTTPClient(self.io_loop, force_instance=True,
+                                           max_clients=max_concurrent_requests,
+                                           resolver=self.resolver)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.io_loop.start, name="ProbeEngine")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self.io_loop.add_callback(self.io_loop.stop)
+        self._thread.join(5)
+        self._thread = None
+        self.http_client.close()
+        self.resolver.close()
+        self.io_loop.close(all_fds=True)
+
+    def submit(self, probe, callback, timeout=DEFAULT_PROBE_TIMEOUT):
+        """
+        Start `probe` in the IOLoop, thread-safe.
+        """
+        self.io_loop.add_callback(self._start_probe, probe, callback, timeout)
+
+    def _start_probe(self, probe, callback, timeout):
+        state = {'finished': False, 'timeout': None}
+
+        def finish(error, result):
+            if state['finished']:
+                return
+            state['finished'] = True
+            if state['timeout'] is not None:
+                self.io_loop.remove_timeout(state['timeout'])
+            try:
+                callback(error, result)
+            except Exception:
+                log.exception("Probe callback failed")
+
+        def on_exception(typ, value, tb):
+            log.debug("Probe failed", exc_info=(typ, value, tb))
+            finish(value, None)
+            return True
+
+        def on_timeout():
+            finish(ProbeTimeout("Probe didn't complete in %ss" % timeout), None)
+
+        state['timeout'] = self.io_loop.add_timeout(time.time() + timeout, on_timeout)
+        # Exceptions raised by the probe or its callbacks end the probe
+        with stack_context.ExceptionStackContext(on_exception):
+            probe(lambda result: finish(None, result))
+
+    def connect(self, address, family, timeout, callback, ssl_options=None):
+        """
+        Open a TCP connection (and do the SSL handshake with `ssl_options`),
+        then call `callback(error, stream, elapsed)`, `error` is None when
+        connected.
+
+        The stream is closed after the callback.
+        """
+        start = time.time()
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        if ssl_options is None:
+            stream = IOStream(sock, io_loop=self.io_loop)
+        else:
+            stream = SSLIOStream(sock, io_loop=self.io_loop, ssl_options=ssl_options)
+        state = {'finished': False}
+
+        def finish(error):
+            if state['finished']:
+                return
+            state['finished'] = True
+            self.io_loop.remove_timeout(deadline)
+            stream.set_close_callback(None)
+            try:
+                callback(error, stream, time.time() - start)
+            finally:
+                stream.close()
+
+        def on_close():
+            finish(stream.error or socket.error("Connection closed"))
+
+        deadline = self.io_loop.add_timeout(start + timeout,
+                                            lambda: finish(socket.timeout("timed out")))
+        stream.set_close_callback(on_close)
+        stream.connect(address, functools.partial(finish, None))
+
+    def resolve_and_connect(self, host, port, family, timeout, callback, ssl_options=None):
+        """
+        Same as `connect` with a hostname, resolved without blocking.
+        """
+        start = time.time()
+
+        def on_resolved(future):
+            try:
+                addrinfo = future.result()
+            except Exception as e:
+                callback(e, None, time.time() - start)
+                return
+            af, address = addrinfo[0]
+            remaining = max(timeout - (time.time() - start), 0)
+
+            def on_connected(error, stream, elapsed):
+                callback(error, stream, time.time() - start)
+
+            self.connect(address, af, remaining, on_connected, ssl_options=ssl_options)
+
+        self.io_loop.add_future(self.resolver.resolve(host, port, family), on_resolved)
+
+    def fetch(self, request, callback):
+        """
+        Send a `tornado.httpclient.HTTPRequest`, `callback` gets the response,
+        whose `error` is set on failures.
+        """
+        self.http_client.fetch(request, callback)
+
+    def get_peer_cert(self, host, port, timeout, ca_certs, callback):
+        """
+        Do an SSL handshake with `host` verifying its certificate with
+        `ca_certs`, then call `callback(error, cert)`.
+        """
+        ssl_options = {'cert_reqs': ssl.CERT_REQUIRED, 'ca_certs': ca_certs}
+
+        def on_connected(error, stream, elapsed):
+            if error is not None:
+                callback(error, None)
+            else:
+                callback(None, stream.socket.getpeercert())
+
+        self.resolve_and_connect(host, port, socket.AF_INET, timeout, on_connected,
+                                 ssl_options=ssl_options)
@@ -6,6 +6,7 @@ import time
 
 # project
 from checks import AgentCheck
+from checks.libs.probes import DEFAULT_MAX_CONCURRENT_REQUESTS, ProbeEngine
 from checks.libs.thread_pool import Pool
 from config import _is_affirmative
 
@@ -53,8 +54,17 @@ class NetworkCheck(AgentCheck):
             The second element is a short error message that will be displayed
             when the service turns down.
 
+        Checks implementing _probe(instance, engine, done), a non-blocking
+        version of _check calling done() with what _check would return, are
+        run by a single ProbeEngine thread instead: see checks.libs.probes.
+        _can_probe(instance) can send some instances to the thread pool anyway.
+        Both put their results in the same queue.
+
     """
 
+    # Non-blocking version of _check, see above
+    _probe = None
+
     def __init__(self, name, init_config, agentConfig, instances):
         AgentCheck.__init__(self, name, init_config, agentConfig, instances)
 
@@ -63,6 +73,8 @@ class NetworkCheck(AgentCheck):
         self.notified = {}
         self.nb_failures = 0
         self.pool_started = False
+        self.pool = None
+        self.probe_engine = None
 
         # Make sure every instance has a name that we use as a unique key
         # to keep track of statuses
@@ -79,27 +91,55 @@ class NetworkCheck(AgentCheck):
         self.stop_pool()
         self.pool_started = False
 
+    def use_probe_engine(self):
+        return self._probe is not None and \
+            _is_affirmative(self.init_config.get('probe_engine', True))
+
     def start_pool(self):
         # The pool size should be the minimum between the number of instances
         # and the DEFAULT_SIZE_POOL. It can also be overridden by the 'threads_count'
         # parameter in the init_config of the check
-        self.log.info("Starting Thread Pool")
         default_size = min(self.instance_count(), DEFAULT_SIZE_POOL)
         self.pool_size = int(self.init_config.get('threads_count', default_size))
 
-        self.pool = Pool(self.pool_size)
+        if self.use_probe_engine():
+            # The thread pool is only started for the instances that can't be probed
+            self.log.info("Starting Probe Engine")
+            self.probe_engine = ProbeEngine(
+                max_concurrent_requests=int(self.init_config.get(
+                    'max_concurrent_requests', DEFAULT_MAX_CONCURRENT_REQUESTS)))
+            self.probe_engine.start()
+        else:
+            self._start_thread_pool()
 
         self.resultsq = Queue()
         self.jobs_status = {}
         self.pool_started = True
 
+    def _start_thread_pool(self):
+        self.log.info("Starting Thread Pool")
+        self.pool = Pool(self.pool_size, name=self.name)
+
+    def _count_pool_threads(self):
+        """
+        Number of live worker threads of the pools of this check, including
+        the stuck ones left behind by `restart_pool`.
+        """
+        prefix = "Worker-%s-" % self.name
+        return len([t for t in threading.enumerate() if t.name.startswith(prefix)])
+
     def stop_pool(self):
         self.log.info("Stopping Thread Pool")
         if self.pool_started:
-            self.pool.terminate()
-            self.pool.join()
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+                assert self.pool.get_nworkers() == 0
+                self.pool = None
+            if self.probe_engine is not None:
+                self.probe_engine.stop()
+                self.probe_engine = None
             self.jobs_status.clear()
-            assert self.pool.get_nworkers() == 0
 
     def restart_pool(self):
         self.stop_pool()
@@ -108,8 +148,10 @@ class NetworkCheck(AgentCheck):
     def check(self, instance):
         if not self.pool_started:
             self.start_pool()
-        if threading.activeCount() > 5 * self.pool_size + 5: # On Windows the agent runs on multiple threads so we need to have an offset of 5 in case the pool_size is 1
-            raise Exception("Thread number (%s) is exploding. Skipping this check" % threading.activeCount())
+        if self.pool is not None:
+            pool_threads = self._count_pool_threads()
+            if pool_threads > 5 * self.pool_size:
+                raise Exception("Thread number (%s) is exploding. Skipping this check" % pool_threads)
         self._process_results()
         self._clean()
         name = instance.get('name', None)
@@ -120,28 +162,49 @@ class NetworkCheck(AgentCheck):
         if name not in self.jobs_status:
             # A given instance should be processed one at a time
             self.jobs_status[name] = time.time()
-            self.pool.apply_async(self._process, args=(instance,))
+            if self.probe_engine is not None and self._can_probe(instance):
+                self.probe_engine.submit(
+                    lambda done: self._probe(instance, self.probe_engine, done),
+                    lambda error, statuses: self._process_probe(instance, error, statuses)
+                )
+            else:
+                if self.pool is None:
+                    self._start_thread_pool()
+                self.pool.apply_async(self._process, args=(instance,))
         else:
             self.log.error("Instance: %s skipped because it's already running." % name)
 
+    def _can_probe(self, instance):
+        return True
+
     def _process(self, instance):
         try:
             statuses = self._check(instance)
-
-            if isinstance(statuses, tuple):
-                # Assume the check only returns one service check
-                status, msg = statuses
-                self.resultsq.put((status, msg, None, instance))
-
-            elif isinstance(statuses, list):
-                for status in statuses:
-                    sc_name, status, msg = status
-                    self.resultsq.put((status, msg, sc_name, instance))
+            self._put_statuses(instance, statuses)
 
         except Exception:
             result = (FAILURE, FAILURE, FAILURE, FAILURE)
             self.resultsq.put(result)
 
+    def _process_probe(self, instance, error, statuses):
+        if error is not None:
+            self.log.error("Probe of instance %s failed: %s", instance['name'], error)
+            # Nothing to restart here, only the instance is done
+            self.resultsq.put((FAILURE, FAILURE, FAILURE, instance))
+        else:
+            self._put_statuses(instance, statuses)
+
+    def _put_statuses(self, instance, statuses):
+        if isinstance(statuses, tuple):
+            # Assume the check only returns one service check
+            status, msg = statuses
+            self.resultsq.put((status, msg, None, instance))
+
+        elif isinstance(statuses, list):
+            for status in statuses:
+                sc_name, status, msg = status
+                self.resultsq.put((status, msg, sc_name, instance))
+
     def _process_results(self):
         for i in range(MAX_LOOP_ITERATIONS):
             try:
@@ -151,6 +214,10 @@ class NetworkCheck(AgentCheck):
                 break
 
             if status == FAILURE:
+                if instance != FAILURE:
+                    # A failed probe, the instance can be processed again
+                    self.jobs_status.pop(instance['name'], None)
+                    continue
                 self.nb_failures += 1
                 if self.nb_failures >= self.pool_size - 1:
                     self.nb_failures = 0
@@ -1,7 +1,9 @@
 # stdlib
 import ConfigParser
+from copy import deepcopy
 from cStringIO import StringIO
 import glob
+from hashlib import md5
 import imp
 import inspect
 import itertools
@@ -15,6 +17,7 @@ import re
 from socket import gaierror, gethostbyname
 import string
 import sys
+import time
 import traceback
 from urlparse import urlparse
 
@@ -497,6 +500,18 @@ def get_config(parse_args=True, cfg_path=None, options=None):
         elif config.has_option("Main", "dogstreams"):
             agentConfig["dogstreams"] = config.get("Main", "dogstreams")
 
+        for key in ("dogstream_max_lines_per_run", "dogstream_max_bytes_per_run", "dogstream_threads"):
+            if config.has_option("Main", key):
+                agentConfig[key] = int(config.get("Main", key))
+
+        if config.has_option("Main", "dogstream_timeout"):
+            agentConfig["dogstream_timeout"] = float(config.get("Main", "dogstream_timeout"))
+
+        if config.has_option("Main", "dogstream_persist_offsets"):
+            agentConfig["dogstream_persist_offsets"] = _is_affirmative(config.get("Main", "dogstream_persist_offsets"))
+        else:
+            agentConfig["dogstream_persist_offsets"] = True
+
         if config.has_option("Main", "nagios_perf_cfg"):
             agentConfig["nagios_perf_cfg"] = config.get("Main", "nagios_perf_cfg")
 
@@ -725,12 +740,46 @@ def check_yaml(conf_path):
         f.close()
 
 
+# What load_check_directory loaded for each check, so that a reload only
+# re-imports and re-initializes the checks whose files changed:
+# check name -> {'check_path', 'check_file', 'module', 'conf_path', 'conf_file',
+#                'config', 'check', 'agentConfig', 'hostname'}
+_checksd_cache = {}
+
+
+def _file_state(path, previous=None):
+    ''' Return the state of a file as {'mtime', 'size', 'md5', 'read_at'}.
+    The file is only read again if its mtime or size changed since the
+    `previous` state, or if it was modified in the same second as it was read. '''
+    st = os.stat(path)
+    if previous is not None and previous['mtime'] == st.st_mtime and previous['size'] == st.st_size \
+            and st.st_mtime < previous['read_at'] - 1:
+        return previous
+
+    read_at = time.time()
+    with open(path, 'rb') as f:
+        digest = md5(f.read()).hexdigest()
+    return {'mtime': st.st_mtime, 'size': st.st_size, 'md5': digest, 'read_at': read_at}
+
+
+def _same_file(state, other):
+    return state is not None and other is not None and state['md5'] == other['md5']
+
+
 def load_check_directory(agentConfig, hostname):
     ''' Return the initialized checks from checks.d, and a mapping of checks that failed to
     initialize. Only checks that have a configuration
-    file in conf.d will be returned. '''
+    file in conf.d will be returned.
+
+    The checks loaded by a previous call are reused when neither their
+    module nor their configuration changed, keeping their state (e.g. the
+    samples of their rates). `load_stats` gives the time it took and the
+    number of checks reused. '''
     from checks import AgentCheck, AGENT_METRICS_CHECK_NAME
 
+    start = time.time()
+    reused_checks = 0
+    cache = {}
     initialized_checks = {}
     init_failed_checks = {}
     deprecated_checks = {}
@@ -786,9 +835,19 @@ def load_check_directory(agentConfig, hostname):
             conf_path = default_conf_path
             conf_exists = True
 
+        entry = _checksd_cache.get(check_name)
+        if entry is not None and entry['check_path'] != check:
+            entry = None
+        conf_file = None
+
         if conf_exists:
             try:
-                check_config = check_yaml(conf_path)
+                previous_conf_file = entry['conf_file'] if entry is not None and entry['conf_path'] == conf_path else None
+                conf_file = _file_state(conf_path, previous_conf_file)
+                if _same_file(previous_conf_file, conf_file):
+                    check_config = entry['config']
+                else:
+                    check_config = check_yaml(conf_path)
             except Exception, e:
                 log.exception("Unable to parse yaml config in %s" % conf_path)
                 traceback_message = traceback.format_exc()
@@ -811,9 +870,19 @@ def load_check_directory(agentConfig, hostname):
                 continue
 
         # If we are here, there is a valid matching configuration file.
-        # Let's try to import the check
+        # Let's try to import the check, unless it didn't change
         try:
-            check_module = imp.load_source('checksd_%s' % check_name, check)
+            check_file = _file_state(check, entry['check_file'] if entry is not None else None)
+            if entry is not None and _same_file(entry['check_file'], check_file):
+                check_module = entry['module']
+            else:
+                if entry is not None:
+                    # The bytecode has a 1 second resolution, it may be stale
+                    try:
+                        os.remove(check + 'c')
+                    except OSError:
+                        pass
+                check_module = imp.load_source('checksd_%s' % check_name, check)
         except Exception, e:
             traceback_message = traceback.format_exc()
             # There is a configuration file for that check but the module can't be imported
@@ -851,37 +920,75 @@ def load_check_directory(agentConfig, hostname):
             init_config = {}
 
         instances = check_config['instances']
-        try:
-            try:
-                c = check_class(check_name, init_config=init_config,
-                                agentConfig=agentConfig, instances=instances)
-            except TypeError, e:
-                # Backwards compatibility for checks which don't support the
-                # instances argument in the constructor.
-                c = check_class(check_name, init_config=init_config,
-                                agentConfig=agentConfig)
-                c.instances = instances
-        except Exception, e:
-            log.exception('Unable to initialize check %s' % check_name)
-            traceback_message = traceback.format_exc()
-            init_failed_checks[check_name] = {'error':e, 'traceback':traceback_message}
+        c = None
+        if entry is not None and entry['check'] is not None \
+                and _same_file(entry['check_file'], check_file) and entry['config'] is check_config \
+                and entry['agentConfig'] is agentConfig and entry['hostname'] == hostname:
+            # Nothing changed, keep the check and its state
+            c = entry['check']
+            reused_checks += 1
         else:
+            # The check may modify its configuration, keep the cached one intact
+            init_config = deepcopy(init_config)
+            instances = deepcopy(instances)
+            try:
+                try:
+                    c = check_class(check_name, init_config=init_config,
+                                    agentConfig=agentConfig, instances=instances)
+                except TypeError, e:
+                    # Backwards compatibility for checks which don't support the
+                    # instances argument in the constructor.
+                    c = check_class(check_name, init_config=init_config,
+                                    agentConfig=agentConfig)
+                    c.instances = instances
+            except Exception, e:
+                log.exception('Unable to initialize check %s' % check_name)
+                traceback_message = traceback.format_exc()
+                init_failed_checks[check_name] = {'error':e, 'traceback':traceback_message}
+                c = None
+
+        if c is not None:
             initialized_checks[check_name] = c
 
+        cache[check_name] = {
+            'check_path': check,
+            'check_file': check_file,
+            'module': check_module,
+            'conf_path': conf_path,
+            'conf_file': conf_file,
+            'config': check_config,
+            'check': c,
+            'agentConfig': agentConfig,
+            'hostname': hostname,
+        }
+
         # Add custom pythonpath(s) if available
         if 'pythonpath' in check_config:
             pythonpath = check_config['pythonpath']
             if not isinstance(pythonpath, list):
                 pythonpath = [pythonpath]
-            sys.path.extend(pythonpath)
+            sys.path.extend(p for p in pythonpath if p not in sys.path)
 
         log.debug('Loaded check.d/%s.py' % check_name)
 
+    # Forget about the checks which aren't configured anymore
+    _checksd_cache.clear()
+    _checksd_cache.update(cache)
+
     init_failed_checks.update(deprecated_checks)
+    load_stats = {
+        'duration': round(time.time() - start, 4),
+        'initialized': len(initialized_checks),
+        'reused': reused_checks,
+        'failed': len(init_failed_checks),
+    }
     log.info('initialized checks.d checks: %s' % [k for k in initialized_checks.keys() if k != AGENT_METRICS_CHECK_NAME])
     log.info('initialization failed checks.d checks: %s' % init_failed_checks.keys())
+    log.info('checks.d checks loaded in %ss, %s reused from the previous load',
+             load_stats['duration'], reused_checks)
     return {'initialized_checks':initialized_checks.values(),
             'init_failed_checks':init_failed_checks,
+            'load_stats': load_stats,
             }
 
 
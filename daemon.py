@@ -21,6 +21,7 @@ import time
 
 # project
 from utils.process import pid_exists
+from utils.subprocess_output import stop_subprocess_helper
 
 log = logging.getLogger(__name__)
 
@@ -108,6 +109,10 @@ class Daemon(object):
         Programming in the UNIX Environment" for details (ISBN 0201563177)
         http://www.erlenstar.demon.co.uk/unix/faq_2.html#SEC16
         """
+        # The daemon would keep the pipe to the subprocess helper of this
+        # process open, it's started again when needed
+        stop_subprocess_helper()
+
         try:
             pid = os.fork()
             if pid > 0:
@@ -21,6 +21,7 @@ from Queue import Full, Queue
 from socket import error as socket_error, gaierror
 import sys
 import threading
+import time
 import zlib
 
 # For pickle & PID files, see issue 293
@@ -50,9 +51,8 @@ from config import (
 import modules
 from transaction import Transaction, TransactionManager
 from util import (
-    get_hostname,
     get_tornado_ioloop,
-    get_uuid,
+    HostIdentity,
     json,
     Watchdog,
 )
@@ -78,6 +78,11 @@ MAX_QUEUE_SIZE = 30 * 1024 * 1024  # 30MB
 
 THROTTLING_DELAY = timedelta(microseconds=1000000/2)  # 2 msg/second
 
+# Maximum number of (name, host, device) contexts relayed metrics (e.g. from
+# graphite) are aggregated into between two flushes, points of new contexts
+# are dropped beyond that
+MAX_METRIC_CONTEXTS = 100000
+
 
 class EmitterThread(threading.Thread):
 
@@ -382,7 +387,10 @@ class Application(tornado.web.Application):
                  skip_ssl_validation=False, use_simple_http_client=False):
         self._port = int(port)
         self._agentConfig = agentConfig
+        # prefix -> {(name, host, device): [timestamp, value]}
         self._metrics = {}
+        self._metric_context_count = 0
+        self._dropped_metric_count = 0
         AgentTransaction.set_application(self)
         AgentTransaction.set_endpoints()
         self._tr_manager = TransactionManager(MAX_WAIT_FOR_REPLAY,
@@ -399,6 +407,13 @@ class Application(tornado.web.Application):
             watchdog_timeout = TRANSACTION_FLUSH_INTERVAL * WATCHDOG_INTERVAL_MULTIPLIER
             self._watchdog = Watchdog(watchdog_timeout,
                                       max_mem_mb=agentConfig.get('limit_memory_consumption', None))
+            self._watchdog.add_memory_pressure_handler(self._on_memory_pressure)
+        self._last_dropped_count = 0
+
+    def _on_memory_pressure(self, under_pressure):
+        if under_pressure:
+            # Queued transactions are what makes the forwarder grow
+            self._tr_manager.drop_oldest()
 
     def log_request(self, handler):
         """ Override the tornado logging method.
@@ -415,27 +430,78 @@ class Application(tornado.web.Application):
                    handler._request_summary(), request_time)
 
     def appendMetric(self, prefix, name, host, device, ts, value):
+        self.appendMetrics(prefix, [(name, host, device, ts, value)])
 
+    def appendMetrics(self, prefix, points):
+        """
+        Aggregate (name, host, device, ts, value) points until the next
+        flush: only the latest point of each context is sent.
+        """
         if prefix in self._metrics:
-            metrics = self._metrics[prefix]
-        else:
-            metrics = {}
-            self._metrics[prefix] = metrics
-
-        if name in metrics:
-            metrics[name].append([host, device, ts, value])
+            contexts = self._metrics[prefix]
         else:
-            metrics[name] = [[host, device, ts, value]]
+            contexts = {}
+            self._metrics[prefix] = contexts
+
+        for name, host, device, ts, value in points:
+            context = (name, host, device)
+            point = contexts.get(context)
+            if point is None:
+                if self._metric_context_count >= MAX_METRIC_CONTEXTS:
+                    self._dropped_metric_count += 1
+                    continue
+                contexts[context] = [ts, value]
+                self._metric_context_count += 1
+            elif ts >= point[0]:
+                point[0] = ts
+                point[1] = value
 
     def _postMetrics(self):
 
+        if self._dropped_metric_count:
+            log.warning("Dropped %s points as %s contexts were already pending" %
+                        (self._dropped_metric_count, MAX_METRIC_CONTEXTS))
+            self._dropped_metric_count = 0
+
         if len(self._metrics) > 0:
-            self._metrics['uuid'] = get_uuid()
-            self._metrics['internalHostname'] = get_hostname(self._agentConfig)
-            self._metrics['apiKey'] = self._agentConfig['api_key']
-            MetricTransaction(json.dumps(self._metrics),
-                              headers={'Content-Type': 'application/json'})
+            payload = {}
+            for prefix, contexts in self._metrics.iteritems():
+                metrics = payload[prefix] = {}
+                for (name, host, device), (ts, value) in contexts.iteritems():
+                    if name in metrics:
+                        metrics[name].append([host, device, ts, value])
+                    else:
+                        metrics[name] = [[host, device, ts, value]]
             self._metrics = {}
+            self._metric_context_count = 0
+
+            payload['uuid'] = HostIdentity.get_uuid()
+            payload['internalHostname'] = HostIdentity.get_hostname()
+            payload['apiKey'] = self._agentConfig['api_key']
+            MetricTransaction(json.dumps(payload),
+                              headers={'Content-Type': 'application/json'})
+
+    def _appendMemoryMetrics(self):
+        """
+        Add the memory usage seen by the watchdog and the transactions
+        dropped to relieve memory pressure to the next metrics payload.
+        """
+        if not (self._watchdog and self._watchdog.memory_limit_enabled) \
+                or self._watchdog.memory_usage_kb is None:
+            return
+
+        dropped_count = self._tr_manager.get_dropped_count()
+        ts = int(time.time())
+        hostname = HostIdentity.get_hostname()
+        series = [
+            ('datadog.forwarder.memory.rss', 1024 * self._watchdog.memory_usage_kb),
+            ('datadog.forwarder.memory.under_pressure', int(self._watchdog.under_memory_pressure)),
+            ('datadog.forwarder.transactions.dropped', dropped_count - self._last_dropped_count),
+        ]
+        self._last_dropped_count = dropped_count
+
+        self.appendMetrics('forwarder', [(name, hostname, 'N/A', ts, value)
+                                         for name, value in series])
 
     def run(self):
         handlers = [
@@ -485,6 +551,8 @@ class Application(tornado.web.Application):
 
         log.info("Listening on port %d" % self._port)
 
+        hostname = HostIdentity.init(self._agentConfig)
+
         # Register callbacks
         self.mloop = get_tornado_ioloop()
 
@@ -493,6 +561,7 @@ class Application(tornado.web.Application):
         def flush_trs():
             if self._watchdog:
                 self._watchdog.reset()
+            self._appendMemoryMetrics()
             self._postMetrics()
             self._tr_manager.flush()
 
@@ -504,7 +573,7 @@ class Application(tornado.web.Application):
         if gport is not None:
             log.info("Starting graphite listener on port %s" % gport)
             from graphite import GraphiteServer
-            gs = GraphiteServer(self, get_hostname(self._agentConfig), io_loop=self.mloop)
+            gs = GraphiteServer(self, hostname, io_loop=self.mloop)
             if non_local_traffic is True:
                 gs.listen(gport)
             else:
@@ -537,9 +606,14 @@ def init(skip_ssl_validation=False, use_simple_http_client=False):
         log.info("caught sigterm. stopping")
         app.stop()
 
+    def sighup_handler(signum, frame):
+        log.info("caught sighup. refreshing the host identity")
+        HostIdentity.invalidate()
+
     import signal
     signal.signal(signal.SIGTERM, sigterm_handler)
     signal.signal(signal.SIGINT, sigterm_handler)
+    signal.signal(signal.SIGHUP, sighup_handler)
 
     return app
 
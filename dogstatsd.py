@@ -36,7 +36,7 @@ from aggregator import get_formatter, MetricsBucketAggregator
 from checks.check_status import DogstatsdStatus
 from config import get_config, get_version
 from daemon import AgentSupervisor, Daemon
-from util import chunks, get_hostname, get_uuid, plural
+from util import chunks, HostIdentity, plural
 from utils.pidfile import PidFile
 
 # urllib3 logs a bunch of stuff at the info level
@@ -60,6 +60,8 @@ FLUSH_LOGGING_INITIAL = 10
 FLUSH_LOGGING_COUNT = 5
 EVENT_CHUNK_SIZE = 50
 COMPRESS_THRESHOLD = 1024
+# Lowest number of contexts per bucket allowed under memory pressure
+MIN_CONTEXT_LIMIT = 1000
 
 
 def serialize_metrics(metrics):
@@ -84,7 +86,7 @@ class Reporter(threading.Thread):
     """
 
     def __init__(self, interval, metrics_aggregator, api_host, api_key=None,
-                 use_watchdog=False, event_chunk_size=None):
+                 use_watchdog=False, event_chunk_size=None, max_mem_mb=None):
         threading.Thread.__init__(self)
         self.interval = int(interval)
         self.finished = threading.Event()
@@ -95,7 +97,8 @@ class Reporter(threading.Thread):
         self.watchdog = None
         if use_watchdog:
             from util import Watchdog
-            self.watchdog = Watchdog(WATCHDOG_TIMEOUT)
+            self.watchdog = Watchdog(WATCHDOG_TIMEOUT, max_mem_mb=max_mem_mb)
+            self.watchdog.add_memory_pressure_handler(self._on_memory_pressure)
 
         self.api_key = api_key
         self.api_host = api_host
@@ -105,6 +108,37 @@ class Reporter(threading.Thread):
         log.info("Stopping reporter")
         self.finished.set()
 
+    def _on_memory_pressure(self, under_pressure):
+        # Keep aggregating the contexts we know of but don't let new ones in
+        if under_pressure:
+            if self.metrics_aggregator.context_limit is None:
+                self.metrics_aggregator.context_limit = max(self.metrics_aggregator.last_flush_context_count,
+                                                            MIN_CONTEXT_LIMIT)
+                log.warn("Limiting the number of contexts to %s" % self.metrics_aggregator.context_limit)
+        else:
+            self.metrics_aggregator.context_limit = None
+
+    def _memory_metrics(self, discarded_contexts):
+        """
+        Report the memory usage seen by the watchdog and the points
+        dropped to relieve memory pressure.
+        """
+        if not (self.watchdog and self.watchdog.memory_limit_enabled) \
+                or self.watchdog.memory_usage_kb is None:
+            return []
+
+        formatter = self.metrics_aggregator.formatter
+        hostname = self.metrics_aggregator.hostname
+        timestamp = time()
+        return [
+            formatter(name, value, timestamp, None, hostname=hostname, interval=self.interval)
+            for name, value in [
+                ('datadog.dogstatsd.memory.rss', 1024 * self.watchdog.memory_usage_kb),
+                ('datadog.dogstatsd.memory.under_pressure', int(self.watchdog.under_memory_pressure)),
+                ('datadog.dogstatsd.contexts.discarded', discarded_contexts),
+            ]
+        ]
+
     def run(self):
 
         log.info("Reporting to %s every %ss" % (self.api_host, self.interval))
@@ -131,7 +165,9 @@ class Reporter(threading.Thread):
             packets_per_second = self.metrics_aggregator.packets_per_second(self.interval)
             packet_count = self.metrics_aggregator.total_count
 
+            discarded_contexts = self.metrics_aggregator.num_discarded_contexts
             metrics = self.metrics_aggregator.flush()
+            metrics += self._memory_metrics(discarded_contexts)
             count = len(metrics)
             if self.flush_count % FLUSH_LOGGING_PERIOD == 0:
                 self.log_count = 0
@@ -191,8 +227,8 @@ class Reporter(threading.Thread):
                 'events': {
                     'api': chunk
                 },
-                'uuid': get_uuid(),
-                'internalHostname': get_hostname()
+                'uuid': HostIdentity.get_uuid(),
+                'internalHostname': HostIdentity.get_hostname()
             }
             params = {}
             if self.api_key:
@@ -326,6 +362,10 @@ class Dogstatsd(Daemon):
         log.debug("Caught sigterm. Stopping run loop.")
         self.server.stop()
 
+    def _handle_sighup(self, signum, frame):
+        log.info("Caught sighup. Refreshing the host identity.")
+        HostIdentity.invalidate()
+
     def run(self):
         # Gracefully exit on sigterm.
         signal.signal(signal.SIGTERM, self._handle_sigterm)
@@ -333,6 +373,9 @@ class Dogstatsd(Daemon):
         # Handle Keyboard Interrupt
         signal.signal(signal.SIGINT, self._handle_sigterm)
 
+        # A SIGHUP has the host name and uuid resolved again
+        signal.signal(signal.SIGHUP, self._handle_sighup)
+
         # Start the reporting thread before accepting data
         self.reporter.start()
 
@@ -388,7 +431,7 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     if use_forwarder:
         target = c['dogstatsd_target']
 
-    hostname = get_hostname(c)
+    hostname = HostIdentity.init(c)
 
     # Create the aggregator (which is the point of communication between the
     # server and reporting threads.
@@ -405,7 +448,8 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     )
 
     # Start the reporting thread.
-    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size)
+    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size,
+                        max_mem_mb=c.get('limit_memory_consumption'))
 
     # Start the server on an IPv4 stack
     # Default to loopback
@@ -1,5 +1,5 @@
-from datetime import datetime
 import re
+import time
 
 from dogstream import common
 
@@ -41,6 +41,18 @@ LOG_PATTERN = re.compile(r"".join([
 ]))
 
 
+# (days since the epoch, "%Y-%m-%d") of the current UTC day
+_today = (None, None)
+
+
+def utc_today():
+    global _today
+    day = int(time.time()) // 86400
+    if day != _today[0]:
+        _today = (day, time.strftime("%Y-%m-%d", time.gmtime(day * 86400)))
+    return _today[1]
+
+
 def parse_date(timestamp):
     try:
         return common.parse_date(timestamp, DATE_FORMAT)
@@ -57,7 +69,7 @@ def parse_cassandra(log, line):
         # Convert the timestamp string into an epoch timestamp
         time_val = event.get('time', None)
         if time_val:
-            event['timestamp'] = parse_date("%s %s" % (datetime.utcnow().strftime("%Y-%m-%d"), time_val))
+            event['timestamp'] = parse_date("%s %s" % (utc_today(), time_val))
         else:
             try:
                 event['timestamp'] = parse_date(event['timestamp'])
@@ -1,26 +1,30 @@
-import calendar
-from datetime import datetime
+from utils.timeparse import TimestampParser
 
 MAX_TITLE_LEN = 100
 
+DEFAULT_DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S,%f')
+
+# One TimestampParser per tuple of formats, to keep their memos across lines
+_parsers = {}
+
 
 class ParseError(Exception):
     pass
 
 
+def get_date_parser(formats=DEFAULT_DATE_FORMATS, utc=True):
+    key = (tuple(formats), utc)
+    parser = _parsers.get(key)
+    if parser is None:
+        parser = _parsers[key] = TimestampParser(formats, utc=utc)
+    return parser
+
+
 def parse_date(date_val, date_format=None):
     if date_format:
-        dt = datetime.strptime(date_val, date_format)
-    else:
-        to_try = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S,%f']
-
-        for fmt in to_try:
-            try:
-                dt = datetime.strptime(date_val, fmt)
-                break
-            except Exception:
-                pass
-        else:
-            raise ParseError(date_val)
-
-    return calendar.timegm(dt.timetuple())
+        return get_date_parser((date_format,)).parse(date_val)
+
+    try:
+        return get_date_parser().parse(date_val)
+    except ValueError:
+        raise ParseError(date_val)
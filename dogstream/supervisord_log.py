@@ -7,9 +7,10 @@ dogstreams: [path_to_supervisord.log]:datadog.streams.supervisord:parse_supervis
 
 """
 # stdlib
-from datetime import datetime
 import re
-import time
+
+# project
+from dogstream import common
 
 EVENT_TYPE = "supervisor"
 
@@ -38,6 +39,9 @@ ALERT_TYPES_MAPPING = {
 # regex to extract the 'program' supervisord is managing from the text
 program_matcher = re.compile("^\w+:? '?(?P<program>\w+)'?")
 
+# supervisord logs in local time
+date_parser = common.get_date_parser(('%Y-%m-%d %H:%M:%S,%f', '%Y-%m-%d %H:%M:%S'), utc=False)
+
 
 def parse_supervisord(log, line):
     """
@@ -50,10 +54,7 @@ def parse_supervisord(log, line):
         log.debug('PARSE supervisord:%s' % line)
     line_items = line.split(' ', 3)
     timestamp = ' '.join(line_items[:2])
-    timestamp_parts = timestamp.split(',')
-    dt = datetime.strptime(timestamp_parts[0], "%Y-%m-%d %H:%M:%S")
-    dt = dt.replace(microsecond=int(timestamp_parts[1]))
-    date = time.mktime(dt.timetuple())
+    date = date_parser.parse(timestamp)
     event_type = line_items[2]
     msg = line_items[3]
     if event_type in SUPERVISORD_LEVELS:
@@ -1,5 +1,6 @@
 # stdlib
 import cPickle as pickle
+from cStringIO import StringIO
 import logging
 import struct
 
@@ -9,15 +10,27 @@ from tornado.tcpserver import TCPServer
 
 log = logging.getLogger(__name__)
 
+# Pickled frames bigger than this are rejected, like carbon does
+MAX_PICKLE_FRAME_SIZE = 1024 * 1024
+# Plaintext lines longer than this are dropped
+MAX_LINE_LENGTH = 4096
+# Data buffered per connection before it's parsed
+MAX_BUFFER_SIZE = 2 * MAX_PICKLE_FRAME_SIZE
+
 
 class GraphiteServer(TCPServer):
+    """
+    Graphite relay, accepting both the plaintext protocol
+    ("<metric> <value> <timestamp>" lines) and pickled frames on the same
+    port: a pickled frame starts with its 4-byte big-endian length, whose
+    first byte is always null since frames are capped to 1MB.
+    """
 
     def __init__(self, app, hostname, io_loop=None, ssl_options=None, **kwargs):
         log.warn('Graphite listener is started -- if you do not need graphite, turn it off in datadog.conf.')
-        log.warn('Graphite relay uses pickle to transport messages. Pickle is not secured against remote execution exploits.')
-        log.warn('See http://blog.nelhage.com/2011/03/exploiting-pickle/ for more details')
         self.app = app
         self.hostname = hostname
+        kwargs.setdefault('max_buffer_size', MAX_BUFFER_SIZE)
         TCPServer.__init__(self, io_loop=io_loop, ssl_options=ssl_options, **kwargs)
 
     def handle_stream(self, stream, address):
@@ -32,20 +45,69 @@ class GraphiteConnection(object):
         self.stream = stream
         self.address = address
         self.hostname = hostname
+        self._partial = ''
         self.stream.set_close_callback(self._on_close)
-        self.stream.read_bytes(4, self._on_read_header)
+        self.stream.read_bytes(4, self._on_read_first_bytes)
+
+    def _on_read_first_bytes(self, data):
+        if data[0] == '\0':
+            log.debug('%s sends pickled frames', self.address)
+            self._on_read_header(data)
+        else:
+            log.debug('%s uses the plaintext protocol', self.address)
+            self._on_read_plaintext(data)
+            self.stream.read_until_close(self._on_read_plaintext_end,
+                                         streaming_callback=self._on_read_plaintext)
 
     def _on_read_header(self, data):
         try:
             size = struct.unpack("!L", data)[0]
             log.debug("Receiving a string of size:" + str(size))
+            if size > MAX_PICKLE_FRAME_SIZE:
+                log.error("Frame of %s bytes from %s is too big, closing the connection", size, self.address)
+                self.stream.close()
+                return
             self.stream.read_bytes(size, self._on_read_line)
         except Exception, e:
             log.error(e)
+            self.stream.close()
 
     def _on_read_line(self, data):
         log.debug('read a new line from %s', self.address)
         self._decode(data)
+        if not self.stream.closed():
+            self.stream.read_bytes(4, self._on_read_header)
+
+    def _on_read_plaintext(self, data):
+        if not data:
+            return
+
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        if len(self._partial) > MAX_LINE_LENGTH:
+            log.warning("Dropping a line of more than %s bytes from %s", MAX_LINE_LENGTH, self.address)
+            self._partial = ''
+
+        points = []
+        invalid = 0
+        for line in lines:
+            fields = line.split()
+            if not fields:
+                continue
+            try:
+                metric, value, ts = fields
+                points.append((metric, (float(ts), float(value))))
+            except ValueError:
+                invalid += 1
+
+        if invalid:
+            log.warning("Ignored %s malformed line%s from %s", invalid, 's' if invalid > 1 else '', self.address)
+
+        self._processMetrics(points)
+
+    def _on_read_plaintext_end(self, data):
+        # The last line may not end with a newline
+        self._on_read_plaintext(data + '\n' if self._partial else data)
 
     def _on_close(self):
         log.debug('client quit %s', self.address)
@@ -56,12 +118,10 @@ class GraphiteConnection(object):
         out of the graphite metric name.
 
         For instance, if the hostname is in 4th position,
-        you could use: host = components[3]
+        you could use: host = metric.split('.')[3]
         """
 
         try:
-            components = metric.split('.')
-
             host = self.hostname
             metric = metric
             device = "N/A"
@@ -71,41 +131,41 @@ class GraphiteConnection(object):
             log.exception("Unparsable metric: %s" % metric)
             return None, None, None
 
-    def _postMetric(self, name, host, device, datapoint):
-
-        ts = datapoint[0]
-        value = datapoint[1]
-        if self.app is not None:
-            self.app.appendMetric("graphite", name, host, device, ts, value)
+    def _processMetrics(self, datapoints):
+        """Parse the metric names to fetch (host, metric, device) and
+            send the datapoints to datadog, in a single batch"""
 
-    def _processMetric(self, metric, datapoint):
-        """Parse the metric name to fetch (host, metric, device) and
-            send the datapoint to datadog"""
+        points = []
+        for metric, (ts, value) in datapoints:
+            metric, host, device = self._parseMetric(metric)
+            if metric is not None:
+                points.append((metric, host, device, ts, value))
 
-        log.debug("New metric: %s, values: %s" % (metric, datapoint))
-        (metric, host, device) = self._parseMetric(metric)
-        if metric is not None:
-            self._postMetric(metric, host, device, datapoint)
-            log.info("Posted metric: %s, host: %s, device: %s" % (metric, host, device))
+        log.debug("Received %s points from %s", len(points), self.address)
+        if points and self.app is not None:
+            self.app.appendMetrics("graphite", points)
 
     def _decode(self, data):
 
         try:
-            datapoints = pickle.loads(data)
+            # Frames only hold lists, tuples, strings and numbers: refuse
+            # any global so that a frame can't run code
+            unpickler = pickle.Unpickler(StringIO(data))
+            unpickler.find_global = None
+            datapoints = unpickler.load()
         except Exception:
             log.exception("Cannot decode grapite points")
             return
 
+        points = []
         for (metric, datapoint) in datapoints:
             try:
-                datapoint = (float(datapoint[0]), float(datapoint[1]))
+                points.append((metric, (float(datapoint[0]), float(datapoint[1]))))
             except Exception, e:
                 log.error(e)
-                continue
 
-            self._processMetric(metric, datapoint)
+        self._processMetrics(points)
 
-        self.stream.read_bytes(4, self._on_read_header)
 
 def start_graphite_listener(port):
     from util import get_hostname
@@ -144,3 +144,30 @@ class TestMongo(unittest.TestCase):
             metric_name = m[0]
             if metric_name in metric_val_checks:
                 self.assertTrue(metric_val_checks[metric_name](m[2]))
+
+    def testMongoClientReuse(self):
+        agentConfig = {
+            'version': '0.1',
+            'api_key': 'toto'
+        }
+        config = {
+            'instances': [{
+                'server': "mongodb://localhost:%s/test" % PORT1,
+                'collect_timing_metrics': True,
+            }]
+        }
+        check = load_check('mongo', config, agentConfig)
+
+        check.check(config['instances'][0])
+        clients = dict(check._clients)
+        self.assertTrue(clients)
+        check.check(config['instances'][0])
+        for key, cli in check._clients.iteritems():
+            self.assertTrue(clients[key] is cli)
+
+        metric_names = [m[0] for m in check.get_metrics()]
+        for step in ['connect', 'server_status', 'dbstats', 'all_dbstats']:
+            self.assertTrue('mongodb.collection_time.%s' % step in metric_names)
+
+        check.stop()
+        self.assertEquals(check._clients, {})
@@ -151,3 +151,22 @@ class TestMySql(AgentCheckTest):
         self.assertServiceCheck('mysql.can_connect', status=AgentCheck.CRITICAL,
                                 tags=self.SC_TAGS, count=1)
         self.coverage_report()
+
+    def test_connection_reuse(self):
+        """
+        The connection is kept open across runs and re-established when lost
+        """
+        config = {'instances': self.MYSQL_CONFIG}
+        self.run_check_twice(config)
+
+        self.assertEquals(len(self.check.dbs), 1)
+        db = self.check.dbs.values()[0]
+        self.run_check(config)
+        self.assertTrue(self.check.dbs.values()[0] is db)
+
+        # Connection lost: the check reconnects
+        db.close()
+        self.run_check(config)
+        self.assertFalse(self.check.dbs.values()[0] is db)
+        self.assertServiceCheck('mysql.can_connect', status=AgentCheck.OK,
+                                tags=self.SC_TAGS, count=1)
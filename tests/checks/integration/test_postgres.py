@@ -217,3 +217,26 @@ class TestPostgres(AgentCheckTest):
         self.assertServiceMetadata(['version'], count=2)
 
         self.coverage_report()
+
+    def test_relations_budget(self):
+        instance = {
+            'host': 'localhost',
+            'port': 15432,
+            'username': 'datadog',
+            'password': 'datadog',
+            'dbname': 'dogs',
+            'relations': ['breed', 'kennel'],
+            'max_relations_per_run': 1,
+        }
+
+        # One relation per run, in turn
+        for rel in ('breed', 'kennel', 'breed'):
+            self.run_check(dict(instances=[instance]))
+            for table in ('breed', 'kennel'):
+                self.assertMetric('postgresql.table_size', count=int(table == rel),
+                                  tags=['db:dogs', 'table:%s' % table])
+
+        # Queries are only compiled once
+        plan = self.check.query_plans[('localhost', 15432, 'dogs')]
+        self.run_check(dict(instances=[instance]))
+        self.assertTrue(self.check.query_plans[('localhost', 15432, 'dogs')] is plan)
@@ -306,6 +306,35 @@ class TestRedis(AgentCheckTest):
         self.assertMetric("redis.slowlog.micros.count", tags=["command:SORT",
             "redis_host:localhost", "redis_port:{0}".format(port)], value=1.0)
 
+    def test_key_lengths(self):
+        port = NOAUTH_PORT
+        instance = {
+            'host': 'localhost',
+            'port': port,
+            'db': 14,
+            'keys': ['test_list', 'test_missing', 'test_pattern:*'],
+        }
+
+        db = redis.Redis(port=port, db=14)  # Datadog's test db
+        db.flushdb()
+        db.rpush('test_list', 1, 2, 3)
+        db.sadd('test_pattern:set', 1, 2)
+        db.hset('test_pattern:hash', 'field', 1)
+
+        self.run_check({"init_config": {}, "instances": [instance]})
+
+        tags = ["redis_host:localhost", "redis_port:{0}".format(port)]
+        self.assertMetric('redis.key.length', value=3, tags=tags + ['key:test_list'])
+        self.assertMetric('redis.key.length', value=0, tags=tags + ['key:test_missing'])
+        self.assertMetric('redis.key.length', value=2, tags=tags + ['key:test_pattern:set'])
+        self.assertMetric('redis.key.length', value=1, tags=tags + ['key:test_pattern:hash'])
+
+        # The type of the keys changed: lengths are still right
+        db.delete('test_list')
+        db.zadd('test_list', a=1)
+        self.run_check({"init_config": {}, "instances": [instance]})
+        self.assertMetric('redis.key.length', value=1, tags=tags + ['key:test_list'])
+
     def _sort_metrics(self, metrics):
         def sort_by(m):
             return m[0], m[1], m[3]
@@ -2,7 +2,7 @@
 import mock
 
 # project
-from checks import AGENT_METRICS_CHECK_NAME
+from checks import AGENT_METRICS_CHECK_NAME, normalization_cache
 from tests.checks.common import AgentCheckTest, load_check
 
 MOCK_CONFIG = {
@@ -100,6 +100,16 @@ class AgentMetricsTestCase(AgentCheckTest):
         self.assertMetric('datadog.agent.collector.memory_info.rss', value=16814080)
         self.assertMetric('datadog.agent.collector.memory_info.vms', value=74522624)
 
+    def test_register_normalization_cache_metrics(self):
+        check = load_check(self.CHECK_NAME, MOCK_CONFIG, AGENT_CONFIG_DEV_MODE)
+        check.normalize('some.metric(name)', 'prefix')
+        check._register_normalization_cache_metrics()
+        self.metrics = check.get_metrics()
+
+        self.assertMetric('datadog.agent.collector.normalization_cache.entries',
+                          value=normalization_cache.get_stats()['entries'])
+        self.assertMetric('datadog.agent.collector.normalization_cache.size')
+
     def test_bad_process_metric_check(self):
         ''' Tests that a bad configuration option for `process_metrics` gets ignored '''
         check = load_check(self.CHECK_NAME, MOCK_CONFIG_2, AGENT_CONFIG_DEV_MODE)
@@ -3,6 +3,10 @@ from itertools import product
 import os
 import shutil
 import tempfile
+import time
+
+# 3p
+import mock
 
 # project
 from tests.checks.common import AgentCheckTest
@@ -166,3 +170,61 @@ class DirectoryTestCase(AgentCheckTest):
 
         # Raises when COVERAGE=true and coverage < 100%
         self.coverage_report()
+
+    def test_incremental(self):
+        """
+        Only the directories whose mtime changed are read again
+        """
+        config = {
+            'instances': [{
+                'directory': self.temp_dir,
+                'recursive': True,
+                'incremental': True,
+            }]
+        }
+        dir_tags = ["name:%s" % self.temp_dir]
+        subfolder = self.temp_dir + "/subfolder"
+
+        # Directories changed a while ago
+        past = time.time() - 60
+        for path in (self.temp_dir, subfolder):
+            os.utime(path, (past, past))
+
+        self.run_check(config)
+        self.assertMetric("system.disk.directory.files", tags=dir_tags, count=1, value=17)
+
+        with mock.patch.object(self.check, '_scan', wraps=self.check._scan) as scan:
+            self.run_check(config)
+            self.assertEquals(scan.call_count, 0)
+            self.assertMetric("system.disk.directory.files", tags=dir_tags, count=1, value=17)
+            self.assertMetric("system.disk.directory.file.bytes.count", tags=dir_tags, count=1)
+
+            with open(subfolder + "/new_file", 'w') as f:
+                f.write("hello")
+            os.remove(self.temp_dir + "/file_0")
+            self.run_check(config)
+            self.assertEquals(sorted(call[0][0] for call in scan.call_args_list),
+                              [self.temp_dir, subfolder])
+            self.assertMetric("system.disk.directory.files", tags=dir_tags, count=1, value=17)
+            self.assertMetric("system.disk.directory.bytes", tags=dir_tags, count=1, value=5)
+
+    def test_sampled_histograms(self):
+        """
+        The count, min and max of the histograms stay exact for sampled directories
+        """
+        big_dir = self.temp_dir + "/big"
+        os.makedirs(big_dir)
+        for i in xrange(600):
+            with open(big_dir + "/file_%d" % i, 'w') as f:
+                f.write('x' * i)
+
+        instance = {'directory': big_dir}
+        self.load_check({'instances': [instance]})
+        with mock.patch.object(self.check, 'histogram') as histogram:
+            self.check.check(instance)
+
+        sizes = [(call[0][1], call[1]['sample_rate']) for call in histogram.call_args_list
+                 if call[0][0] == "system.disk.directory.file.bytes"]
+        self.assertEquals(sum(int(1 / rate) for _, rate in sizes), 600)
+        self.assertEquals(min(size for size, _ in sizes), 0)
+        self.assertEquals(max(size for size, _ in sizes), 599)
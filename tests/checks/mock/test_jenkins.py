@@ -8,6 +8,7 @@ import tempfile
 import unittest
 
 # 3p
+import mock
 import xml.etree.ElementTree as ET
 
 # project
@@ -68,6 +69,7 @@ class TestJenkins(unittest.TestCase):
     def _create_check(self):
         # Create the jenkins check
         self.check, instances = get_check('jenkins', self.config_yaml)
+        self.check.state_path = os.path.join(self.tmp_dir, 'jenkins_state.json')
         self.instance = instances[0]
 
     def _populate_build_dir(self, metadata, time=None):
@@ -172,3 +174,81 @@ class TestJenkins(unittest.TestCase):
         # The check method does not return anything, so this testcase passes
         # if the high_watermark was NOT updated and no exceptions were raised.
         assert self.check.high_watermarks[self.instance['name']]['foo'] == 0
+
+    def testIncrementalIndex(self):
+        """
+        Test that build.xml files are only parsed when there are new builds.
+        """
+        self._create_check()
+        self.check.check(self.instance)
+
+        job_index = self.check._indexes['default']['jobs']['foo']
+        # Pretend the builds directory was read a while ago
+        job_index['scanned_at'] -= 60
+
+        with mock.patch.object(self.check, '_parse_build_file', wraps=self.check._parse_build_file) as parse:
+            self.check.check(self.instance)
+            self.assertEquals(parse.call_count, 0)
+            self.assertEquals(self.check.get_events(), [])
+
+            # A new build shows up
+            self._populate_build_dir(dict_to_xml(UNSUCCESSFUL_BUILD))
+            self.check.check(self.instance)
+            self.assertEquals(parse.call_count, 1)
+
+        events = self.check.get_events()
+        self.assertEquals(len(events), 1)
+        self.assertEquals(events[0]['result'], 'ABORTED')
+
+    def testBuildsSinceLastRun(self):
+        """
+        Test that every build newer than the last one reported is reported.
+        """
+        self._create_check()
+        self.check.check(self.instance)
+
+        now = datetime.datetime.now()
+        self._populate_build_dir(dict_to_xml(UNSUCCESSFUL_BUILD), now - datetime.timedelta(minutes=1))
+        self._populate_build_dir(dict_to_xml(SUCCESSFUL_BUILD), now)
+        self.check.check(self.instance)
+
+        events = self.check.get_events()
+        self.assertEquals([e['result'] for e in events], ['SUCCESS', 'ABORTED'])
+
+        self.check.check(self.instance)
+        self.assertEquals(self.check.get_events(), [])
+
+    def testBranchWithOtherRoots(self):
+        """
+        Test that the git branch is found whatever the root element of build.xml.
+        """
+        self._create_check()
+        for root in ('build', 'matrix-build', 'maven2-moduleset-build', 'flow-build'):
+            build = ET.Element(root)
+            node = ET.SubElement(build, 'actions')
+            for tag in ('hudson.plugins.git.util.BuildData', 'buildsByBranchName', 'entry',
+                        'hudson.plugins.git.util.Build', 'revision', 'branches',
+                        'hudson.plugins.git.Branch', 'name'):
+                node = ET.SubElement(node, tag)
+            node.text = 'origin/master'
+            ET.SubElement(build, 'result').text = 'SUCCESS'
+
+            build_file = os.path.join(self.tmp_dir, 'build.xml')
+            write_file(build_file, ET.tostring(build))
+            self.assertEquals(self.check._parse_build_file(build_file, ['result']),
+                              {'branch': 'origin/master', 'result': 'SUCCESS'})
+
+    def testStateFile(self):
+        """
+        Test that the builds which ran while the agent was stopped are reported.
+        """
+        self._create_check()
+        self.check.check(self.instance)
+        self.assertEquals(self.check.get_events(), [])
+
+        self._populate_build_dir(dict_to_xml(UNSUCCESSFUL_BUILD))
+        self._create_check()
+        self.check.check(self.instance)
+
+        metrics_names = [m[0] for m in self.check.get_metrics()]
+        self.assertTrue('jenkins.job.failure' in metrics_names)
@@ -0,0 +1,75 @@
+# 3p
+from kafka.common import OffsetResponse
+from mock import Mock, patch
+
+# project
+from tests.checks.common import AgentCheckTest
+
+CONFIG = {
+    'init_config': {},
+    'instances': [{
+        'kafka_connect_str': 'localhost:19092',
+        'zk_connect_str': 'localhost:2181',
+        'consumer_groups': {
+            'my_consumer': {
+                'topic0': [0, 1],
+                'topic1': [0],
+            }
+        }
+    }]
+}
+
+CONSUMER_OFFSETS = {
+    '/consumers/my_consumer/offsets/topic0/0': '10',
+    '/consumers/my_consumer/offsets/topic0/1': '20',
+    '/consumers/my_consumer/offsets/topic1/0': '30',
+}
+
+
+def get_async(zk_path):
+    result = Mock()
+    result.get.return_value = (CONSUMER_OFFSETS[zk_path], None)
+    return result
+
+
+def send_offset_request(requests, fail_on_error=True):
+    return [OffsetResponse(r.topic, r.partition, 0, (100,)) for r in requests]
+
+
+class TestKafkaConsumer(AgentCheckTest):
+    CHECK_NAME = 'kafka_consumer'
+
+    def test_check(self):
+        zk_conn = Mock()
+        zk_conn.get_async.side_effect = get_async
+        kafka_conn = Mock()
+        kafka_conn.send_offset_request.side_effect = send_offset_request
+
+        self.load_check(CONFIG)
+        with patch('kafka_consumer.KazooClient', return_value=zk_conn) as zk_client, \
+                patch('kafka_consumer.KafkaClient', return_value=kafka_conn) as kafka_client:
+            self.run_check(CONFIG)
+            self.run_check(CONFIG)
+
+        # Connections are kept across runs
+        self.assertEquals(zk_client.call_count, 1)
+        self.assertEquals(kafka_client.call_count, 1)
+        self.assertEquals(zk_conn.start.call_count, 1)
+
+        # Consumer offsets are read asynchronously, broker offsets
+        # are fetched in a single request
+        self.assertEquals(zk_conn.get_async.call_count, 6)
+        self.assertEquals(zk_conn.get.call_count, 0)
+        self.assertEquals(kafka_conn.send_offset_request.call_count, 2)
+        self.assertEquals(len(kafka_conn.send_offset_request.call_args[0][0]), 3)
+
+        for topic, partition, offset in [('topic0', 0, 10), ('topic0', 1, 20), ('topic1', 0, 30)]:
+            tags = ['topic:%s' % topic, 'partition:%s' % partition]
+            self.assertMetric('kafka.broker_offset', value=100, tags=tags)
+            tags.append('consumer_group:my_consumer')
+            self.assertMetric('kafka.consumer_offset', value=offset, tags=tags)
+            self.assertMetric('kafka.consumer_lag', value=100 - offset, tags=tags)
+
+        self.check.stop()
+        self.assertEquals(zk_conn.stop.call_count, 1)
+        self.assertEquals(kafka_conn.close.call_count, 1)
@@ -47,6 +47,16 @@ class TestCheckNetwork(AgentCheckTest):
         'system.net.tcp6.time_wait': 1,
     }
 
+    @mock.patch('network.Platform.is_linux', return_value=True)
+    def test_cx_state_linux_proc(self, mock_platform):
+        with mock.patch('network.Network.PROC_NET_PATH', Fixtures.file('proc_net')):
+            self.run_check({})
+
+        # Assert metrics
+        for metric, value in self.CX_STATE_GAUGES_VALUES.iteritems():
+            self.assertMetric(metric, value=value)
+
+    @mock.patch('network.Network.PROC_NET_PATH', '/nonexistent')
     @mock.patch('network.get_subprocess_output', side_effect=ss_subprocess_mock)
     @mock.patch('network.Platform.is_linux', return_value=True)
     def test_cx_state_linux_ss(self, mock_subprocess, mock_platform):
@@ -56,6 +66,7 @@ class TestCheckNetwork(AgentCheckTest):
         for metric, value in self.CX_STATE_GAUGES_VALUES.iteritems():
             self.assertMetric(metric, value=value)
 
+    @mock.patch('network.Network.PROC_NET_PATH', '/nonexistent')
     @mock.patch('network.get_subprocess_output', side_effect=netstat_subprocess_mock)
     @mock.patch('network.Platform.is_linux', return_value=True)
     def test_cx_state_linux_netstat(self, mock_subprocess, mock_platform):
@@ -0,0 +1,218 @@
+# 3p
+import mock
+from pyasn1.type import univ
+from pysnmp.proto import errind, rfc1905
+import pysnmp.proto.rfc1902 as snmp_type
+from pysnmp.smi.exval import endOfMibView, noSuchInstance
+
+# project
+from checks import AgentCheck
+from tests.checks.common import AgentCheckTest
+
+IF_IN_OCTETS = "1.3.6.1.2.1.2.2.1.10"
+IF_OUT_OCTETS = "1.3.6.1.2.1.2.2.1.16"
+SYS_UPTIME = "1.3.6.1.2.1.1.3.0"
+
+NO_SUCH_NAME = rfc1905._errorStatus.clone('noSuchName')
+
+
+def oid(value):
+    return snmp_type.ObjectName(value)
+
+
+class FakeCmdGenerator(object):
+    """
+    Answer the requests of the check from the in-memory MIB view of each
+    device, calling the callbacks synchronously like the dispatcher would.
+
+    `devices` maps an IP to a dict {OID: value}, or to an error indication
+    returned for every request.
+    """
+    def __init__(self, devices):
+        self.devices = devices
+        self.snmpEngine = mock.Mock(transportDispatcher=None)
+
+    def _view(self, transport_target):
+        return self.devices[transport_target.transportAddr[0]]
+
+    def _next(self, view, name):
+        for candidate in sorted(view, key=lambda o: oid(o).asTuple()):
+            if oid(candidate).asTuple() > name.asTuple():
+                return oid(candidate), view[candidate]
+        return name, endOfMibView
+
+    def getCmd(self, auth_data, transport_target, oids, cb_info, **kwargs):
+        cb_fun, cb_ctx = cb_info
+        view = self._view(transport_target)
+        if not isinstance(view, dict):
+            return cb_fun(None, view, 0, 0, [], cb_ctx)
+        var_binds = [(oid(str(o)), view.get(str(o), noSuchInstance)) for o in oids]
+        cb_fun(None, None, 0, 0, var_binds, cb_ctx)
+
+    def bulkCmd(self, auth_data, transport_target, non_repeaters, max_repetitions,
+                oids, cb_info, **kwargs):
+        cb_fun, cb_ctx = cb_info
+        view = self._view(transport_target)
+        names = [oid(str(o)) for o in oids]
+        while True:
+            table = []
+            for _ in range(max_repetitions):
+                row = [self._next(view, name) for name in names]
+                table.append(row)
+                names = [name for name, _ in row]
+            if not cb_fun(None, None, 0, 0, table, cb_ctx):
+                return
+            if all(endOfMibView.isSameTypeWith(value) for _, value in table[-1]):
+                return
+
+
+class TestSNMPWalk(AgentCheckTest):
+    """
+    Drive the callbacks of the walk with the var-bind tables a device
+    could answer.
+    """
+    CHECK_NAME = 'snmp'
+
+    def _load(self, snmp_version=2, ignore_nonincreasing_oid=False, instances=None):
+        instances = instances or [{
+            'ip_address': 'localhost',
+            'community_string': 'public',
+            'snmp_version': snmp_version,
+            'metrics': [{'OID': IF_IN_OCTETS, 'name': 'ifInOctets'}],
+        }]
+        self.load_check({
+            'init_config': {'ignore_nonincreasing_oid': ignore_nonincreasing_oid},
+            'instances': instances,
+        })
+
+    def _query(self, oids=None):
+        from_module = self.load_class('OIDQuery')
+        return from_module(self.check.instances[0], oids or [IF_IN_OCTETS], False, 1, 0)
+
+    def _walk(self, query, table, error_indication=None, error_status=0):
+        heads = [univ.ObjectIdentifier(o) for o in query.oids]
+        with mock.patch.object(self.check, '_send_get') as send_get:
+            more = self.check._on_walk(None, error_indication, error_status, 0,
+                                       table, (query, heads))
+        return more, send_get.called
+
+    def test_walk_stops_at_subtree_end(self):
+        self._load()
+        query = self._query()
+        table = [
+            [(oid(IF_IN_OCTETS + ".1"), snmp_type.Counter32(10))],
+            [(oid(IF_IN_OCTETS + ".2"), snmp_type.Counter32(20))],
+        ]
+        more, next_get = self._walk(query, table)
+        self.assertTrue(more)
+        self.assertFalse(next_get)
+
+        # The next column isn't part of the walk
+        table = [
+            [(oid(IF_IN_OCTETS + ".3"), snmp_type.Counter32(30))],
+            [(oid(IF_OUT_OCTETS + ".1"), snmp_type.Counter32(40))],
+        ]
+        more, next_get = self._walk(query, table)
+        self.assertFalse(more)
+        self.assertTrue(next_get)
+        self.assertEquals(sorted(query.get_results()),
+                          [IF_IN_OCTETS + ".1", IF_IN_OCTETS + ".2", IF_IN_OCTETS + ".3"])
+
+    def test_walk_end_of_mib_view(self):
+        self._load()
+        query = self._query()
+        table = [
+            [(oid(IF_IN_OCTETS + ".1"), snmp_type.Counter32(10))],
+            [(oid(IF_IN_OCTETS + ".1"), endOfMibView)],
+        ]
+        more, next_get = self._walk(query, table)
+        # The row before the end is in the subtree, the next request
+        # gets endOfMibView only
+        self.assertFalse(more)
+        self.assertTrue(next_get)
+        self.assertEquals(query.get_results().keys(), [IF_IN_OCTETS + ".1"])
+
+    def test_walk_v1_no_such_name(self):
+        self._load(snmp_version=1)
+        query = self._query()
+        self.assertTrue(query.snmp_v1)
+
+        # SNMP v1 agents answer noSuchName at the end of the MIB
+        more, next_get = self._walk(query, [], error_status=NO_SUCH_NAME)
+        self.assertFalse(more)
+        self.assertTrue(next_get)
+        self.assertEquals(query.service_check_error, None)
+        self.assertEquals(query.get_results(), {})
+
+        # Not for v2c
+        self._load()
+        query = self._query()
+        more, next_get = self._walk(query, [], error_status=NO_SUCH_NAME)
+        self.assertFalse(more)
+        self.assertTrue("noSuchName" in query.service_check_error)
+
+    def test_walk_oid_not_increasing(self):
+        table = [[(oid(IF_IN_OCTETS + ".1"), snmp_type.Counter32(10))]]
+
+        self._load()
+        query = self._query()
+        more, next_get = self._walk(query, table, error_indication=errind.oidNotIncreasing)
+        self.assertFalse(more)
+        self.assertFalse(next_get)
+        self.assertTrue(query.error is not None)
+        self.assertTrue(query.service_check_error.endswith("for instance localhost"))
+
+        self._load(ignore_nonincreasing_oid=True)
+        query = self._query()
+        more, next_get = self._walk(query, table, error_indication=errind.oidNotIncreasing)
+        self.assertTrue(more)
+        self.assertEquals(query.error, None)
+        self.assertEquals(query.get_results().keys(), [IF_IN_OCTETS + ".1"])
+
+    def test_get_falls_back_to_walk(self):
+        self._load()
+        query = self._query([SYS_UPTIME, IF_IN_OCTETS])
+        var_binds = [
+            (oid(SYS_UPTIME), snmp_type.TimeTicks(42)),
+            (oid(IF_IN_OCTETS), noSuchInstance),
+        ]
+        with mock.patch.object(self.check, '_send_walk') as send_walk:
+            self.check._on_get(None, None, 0, 0, var_binds, query)
+        send_walk.assert_called_once_with(query, [IF_IN_OCTETS])
+        self.assertEquals(query.get_results().keys(), [SYS_UPTIME])
+
+    def test_walk_with_getbulk(self):
+        self._load()
+        self.check.bulk_max_repetitions = 2
+        self.check.async_cmd_generator = FakeCmdGenerator({'127.0.0.1': {
+            IF_IN_OCTETS + ".1": snmp_type.Counter32(10),
+            IF_IN_OCTETS + ".2": snmp_type.Counter32(20),
+            IF_IN_OCTETS + ".3": snmp_type.Counter32(30),
+            IF_OUT_OCTETS + ".1": snmp_type.Counter32(40),
+        }})
+        query = self._query()
+        self.check.run_queries([query])
+        self.assertEquals(sorted(query.get_results()),
+                          [IF_IN_OCTETS + ".1", IF_IN_OCTETS + ".2", IF_IN_OCTETS + ".3"])
+
+    def test_device_errors_are_isolated(self):
+        instances = [{
+            'ip_address': ip,
+            'community_string': 'public',
+            'metrics': [{'OID': IF_IN_OCTETS, 'name': 'ifInOctets'}],
+        } for ip in ('127.0.0.1', '127.0.0.2')]
+        self._load(instances=instances)
+        self.check.async_cmd_generator = FakeCmdGenerator({
+            '127.0.0.1': errind.requestTimedOut,
+            '127.0.0.2': {IF_IN_OCTETS + ".1": snmp_type.Gauge32(10)},
+        })
+
+        self.check.run()
+        self.metrics = self.check.get_metrics()
+        self.service_checks = self.check.get_service_checks()
+
+        self.assertMetric('snmp.ifInOctets', value=10, tags=['snmp_device:127.0.0.2'], count=1)
+        self.assertServiceCheck('snmp.can_check', status=AgentCheck.CRITICAL,
+                                tags=['snmp_device:127.0.0.1'], count=1)
+        self.assertServiceCheck('snmp.can_check', status=AgentCheck.OK,
+                                tags=['snmp_device:127.0.0.2'], count=1)
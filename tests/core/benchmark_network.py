@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Performance tests for the network check.
+"""
+# stdlib
+import logging
+import os
+import tempfile
+import time
+
+# project
+from tests.checks.common import AgentCheckTest
+
+
+class TestCheckNetworkPerf(AgentCheckTest):
+    CHECK_NAME = 'network'
+
+    LINE_COUNT = 1000000
+    TCP_LINE = "%6d: 0F02000A:B245 0F02000A:2454 %s 00000000:00000000 00:00000000 00000000   112        0 %d 1 0000000000000000 20 4 30 10 -1\n"
+    STATES = ['01', '01', '01', '06', '0A']
+
+    def test_proc_cx_state_perf(self):
+        self.load_check({'instances': [{'collect_connection_state': True}]})
+        proc_net = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(proc_net, 'tcp'), 'w') as f:
+                f.write("  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n")
+                for i in xrange(self.LINE_COUNT):
+                    f.write(self.TCP_LINE % (i, self.STATES[i % len(self.STATES)], i))
+            for name in ['tcp6', 'udp', 'udp6']:
+                with open(os.path.join(proc_net, name), 'w') as f:
+                    f.write("  sl  local_address rem_address   st\n")
+
+            start = time.time()
+            metrics = self.check._parse_proc_cx_state(proc_net)
+            elapsed = time.time() - start
+        finally:
+            for name in os.listdir(proc_net):
+                os.remove(os.path.join(proc_net, name))
+            os.rmdir(proc_net)
+
+        self.assertEquals(metrics['system.net.tcp4.established'], self.LINE_COUNT * 3 / 5)
+        self.assertEquals(metrics['system.net.tcp4.time_wait'], self.LINE_COUNT / 5)
+        self.assertEquals(metrics['system.net.tcp4.listening'], self.LINE_COUNT / 5)
+        logging.getLogger().info("Counted %s connections in %.3fs", self.LINE_COUNT, elapsed)
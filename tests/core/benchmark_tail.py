@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Performance tests for the log file tailer.
+"""
+import logging
+import tempfile
+import time
+import unittest
+
+
+class TestTailPerf(unittest.TestCase):
+
+    LINE = "2015-07-01 12:00:00 INFO web.requests 12 metric_type=counter unit=request\n"
+    LINE_COUNT = 500000
+
+    def test_tail_throughput(self):
+        from utils.tailfile import TailFile
+        log_file = tempfile.NamedTemporaryFile()
+        self.count = 0
+
+        def line_parser(l):
+            self.count += 1
+
+        tail = TailFile(logging.getLogger(), log_file.name, line_parser)
+        gen = tail.tail(line_by_line=False, move_end=True)
+        gen.next()
+
+        log_file.write(self.LINE * self.LINE_COUNT)
+        log_file.flush()
+
+        start = time.time()
+        gen.next()
+        elapsed = time.time() - start
+
+        self.assertEquals(self.count, self.LINE_COUNT)
+        size = len(self.LINE) * self.LINE_COUNT
+        logging.getLogger().info("Tailed %s lines (%.1f MB) in %.3fs: %.1f MB/s",
+            self.LINE_COUNT, size / 1e6, elapsed, size / 1e6 / max(elapsed, 1e-6))
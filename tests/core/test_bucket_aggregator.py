@@ -43,6 +43,26 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         # Floating point math?
         assert abs(i - j) <= e, "%s %s %s" % (i, j, e)
 
+    def test_context_limit(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval)
+        for i in range(3):
+            stats.submit_packets('my.gauge.%s:1|g' % i)
+        self.sleep_for_interval_length()
+        stats.flush()
+        nt.assert_equal(stats.last_flush_context_count, 3)
+
+        # Known contexts are still aggregated, new ones are dropped
+        stats.context_limit = 2
+        stats.submit_packets('my.gauge.0:2|g')
+        stats.submit_packets('my.gauge.1:2|g')
+        stats.submit_packets('my.gauge.2:2|g')
+        stats.submit_packets('my.gauge.0:3|g')
+        nt.assert_equal(stats.num_discarded_contexts, 1)
+
+        stats.context_limit = None
+        stats.submit_packets('my.gauge.3:2|g')
+        nt.assert_equal(stats.num_discarded_contexts, 1)
+
     def test_counter_normalization(self):
         ag_interval = 10
         stats = MetricsBucketAggregator('myhost', interval=ag_interval)
@@ -1,11 +1,18 @@
 # stdlib
+import os
+import time
+
+# 3p
+import mock
 import nose.tools as nt
+import simplejson as json
 
 # project
 from checks import AgentCheck
 from checks.check_status import (
     CheckStatus,
     CollectorStatus,
+    DogstatsdStatus,
     InstanceStatus,
     STATUS_ERROR,
     STATUS_OK,
@@ -51,7 +58,7 @@ def test_persistence():
     i1 = InstanceStatus(1, STATUS_OK)
     chk1 = CheckStatus("dummy", [i1], 1, 2)
     c1 = CollectorStatus([chk1])
-    c1.persist()
+    c1.persist(force=True)
 
     c2 = CollectorStatus.load_latest_status()
     nt.assert_equal(1, len(c2.check_statuses))
@@ -60,6 +67,44 @@ def test_persistence():
     assert chk2.status == chk2.status
     assert chk2.metric_count == 1
     assert chk2.event_count == 2
+    assert c2.created_at == c1.created_at
+    assert c2.check_statuses[0].instance_statuses[0].status == STATUS_OK
+
+    # Written as JSON, not pickled
+    path = CollectorStatus._get_status_path()
+    with open(path) as f:
+        nt.assert_equal(json.loads(f.read())['__status__'], 'CollectorStatus')
+    assert not [p for p in os.listdir(os.path.dirname(path)) if p.startswith('CollectorStatus.json.')]
+
+
+def test_persistence_rate_limit():
+    DogstatsdStatus.remove_latest_status()
+    with mock.patch('checks.check_status.time.time', return_value=1000):
+        assert DogstatsdStatus(flush_count=1).persist()
+        assert not DogstatsdStatus(flush_count=2).persist()
+        assert DogstatsdStatus(flush_count=3).persist(force=True)
+    nt.assert_equal(DogstatsdStatus.load_latest_status().flush_count, 3)
+
+    with mock.patch('checks.check_status.time.time', return_value=1005):
+        assert DogstatsdStatus(flush_count=4).persist()
+    nt.assert_equal(DogstatsdStatus.load_latest_status().flush_count, 4)
+
+    DogstatsdStatus.remove_latest_status()
+
+
+def test_persistence_coalescing():
+    DogstatsdStatus.remove_latest_status()
+    with mock.patch('checks.check_status.MIN_PERSIST_INTERVAL', 0.2):
+        assert DogstatsdStatus(flush_count=1).persist()
+        assert not DogstatsdStatus(flush_count=2).persist()
+        assert not DogstatsdStatus(flush_count=3).persist()
+        nt.assert_equal(DogstatsdStatus.load_latest_status().flush_count, 1)
+
+        # The latest status held back is written once the interval is elapsed
+        time.sleep(0.5)
+        nt.assert_equal(DogstatsdStatus.load_latest_status().flush_count, 3)
+
+    DogstatsdStatus.remove_latest_status()
 
 
 def test_persistence_fail():
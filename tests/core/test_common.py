@@ -4,20 +4,26 @@ import os
 import time
 import unittest
 
+# 3p
+import mock
+
 # project
 from aggregator import MetricsAggregator
 from checks import (
     AgentCheck,
     Check,
     CheckException,
+    CONTEXT_EXPIRY_SECONDS,
+    CONTEXT_SWEEP_INTERVAL,
     Infinity,
     UnknownValue,
 )
 from checks.collector import Collector
 from tests.checks.common import load_check
-from util import get_hostname
+from util import get_hostname, get_uuid, HostIdentity
 from utils.ntp import get_ntp_args
 from utils.proxy import get_proxy
+from utils.subprocess_output import stop_subprocess_helper
 
 logger = logging.getLogger()
 
@@ -91,6 +97,36 @@ class TestCore(unittest.TestCase):
         # Tagged metrics are not available through get_samples anymore
         self.assertEquals(self.c.get_samples(), {})
 
+    def test_sample_expiry(self):
+        now = time.time()
+        self.c.save_sample("test-metric", 1.0, tags=["tag1"])
+        self.c.save_sample("test-metric", 2.0, tags=["tag2"])
+        self.assertEquals(self.c.get_context_count(), 2)
+
+        # "tag1" isn't saved anymore
+        self.c._sample_last_seen[("test-metric", (("tag1",), None))] -= CONTEXT_EXPIRY_SECONDS + 1
+        # Not swept before the sweep interval
+        self.c._expire_samples(now)
+        self.assertEquals(self.c.get_context_count(), 2)
+
+        self.c._expire_samples(now + CONTEXT_SWEEP_INTERVAL)
+        self.assertEquals(self.c.get_context_count(), 1)
+        self.assertEquals(self.c._sample_store["test-metric"].keys(), [(("tag2",), None)])
+
+    def test_historate_expiry(self):
+        self.setUpAgentCheck()
+        now = time.time()
+        self.ac.historate("test.historate", 1, [], tags=["foo:1"])
+        self.ac.historate("test.historate", 1, [], tags=["foo:2"])
+        self.assertEquals(len(self.ac.historate_dict), 2)
+
+        context = ("test.historate", "foo:1")
+        value, ts = self.ac.historate_dict[context]
+        self.ac.historate_dict[context] = (value, ts - CONTEXT_EXPIRY_SECONDS - 1)
+        self.ac._expire_contexts(now + CONTEXT_SWEEP_INTERVAL)
+        self.assertEquals(self.ac.historate_dict.keys(), [("test.historate", "foo:2")])
+        self.assertEquals(self.ac.get_context_count(), 1)
+
     def test_samples(self):
         self.assertEquals(self.c.get_samples(), {})
         self.c.save_sample("test-metric", 1.0, 0.0)  # value, ts
@@ -163,6 +199,9 @@ class TestCore(unittest.TestCase):
         checks = [load_check('redisdb', redis_config, agentConfig)]
 
         c = Collector(agentConfig, [], {}, get_hostname(agentConfig))
+        # Stops the metadata refresher started by the first run
+        self.addCleanup(c.stop)
+        self.addCleanup(stop_subprocess_helper)
         payload = c.run({
             'initialized_checks': checks,
             'init_failed_checks': {}
@@ -179,6 +218,10 @@ class TestCore(unittest.TestCase):
             tag = "check:%s" % check.name
             assert tag in all_tags, all_tags
 
+        # And a metric of the contexts they keep
+        context_metrics = [m for m in metrics if m[0] == 'datadog.agent.check_contexts']
+        self.assertEquals(len(context_metrics), len(checks))
+
     def test_apptags(self):
         '''
         Tests that the app tags are sent if specified so
@@ -200,6 +243,9 @@ class TestCore(unittest.TestCase):
         checks = [load_check('redisdb', redis_config, agentConfig)]
 
         c = Collector(agentConfig, [], {}, get_hostname(agentConfig))
+        # Stops the metadata refresher started by the first run
+        self.addCleanup(c.stop)
+        self.addCleanup(stop_subprocess_helper)
         payload = c.run({
             'initialized_checks': checks,
             'init_failed_checks': {}
@@ -393,3 +439,47 @@ class TestAggregator(unittest.TestCase):
         self.assertEquals(len(self.aggr.metrics), 1, self.aggr.metrics)
         metric = self.aggr.metrics.values()[0]
         self.assertEquals(metric.value, 2)
+
+
+class TestHostIdentity(unittest.TestCase):
+    def setUp(self):
+        HostIdentity.reset()
+
+    def tearDown(self):
+        HostIdentity.reset()
+
+    def test_resolved_once(self):
+        config = {'hostname': 'foo'}
+        with mock.patch('util.get_hostname', return_value='foo') as resolve:
+            self.assertEquals(HostIdentity.init(config), 'foo')
+            for _ in range(10):
+                self.assertEquals(HostIdentity.get_hostname(), 'foo')
+                self.assertEquals(HostIdentity.get_uuid(), get_uuid())
+            resolve.assert_called_once_with(config)
+
+            # Resolved again after a SIGHUP or once the identity expired
+            HostIdentity.invalidate()
+            resolve.return_value = 'bar'
+            self.assertEquals(HostIdentity.get_hostname(), 'bar')
+            with mock.patch.object(HostIdentity, 'REFRESH_INTERVAL', 0):
+                HostIdentity.get_hostname()
+            self.assertEquals(resolve.call_count, 3)
+
+    def test_invalidate_with_lock_held(self):
+        # A SIGHUP handler may run in the thread resolving the identity
+        with mock.patch('util.get_hostname', return_value='foo') as resolve:
+            HostIdentity.init({})
+            with HostIdentity._lock:
+                HostIdentity.invalidate()
+            HostIdentity.get_hostname()
+            self.assertEquals(resolve.call_count, 2)
+
+    def test_failed_refresh(self):
+        with mock.patch('util.get_hostname', return_value='foo') as resolve:
+            HostIdentity.init({})
+            resolve.side_effect = Exception("no host name")
+            HostIdentity.invalidate()
+            self.assertEquals(HostIdentity.get_hostname(), 'foo')
+
+            HostIdentity.reset()
+            self.assertRaises(Exception, HostIdentity.init, {})
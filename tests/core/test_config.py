@@ -2,9 +2,13 @@
 # stdlib
 import os
 import os.path
+import shutil
 import tempfile
 import unittest
 
+# 3p
+import mock
+
 # project
 from config import get_config, load_check_directory
 from util import is_valid_hostname, windows_friendly_colon_split
@@ -110,3 +114,63 @@ class TestConfig(unittest.TestCase):
 
         for c in DEFAULT_CHECKS:
             self.assertTrue(c in init_checks_names)
+
+    def testReloadCheckDirectory(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            checksd_path = os.path.join(tmp_dir, 'checks.d')
+            confd_path = os.path.join(tmp_dir, 'conf.d')
+            os.mkdir(checksd_path)
+            os.mkdir(confd_path)
+            check_path = os.path.join(checksd_path, 'reload_test.py')
+            conf_path = os.path.join(confd_path, 'reload_test.yaml')
+
+            def write(path, content):
+                with open(path, 'w') as f:
+                    f.write(content)
+
+            write(check_path, "from checks import AgentCheck\n"
+                              "class ReloadTest(AgentCheck):\n"
+                              "    pass\n")
+            write(conf_path, "init_config:\ninstances:\n  - host: foo\n")
+
+            agentConfig = {'additional_checksd': checksd_path}
+
+            def load():
+                with mock.patch('config.get_confd_path', return_value=confd_path):
+                    checks = load_check_directory(agentConfig, 'foo')
+                return dict((c.name, c) for c in checks['initialized_checks']), checks['load_stats']
+
+            checks, stats = load()
+            check = checks['reload_test']
+            self.assertEquals(check.instances, [{'host': 'foo'}])
+            self.assertEquals(stats['reused'], 0)
+
+            # Nothing changed, the check and its state are kept
+            checks, stats = load()
+            self.assertTrue(checks['reload_test'] is check)
+            self.assertEquals(stats['reused'], 1)
+
+            # A new configuration, same module
+            write(conf_path, "init_config:\ninstances:\n  - host: bar\n")
+            checks, stats = load()
+            self.assertFalse(checks['reload_test'] is check)
+            self.assertTrue(checks['reload_test'].__class__ is check.__class__)
+            self.assertEquals(checks['reload_test'].instances, [{'host': 'bar'}])
+            self.assertEquals(stats['reused'], 0)
+            check = checks['reload_test']
+
+            # A new module, same configuration
+            write(check_path, "from checks import AgentCheck\n"
+                              "class ReloadTest(AgentCheck):\n"
+                              "    version = 2\n")
+            checks, stats = load()
+            self.assertFalse(checks['reload_test'].__class__ is check.__class__)
+            self.assertEquals(checks['reload_test'].version, 2)
+
+            # Not configured anymore
+            os.remove(conf_path)
+            checks, stats = load()
+            self.assertFalse('reload_test' in checks)
+        finally:
+            shutil.rmtree(tmp_dir)
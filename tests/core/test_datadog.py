@@ -171,6 +171,59 @@ class TestDogstream(TailTestCase):
         for metric, timestamp, val, attr in expected_output['dogstream']:
             assert isinstance(val, (int, long))
 
+    def test_dogstream_budget(self):
+        log_data = [
+            ('test.metric.a', '1000000000', '1', 'metric_type=counter'),
+            ('test.metric.a', '1000000005', '2', 'metric_type=counter'),
+            ('test.metric.a', '1000000010', '3', 'metric_type=counter'),
+        ]
+        self._write_log((' '.join(data) for data in log_data))
+
+        # Lines beyond the budget are left for the next runs
+        config = dict(self.config, dogstream_max_lines_per_run=2)
+        self.assertEquals(self.dogstream.check(config, move_end=False), {
+            "dogstream": [
+                ('test.metric.a', 1000000000, 1, self.counter),
+                ('test.metric.a', 1000000005, 2, self.counter),
+            ]
+        })
+        self.assertEquals(self.dogstream.check(config), {
+            "dogstream": [('test.metric.a', 1000000010, 3, self.counter)]
+        })
+        self.assertEquals(self.dogstream.check(config), {})
+
+    def test_dogstream_persisted_offsets(self):
+        offsets_file = NamedTemporaryFile()
+
+        def init_dogstreams():
+            dogstreams = Dogstreams._instantiate_dogstreams(self.logger, self.config, self.config['dogstreams'])
+            return Dogstreams(self.logger, dogstreams, offsets_path=offsets_file.name)
+
+        self._write_log(['test.metric.a 1000000000 1 metric_type=gauge'])
+        init_dogstreams().check(self.config, move_end=False)
+
+        # Lines written while the agent is down are read after a restart
+        self._write_log(['test.metric.a 1000000005 2 metric_type=gauge'])
+        self.assertEquals(init_dogstreams().check(self.config), {
+            "dogstream": [('test.metric.a', 1000000005, 2, self.gauge)]
+        })
+
+    def test_dogstream_parallel(self):
+        log_files = [NamedTemporaryFile() for _ in range(3)]
+        for i, log_file in enumerate(log_files):
+            print >> log_file, 'test.metric.%s 1000000000 %s metric_type=gauge' % (i, i)
+            log_file.flush()
+
+        config = dict(self.config, dogstreams=','.join(f.name for f in log_files), dogstream_threads=2)
+        dogstream = Dogstreams.init(self.logger, config)
+        try:
+            self.assertEquals(dogstream.threads, 2)
+            self.assertEquals(dogstream.check(config, move_end=False), {
+                "dogstream": [('test.metric.%s' % i, 1000000000, i, self.gauge) for i in range(3)]
+            })
+        finally:
+            dogstream.stop()
+
     def test_dogstream_bad_input(self):
         log_data = [
             ('test.metric.e1000000000 1metric_type=gauge'),
@@ -0,0 +1,114 @@
+# stdlib
+import cPickle as pickle
+import struct
+import unittest
+
+# 3p
+import mock
+import simplejson as json
+
+# project
+from ddagent import Application
+from graphite import GraphiteConnection
+
+
+class FakeStream(object):
+    def __init__(self):
+        self.reads = []
+        self.closed_ = False
+
+    def set_close_callback(self, callback):
+        pass
+
+    def read_bytes(self, num_bytes, callback, streaming_callback=None):
+        self.reads.append(('bytes', num_bytes, callback))
+
+    def read_until_close(self, callback, streaming_callback=None):
+        self.reads.append(('until_close', callback, streaming_callback))
+
+    def close(self):
+        self.closed_ = True
+
+    def closed(self):
+        return self.closed_
+
+
+class FakeApp(object):
+    def __init__(self):
+        self.points = []
+
+    def appendMetrics(self, prefix, points):
+        self.points.extend(points)
+
+
+class TestGraphite(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = FakeStream()
+        self.app = FakeApp()
+        self.connection = GraphiteConnection(self.stream, ('127.0.0.1', 4242), self.app, 'myhost')
+
+    def test_plaintext(self):
+        data = "foo.bar 1.5 1400000000\nfoo.baz 2 1400000001\nfoo.invalid\nfoo.bar 3 14000"
+        self.connection._on_read_first_bytes(data[:4])
+        _, end_callback, streaming_callback = self.stream.reads[-1]
+        streaming_callback(data[4:])
+        self.assertEquals(self.app.points, [
+            ('foo.bar', 'myhost', 'N/A', 1400000000.0, 1.5),
+            ('foo.baz', 'myhost', 'N/A', 1400000001.0, 2.0),
+        ])
+
+        # The last line is complete once the connection is closed
+        streaming_callback("00002\n")
+        end_callback('')
+        self.assertEquals(self.app.points[-1], ('foo.bar', 'myhost', 'N/A', 1400000002.0, 3.0))
+
+    def test_pickle(self):
+        frame = pickle.dumps([('foo.bar', (1400000000, 1.5)), ('foo.baz', ('1400000001', '2'))], protocol=2)
+        self.connection._on_read_first_bytes(struct.pack("!L", len(frame)))
+        kind, size, callback = self.stream.reads[-1]
+        self.assertEquals(size, len(frame))
+        callback(frame)
+        self.assertEquals(self.app.points, [
+            ('foo.bar', 'myhost', 'N/A', 1400000000.0, 1.5),
+            ('foo.baz', 'myhost', 'N/A', 1400000001.0, 2.0),
+        ])
+        # Waiting for the next frame
+        self.assertEquals(self.stream.reads[-1][1], 4)
+
+    def test_pickle_rejected(self):
+        # Globals can't be unpickled
+        frame = pickle.dumps([('foo.bar', (1400000000, set([1.5])))], protocol=2)
+        self.connection._on_read_first_bytes(struct.pack("!L", len(frame)))
+        self.stream.reads[-1][2](frame)
+        self.assertEquals(self.app.points, [])
+
+        # Neither can huge frames
+        self.connection._on_read_header(struct.pack("!L", 2 ** 21))
+        self.assertTrue(self.stream.closed())
+
+
+class TestRelayedMetrics(unittest.TestCase):
+
+    @mock.patch('ddagent.MetricTransaction')
+    def test_aggregation(self, transaction):
+        app = Application(12345, {'api_key': 'foo'}, watchdog=False)
+        app.appendMetrics('graphite', [
+            ('foo.bar', 'myhost', 'N/A', 1400000001, 2),
+            ('foo.bar', 'myhost', 'N/A', 1400000000, 1),
+            ('foo.bar', 'otherhost', 'N/A', 1400000000, 3),
+        ])
+        app.appendMetric('graphite', 'foo.baz', 'myhost', 'N/A', 1400000000, 4)
+
+        with mock.patch('ddagent.MAX_METRIC_CONTEXTS', 3):
+            app.appendMetric('graphite', 'foo.dropped', 'myhost', 'N/A', 1400000000, 5)
+
+        app._postMetrics()
+        payload = json.loads(transaction.call_args[0][0])
+        self.assertEquals(sorted(payload['graphite']['foo.bar']), [
+            ['myhost', 'N/A', 1400000001, 2],
+            ['otherhost', 'N/A', 1400000000, 3],
+        ])
+        self.assertEquals(payload['graphite']['foo.baz'], [['myhost', 'N/A', 1400000000, 4]])
+        self.assertNotIn('foo.dropped', payload['graphite'])
+        self.assertEquals(app._metrics, {})
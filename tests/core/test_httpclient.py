@@ -0,0 +1,110 @@
+# stdlib
+import BaseHTTPServer
+from SocketServer import ThreadingMixIn
+import threading
+import unittest
+
+# 3p
+import mock
+
+# project
+from checks import AgentCheck
+from utils.httpclient import HTTPClient
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = []
+    requests = []
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connections.append(self.client_address)
+
+    def do_GET(self):
+        self.requests.append((self.path, dict(self.headers)))
+        if self.path == '/etag' and self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = '{"path": "%s"}' % self.path
+        self.send_response(200)
+        if self.path == '/etag':
+            self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # Kept-alive connections are served by their own thread
+    daemon_threads = True
+
+
+class TestHTTPClient(unittest.TestCase):
+
+    def setUp(self):
+        # Other tests may leave proxy settings in the environment
+        self.no_proxy = mock.patch.dict('os.environ', {'no_proxy': '127.0.0.1', 'NO_PROXY': '127.0.0.1'})
+        self.no_proxy.start()
+        Handler.connections[:] = []
+        Handler.requests[:] = []
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.no_proxy.stop()
+
+    def test_keep_alive(self):
+        client = HTTPClient()
+        for _ in range(3):
+            self.assertEquals(client.get(self.url + '/foo').json(), {'path': '/foo'})
+        self.assertEquals(len(Handler.connections), 1)
+
+        # Another key has its own session
+        client.get(self.url + '/foo', key='other')
+        self.assertEquals(len(Handler.connections), 2)
+
+        stats = client.get_stats()['127.0.0.1:%s' % self.server.server_port]
+        self.assertEquals(stats['requests'], 4)
+        self.assertEquals(stats['errors'], 0)
+        client.close()
+
+    def test_conditional(self):
+        client = HTTPClient()
+        first = client.get(self.url + '/etag', conditional=True)
+        second = client.get(self.url + '/etag', conditional=True)
+        self.assertTrue(second is first)
+        self.assertEquals(second.json(), {'path': '/etag'})
+        self.assertEquals(Handler.requests[1][1].get('if-none-match'), '"v1"')
+
+        # Not conditional, no validator is sent
+        client.get(self.url + '/etag')
+        self.assertFalse('if-none-match' in Handler.requests[2][1])
+
+        stats = client.get_stats()['127.0.0.1:%s' % self.server.server_port]
+        self.assertEquals(stats['not_modified'], 1)
+
+    def test_agent_check_sessions(self):
+        url = self.url
+
+        class HTTPCheck(AgentCheck):
+            def check(self, instance):
+                self.http_get(url + instance['path']).raise_for_status()
+
+        check = HTTPCheck('http_test', {}, {'version': '1.0'}, [{'path': '/a'}, {'path': '/b'}])
+        for _ in range(2):
+            check.run()
+        self.assertEquals(len(Handler.connections), 2)
+        self.assertEquals(Handler.requests[0][1]['user-agent'], 'Datadog Agent/1.0')
+        check.stop()
@@ -0,0 +1,62 @@
+# stdlib
+import unittest
+
+# project
+from utils.lru_cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # 'a' is now the most recently used
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)
+
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('c'), 3)
+        self.assertEquals(cache.get_stats(), {
+            'hits': 3,
+            'misses': 1,
+            'evictions': 1,
+            'entries': 2,
+            'size': 2,
+        })
+
+    def test_sizeof(self):
+        cache = LRUCache(10, sizeof=lambda key, value: len(value))
+        cache.set('a', 'xxxx')
+        cache.set('b', 'xxxx')
+        cache.set('a', 'xx')
+        self.assertEquals(cache.size, 6)
+
+        # 'b' is the least recently used
+        cache.set('c', 'xxxxxx')
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.size, 8)
+        self.assertEquals(cache.get('b'), None)
+
+        # Too big to be cached at all
+        cache.set('d', 'x' * 11)
+        self.assertEquals(cache.get('d'), None)
+        self.assertEquals(cache.get('c'), 'xxxxxx')
+
+    def test_get_or_compute(self):
+        cache = LRUCache(10)
+        calls = []
+
+        def compute(x):
+            calls.append(x)
+            return x * 2
+
+        self.assertEquals(cache.get_or_compute('k', compute, 2), 4)
+        self.assertEquals(cache.get_or_compute('k', compute, 2), 4)
+        self.assertEquals(calls, [2])
+
+        # None is a valid value
+        cache.get_or_compute('none', lambda: calls.append(None))
+        cache.get_or_compute('none', lambda: calls.append(None))
+        self.assertEquals(calls, [2, None])
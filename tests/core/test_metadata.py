@@ -1,8 +1,11 @@
 import unittest
 
+# 3p
+import mock
+
 # project
 from checks import AgentCheck
-from checks.collector import Collector
+from checks.collector import Collector, MetadataRefresher
 
 
 class TestMetadata(unittest.TestCase):
@@ -32,6 +35,63 @@ class TestMetadata(unittest.TestCase):
         assert "socket-fqdn" in metadata
         assert "socket-hostname" in metadata
 
+    def test_metadata_refresher(self):
+        """
+        Host metadata snapshots are versioned and timed per provider
+        """
+        def failing_provider():
+            raise Exception("unreachable")
+
+        refresher = MetadataRefresher([('meta', lambda: {'hostname': 'foo'}), ('gohai', failing_provider)], 60)
+        self.assertEquals(refresher.snapshot(), None)
+
+        refresher.refresh()
+        refresher.refresh()
+        snapshot = refresher.snapshot()
+        self.assertEquals(snapshot['version'], 2)
+        self.assertEquals(snapshot['data'], {'meta': {'hostname': 'foo'}})
+        self.assertEquals(sorted(snapshot['timings']), ['gohai', 'meta'])
+
+    def test_host_metadata_attached_once(self):
+        """
+        A snapshot is attached to a single payload, without being altered by it
+        """
+        c = Collector({'check_timings': True, 'create_dd_check_tags': False}, None, {}, "foo")
+        c._metadata_refresher = MetadataRefresher([('host-tags', lambda: {'system': ['env:prod']})], 60)
+        c._metadata_refresher.refresh()
+
+        payload = {'host-tags': {}, 'metrics': []}
+        c._populate_payload_metadata(payload, [], start_event=False)
+        self.assertEquals(payload['host-tags'], {'system': ['env:prod']})
+        self.assertEquals(payload['metrics'][0][0], 'datadog.agent.metadata_collection_time')
+
+        payload['host-tags']['system'].append('dd_check:foo')
+        self.assertEquals(c._metadata_refresher.snapshot()['data']['host-tags'], {'system': ['env:prod']})
+
+        c.run_count = 2
+        payload = {'host-tags': {}, 'metrics': []}
+        c._populate_payload_metadata(payload, [], start_event=False)
+        self.assertEquals(payload['host-tags'], {})
+
+    def test_host_metadata_on_first_run(self):
+        """
+        The first payload holds the host metadata
+        """
+        c = Collector({'check_timings': False, 'create_dd_check_tags': False}, None, {}, "foo")
+        with mock.patch.object(c, '_get_gohai_metadata', return_value='{}'), \
+                mock.patch.object(c, '_get_hostname_metadata', return_value={'hostname': 'foo'}), \
+                mock.patch.object(c, '_get_host_tags', return_value={}), \
+                mock.patch('checks.collector.get_system_stats', return_value={'cpuCores': 2}):
+            try:
+                payload = {'host-tags': {}, 'metrics': [], 'events': {}}
+                c._populate_payload_metadata(payload, [], start_event=False)
+            finally:
+                c._metadata_refresher.stop()
+
+        self.assertEquals(payload['meta'], {'hostname': 'foo'})
+        self.assertEquals(payload['gohai'], '{}')
+        self.assertEquals(payload['systemStats'], {'cpuCores': 2})
+
     def test_instance_metadata_rollup(self):
         """
         Roll-up instance metadata
@@ -0,0 +1,181 @@
+# stdlib
+import BaseHTTPServer
+import socket
+from SocketServer import ThreadingMixIn
+import threading
+import time
+import unittest
+
+# 3p
+import mock
+from tornado.httpclient import HTTPRequest
+
+# project
+from checks.libs.probes import ProbeEngine, ProbeTimeout
+from tests.checks.common import load_check
+
+RESULTS_TIMEOUT = 5
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        code = int(self.path.strip('/') or 200)
+        body = 'hello world'
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestProbes(unittest.TestCase):
+
+    def setUp(self):
+        self.no_proxy = mock.patch.dict('os.environ', {'no_proxy': '127.0.0.1', 'NO_PROXY': '127.0.0.1'})
+        self.no_proxy.start()
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        # A port nobody listens on
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.closed_port = sock.getsockname()[1]
+        sock.close()
+
+        self.engine = ProbeEngine()
+        self.engine.start()
+        self.check = None
+
+    def tearDown(self):
+        self.engine.stop()
+        if self.check is not None:
+            self.check.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        self.no_proxy.stop()
+
+    def run_probe(self, probe, timeout=5):
+        results = []
+        event = threading.Event()
+
+        def callback(error, result):
+            results.append((error, result))
+            event.set()
+
+        self.engine.submit(probe, callback, timeout=timeout)
+        event.wait(RESULTS_TIMEOUT)
+        self.assertEquals(len(results), 1)
+        return results[0]
+
+    def test_connect(self):
+        def probe(address):
+            return lambda done: self.engine.connect(
+                address, socket.AF_INET, 1, lambda error, stream, elapsed: done(error))
+
+        error, result = self.run_probe(probe(('127.0.0.1', self.port)))
+        self.assertTrue(error is None and result is None)
+
+        error, result = self.run_probe(probe(('127.0.0.1', self.closed_port)))
+        self.assertTrue(isinstance(result, socket.error))
+
+        def resolve_probe(done):
+            self.engine.resolve_and_connect('localhost', self.port, socket.AF_INET, 1,
+                                            lambda error, stream, elapsed: done(error))
+
+        error, result = self.run_probe(resolve_probe)
+        self.assertTrue(result is None)
+
+    def test_probe_failures(self):
+        def failing_probe(done):
+            raise ValueError("boom")
+
+        error, result = self.run_probe(failing_probe)
+        self.assertTrue(isinstance(error, ValueError))
+
+        # Exceptions in the callbacks of the probe end it too
+        def failing_callback(done):
+            self.engine.fetch(HTTPRequest('http://127.0.0.1:%s/' % self.port),
+                              lambda response: 1 / 0)
+
+        error, result = self.run_probe(failing_callback)
+        self.assertTrue(isinstance(error, ZeroDivisionError))
+
+        error, result = self.run_probe(lambda done: None, timeout=0.1)
+        self.assertTrue(isinstance(error, ProbeTimeout))
+
+    def wait_for_results(self, count):
+        for _ in range(RESULTS_TIMEOUT * 10):
+            self.check._process_results()
+            if len(self.check.service_checks) >= count:
+                break
+            time.sleep(0.1)
+        return dict((sc['tags'][-1], sc['status']) for sc in self.check.get_service_checks())
+
+    def test_tcp_check(self):
+        instances = [
+            {'name': 'up', 'host': '127.0.0.1', 'port': self.port, 'skip_event': True},
+            {'name': 'up_hostname', 'host': 'localhost', 'port': self.port, 'skip_event': True},
+            {'name': 'down', 'host': '127.0.0.1', 'port': self.closed_port, 'skip_event': True},
+        ]
+        self.check = load_check('tcp_check', {'init_config': {}, 'instances': instances}, {})
+        for instance in instances:
+            self.check.check(instance)
+        self.assertTrue(self.check.pool is None)
+
+        statuses = self.wait_for_results(3)
+        self.assertEquals(statuses, {
+            'instance:up': 0,
+            'instance:up_hostname': 0,
+            'instance:down': 2,
+        })
+
+    def test_http_check(self):
+        url = 'http://127.0.0.1:%s' % self.port
+        instances = [
+            {'name': 'up', 'url': url, 'skip_event': True},
+            {'name': 'status_code', 'url': url + '/404', 'skip_event': True},
+            {'name': 'status_code_match', 'url': url + '/404', 'skip_event': True,
+             'http_response_status_code': '4..'},
+            {'name': 'content_match', 'url': url, 'skip_event': True, 'content_match': 'wor.d'},
+            {'name': 'content_mismatch', 'url': url, 'skip_event': True, 'content_match': 'foo'},
+            {'name': 'down', 'url': 'http://127.0.0.1:%s' % self.closed_port, 'skip_event': True},
+        ]
+        self.check = load_check('http_check', {'init_config': {}, 'instances': instances}, {'version': '1.0'})
+        for instance in instances:
+            self.check.check(instance)
+        self.assertTrue(self.check.pool is None)
+
+        statuses = self.wait_for_results(6)
+        self.assertEquals(statuses, {
+            'instance:up': 0,
+            'instance:status_code': 2,
+            'instance:status_code_match': 0,
+            'instance:content_match': 0,
+            'instance:content_mismatch': 2,
+            'instance:down': 2,
+        })
+
+    def test_stop(self):
+        engine = ProbeEngine(resolver_threads=2)
+        engine.start()
+        threads = [engine._thread] + engine.resolver._threads
+        engine.stop()
+        self.assertEquals([t for t in threads if t.is_alive()], [])
+
+    def test_thread_pool_fallback(self):
+        instances = [{'name': 'up', 'host': '127.0.0.1', 'port': self.port, 'skip_event': True}]
+        self.check = load_check('tcp_check', {'init_config': {'probe_engine': False},
+                                              'instances': instances}, {})
+        self.check.check(instances[0])
+        self.assertTrue(self.check.probe_engine is None)
+        self.assertEquals(self.wait_for_results(1), {'instance:up': 0})
@@ -0,0 +1,122 @@
+# stdlib
+import logging
+import os
+import signal
+import threading
+import time
+import unittest
+
+# 3p
+import mock
+
+# project
+from utils.subprocess_output import (
+    get_subprocess_output,
+    stop_subprocess_helper,
+    SubprocessHelper,
+    SubprocessTimeout,
+)
+
+log = logging.getLogger(__name__)
+
+
+class TestSubprocessHelper(unittest.TestCase):
+
+    def setUp(self):
+        self.helper = SubprocessHelper()
+
+    def tearDown(self):
+        self.helper.stop()
+        # Commands run with `get_subprocess_output` use the global helper
+        stop_subprocess_helper()
+
+    def test_run(self):
+        self.assertEquals(self.helper.run(['sh', '-c', 'echo out; echo err >&2; exit 3']),
+                          ('out\n', 'err\n', 3))
+        self.assertRaises(OSError, self.helper.run, ['/does/not/exist'])
+
+        # Big outputs are streamed back
+        output, _, _ = self.helper.run(['head', '-c', '1000000', '/dev/zero'])
+        self.assertEquals(len(output), 1000000)
+
+    def test_env(self):
+        for _ in range(2):
+            output, _, _ = self.helper.run('echo $DD_TEST_VAR', shell=True, env={'DD_TEST_VAR': 'foo'})
+            self.assertEquals(output, 'foo\n')
+        self.assertEquals(len(self.helper._envs), 1)
+
+    def test_concurrent_commands(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.helper.run(['sleep', '0.5'])))
+                   for _ in range(5)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(results), 5)
+        self.assertTrue(time.time() - start < 2)
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertRaises(SubprocessTimeout, self.helper.run, ['sleep', '10'], timeout=0.2)
+        self.assertTrue(time.time() - start < 5)
+        # Still usable
+        self.assertEquals(self.helper.run(['echo', 'hello'])[0], 'hello\n')
+
+    def test_signals(self):
+        # Signal handlers run while waiting for a command, e.g. the watchdog
+        def handler(signum, frame):
+            raise KeyboardInterrupt()
+
+        previous = signal.signal(signal.SIGALRM, handler)
+        try:
+            start = time.time()
+            signal.alarm(1)
+            self.assertRaises(KeyboardInterrupt, self.helper.run, ['sleep', '5'])
+            self.assertTrue(time.time() - start < 3)
+        finally:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, previous)
+
+    def test_stop(self):
+        self.helper.run(['true'])
+        reader = self.helper._reader
+        self.helper.stop()
+        self.assertFalse(reader.is_alive())
+        # Started again by the next command
+        self.assertEquals(self.helper.run(['echo', 'hello'])[0], 'hello\n')
+
+    def test_fork(self):
+        self.helper.run(['true'])
+        parent_proc = self.helper._proc
+        pid = os.fork()
+        if pid == 0:
+            # A forked child starts its own helper, and closes the pipe to
+            # the helper of its parent
+            try:
+                ok = self.helper.run(['echo', 'hello'])[0] == 'hello\n' \
+                    and self.helper._proc is not parent_proc and parent_proc.stdin.closed
+            except Exception:
+                ok = False
+            finally:
+                self.helper.stop()
+            os._exit(0 if ok else 1)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEquals(status, 0)
+        self.assertEquals(self.helper.run(['echo', 'hello'])[0], 'hello\n')
+
+    def test_helper_restart(self):
+        self.helper.run(['true'])
+        self.helper._proc.kill()
+        self.helper._proc.wait()
+        time.sleep(0.1)
+        self.assertEquals(self.helper.run(['echo', 'hello'])[0], 'hello\n')
+
+    def test_fallback(self):
+        # Commands still run when the helper can't be started
+        with mock.patch('utils.subprocess_output.HELPER_PATH', '/does/not/exist'), \
+                mock.patch('utils.subprocess_output.sys.executable', '/does/not/exist'):
+            with mock.patch('utils.subprocess_output._helper', SubprocessHelper()):
+                self.assertEquals(get_subprocess_output(['echo', 'hello'], log), ('hello\n', '', 0))
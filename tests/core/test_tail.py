@@ -1,8 +1,11 @@
 import logging
+import os
 import subprocess
 import tempfile
 import unittest
 
+from nose.plugins.skip import SkipTest
+
 
 class TestTail(unittest.TestCase):
     def setUp(self):
@@ -64,3 +67,90 @@ class TestTail(unittest.TestCase):
             self.assertEquals(self.last_line, new_string[:-1], self.last_line)
         except OSError:
             "logrotate is not present"
+
+    def test_partial_lines(self):
+        from utils.tailfile import TailFile
+        lines = []
+
+        tail = TailFile(logging.getLogger(), self.log_file.name, lines.append)
+        gen = tail.tail(line_by_line=False, move_end=True)
+        gen.next()
+
+        # Incomplete lines are kept until their end is written
+        self.log_file.write("first line\nsecond")
+        self.log_file.flush()
+        gen.next()
+        self.assertEquals(lines, ["first line"])
+
+        self.log_file.write(" line\n")
+        self.log_file.flush()
+        gen.next()
+        self.assertEquals(lines, ["first line", "second line"])
+
+    def test_rename_rotation(self):
+        from utils.tailfile import TailFile
+        lines = []
+        path = self.log_file.name
+
+        tail = TailFile(logging.getLogger(), path, lines.append)
+        gen = tail.tail(line_by_line=False, move_end=True)
+        gen.next()
+
+        # Lines written to the old file after the rename are not lost
+        self.log_file.write("before rotation\n")
+        self.log_file.flush()
+        os.rename(path, path + '.1')
+        self.log_file.write("after rotation\n")
+        self.log_file.flush()
+
+        try:
+            with open(path, 'w') as f:
+                f.write("new file\n")
+            gen.next()
+            self.assertEquals(lines, ["before rotation", "after rotation", "new file"])
+        finally:
+            os.rename(path + '.1', path)
+
+    def test_unchanged_file_is_not_read(self):
+        from utils.tailfile import TailFile, Inotify
+        if not Inotify.is_available():
+            raise SkipTest("inotify is not available")
+
+        tail = TailFile(logging.getLogger(), self.log_file.name, lambda l: None)
+        # Only created once tailing starts
+        self.assertTrue(tail._inotify is None)
+        gen = tail.tail(line_by_line=False, move_end=True)
+        gen.next()
+        self.assertTrue(tail._inotify is not None)
+
+        def fail():
+            raise AssertionError("File should not be checked")
+
+        tail._check_rotation = fail
+        tail._read_block = fail
+        gen.next()
+        gen.next()
+
+        gen.close()
+        self.assertTrue(tail._inotify is None)
+
+    def test_position(self):
+        from utils.tailfile import TailFile
+        lines = []
+        positions = []
+
+        tail = TailFile(logging.getLogger(), self.log_file.name, lambda l: lines.append(l) or True)
+        gen = tail.tail(line_by_line=True, move_end=True)
+        gen.next()
+
+        # The holes left by a truncate are stripped from the lines,
+        # not from the offsets
+        content = "\0\0first\nsecond\n\0third\n"
+        self.log_file.write(content)
+        self.log_file.flush()
+        for _ in range(3):
+            gen.next()
+            positions.append(tail.position()[1])
+
+        self.assertEquals(lines, ["first", "second", "third"])
+        self.assertEquals(positions, [len("\0\0first\n"), len("\0\0first\nsecond\n"), len(content)])
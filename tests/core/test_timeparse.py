@@ -0,0 +1,65 @@
+# stdlib
+import calendar
+from datetime import datetime
+import time
+import unittest
+
+# 3p
+import mock
+
+# project
+from utils.timeparse import TimestampParser
+
+
+class TestTimestampParser(unittest.TestCase):
+
+    def _strptime(self, value, fmt, utc=True):
+        timetuple = datetime.strptime(value, fmt).timetuple()
+        if utc:
+            return calendar.timegm(timetuple)
+        return time.mktime(timetuple)
+
+    def test_epoch(self):
+        parser = TimestampParser()
+        self.assertEquals(parser.parse('1000000000'), 1000000000)
+        self.assertEquals(parser.parse('1000000000.75'), 1000000000)
+        self.assertEquals(parser.parse(1000000001), 1000000001)
+        self.assertRaises(ValueError, parser.parse, 'foo')
+
+    def test_iso_formats(self):
+        values = [
+            ('2012-05-13 13:27:17', '%Y-%m-%d %H:%M:%S'),
+            ('2012-05-13 13:27:59,685', '%Y-%m-%d %H:%M:%S,%f'),
+            ('2012-05-13 13:28:00.1', '%Y-%m-%d %H:%M:%S.%f'),
+            ('2012-12-31T23:59:59', '%Y-%m-%dT%H:%M:%S'),
+            ('2013-01-01T00:00:00.123456', '%Y-%m-%dT%H:%M:%S.%f'),
+        ]
+        for utc in (True, False):
+            for value, fmt in values:
+                parser = TimestampParser([fmt], utc=utc)
+                self.assertEquals(parser.parse(value), self._strptime(value, fmt, utc))
+
+    def test_formats_order(self):
+        parser = TimestampParser(['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S,%f', '%d/%m/%Y %H:%M'])
+
+        # The minute prefix is shared by the next lines
+        for value in ['2012-05-13 13:27:17', '2012-05-13 13:27:18,100', '2012-05-13 13:27:18']:
+            self.assertEquals(parser.parse(value), calendar.timegm((2012, 5, 13, 13, 27, int(value[17:19]), 0, 0, 0)))
+
+        # Unpadded fields and other formats go through strptime
+        self.assertEquals(parser.parse('2012-5-13 13:27:17'), calendar.timegm((2012, 5, 13, 13, 27, 17, 0, 0, 0)))
+        self.assertEquals(parser.parse('13/05/2012 13:27'), calendar.timegm((2012, 5, 13, 13, 27, 0, 0, 0, 0)))
+
+        for value in ['2012-05-13 13:27:17,', '2012-02-30 13:27:17', '2012-05-13 13:27:17 UTC', '']:
+            self.assertRaises(ValueError, parser.parse, value)
+
+    def test_no_strptime_for_other_fractions(self):
+        # The default formats of dogstream, lines with a fraction first
+        # fail the format without it
+        parser = TimestampParser(['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S,%f'])
+        with mock.patch('utils.timeparse.datetime', wraps=datetime) as dt:
+            for second in range(60):
+                value = '2012-05-13 13:27:%02d,%03d' % (second, second)
+                self.assertEquals(parser.parse(value),
+                                  calendar.timegm((2012, 5, 13, 13, 27, second, 0, 0, 0)))
+            self.assertEquals(dt.strptime.call_count, 0)
@@ -88,6 +88,23 @@ class TestTransaction(unittest.TestCase):
         trManager.flush()
         self.assertEqual(len(trManager._transactions), 0)
 
+    def testDropOldest(self):
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0))
+        oneTrSize = MAX_QUEUE_SIZE / 10
+        trs = [memTransaction(oneTrSize, trManager) for i in xrange(8)]
+        for tr in trs:
+            trManager.append(tr)
+
+        self.assertEqual(trManager.drop_oldest(0.5), 4)
+        self.assertEqual([tr.get_id() for tr in trManager._transactions], [5, 6, 7, 8])
+        self.assertEqual(trManager._total_size, 4 * oneTrSize)
+        self.assertEqual(trManager.get_dropped_count(), 4)
+
+        # A transaction dropped while being flushed is not removed twice
+        trManager.tr_success(trs[0])
+        self.assertEqual(trManager._total_count, 4)
+        self.assertEqual(trManager._total_size, 4 * oneTrSize)
+
     def testThrottling(self):
         """Test throttling while flushing"""
 
@@ -5,16 +5,19 @@ import subprocess
 import sys
 import time
 import unittest
+import signal
 import urllib as url
 
 # 3p
+import mock
+import simplejson as json
 from nose.plugins.attrib import attr
 
 # project
 # needed because of the subprocess calls
 sys.path.append(os.getcwd())
 from ddagent import Application
-from util import Watchdog
+from util import get_memory_usage_kb, Watchdog
 
 
 @attr(requires='core_integration')
@@ -71,6 +74,95 @@ class TestWatchdog(unittest.TestCase):
         self.assertTrue(duration < self.JITTER_FACTOR * 4)
 
 
+class TestWatchdogMemory(unittest.TestCase):
+
+    def tearDown(self):
+        signal.alarm(0)
+
+    def test_memory_usage(self):
+        rss_kb = int(subprocess.check_output(['ps', '-p', str(os.getpid()), '-o', 'rss=']))
+        self.assertTrue(abs(get_memory_usage_kb() - rss_kb) < 10 * 1024)
+
+    @mock.patch('resource.setrlimit')
+    def test_memory_pressure(self, *mocks):
+        w = Watchdog(10, max_mem_mb=100)
+        calls = []
+        w.add_memory_pressure_handler(calls.append)
+
+        with mock.patch('util.get_memory_usage_kb', return_value=70 * 1024):
+            w.reset()
+        self.assertEquals(calls, [])
+        self.assertFalse(w.under_memory_pressure)
+
+        # Load is shed when entering the pressure, then every few resets
+        # while the usage stays above the soft limit
+        with mock.patch('util.get_memory_usage_kb', return_value=85 * 1024):
+            w.reset()
+            w.reset()
+            self.assertEquals(calls, [True])
+            self.assertTrue(w.under_memory_pressure)
+            self.assertEquals(w.memory_pressure_count, 2)
+
+            for _ in range(Watchdog.SHED_INTERVAL_RESETS - 1):
+                w.reset()
+            self.assertEquals(calls, [True, True])
+
+        # The pressure is over once the usage stayed under the soft limit
+        with mock.patch('util.get_memory_usage_kb', return_value=75 * 1024):
+            for _ in range(Watchdog.RELEASE_RESETS - 1):
+                w.reset()
+            self.assertEquals(calls, [True, True])
+            self.assertTrue(w.under_memory_pressure)
+            w.reset()
+        self.assertEquals(calls, [True, True, False])
+        self.assertFalse(w.under_memory_pressure)
+        self.assertEquals(w.memory_usage_kb, 75 * 1024)
+
+        # Killed only if shedding didn't bring it back under the hard limit
+        usage = [99 * 1024, 90 * 1024]
+        with mock.patch('util.get_memory_usage_kb', side_effect=lambda: usage.pop(0)):
+            with mock.patch.object(Watchdog, 'self_destruct') as self_destruct:
+                w.reset()
+        self.assertFalse(self_destruct.called)
+
+        with mock.patch('util.get_memory_usage_kb', return_value=99 * 1024):
+            with mock.patch.object(Watchdog, 'self_destruct') as self_destruct:
+                w.reset()
+        self.assertTrue(self_destruct.called)
+
+
+    def test_dogstatsd_context_limit(self):
+        from aggregator import MetricsBucketAggregator
+        from dogstatsd import MIN_CONTEXT_LIMIT, Reporter
+
+        aggregator = MetricsBucketAggregator('myhost')
+        reporter = Reporter(10, aggregator, 'http://localhost:17123')
+        # Nothing was flushed yet, new contexts are still accepted
+        reporter._on_memory_pressure(True)
+        self.assertEquals(aggregator.context_limit, MIN_CONTEXT_LIMIT)
+        reporter._on_memory_pressure(False)
+        self.assertEquals(aggregator.context_limit, None)
+
+    @mock.patch('ddagent.MetricTransaction')
+    @mock.patch('ddagent.HostIdentity.get_hostname', return_value='myhost')
+    def test_forwarder_memory_metrics(self, get_hostname, transaction):
+        app = Application(12345, {'api_key': 'foo'}, watchdog=False)
+        app._watchdog = mock.Mock(memory_limit_enabled=True, memory_usage_kb=1000,
+                                  under_memory_pressure=True)
+        app._appendMemoryMetrics()
+        app._postMetrics()
+
+        # Sent along with the other metrics
+        self.assertEquals(transaction.call_count, 1)
+        payload = json.loads(transaction.call_args[0][0])
+        metrics = dict((name, points[0][3]) for name, points in payload['forwarder'].iteritems())
+        self.assertEquals(metrics, {
+            'datadog.forwarder.memory.rss': 1024000,
+            'datadog.forwarder.memory.under_pressure': 1,
+            'datadog.forwarder.transactions.dropped': 0,
+        })
+
+
 class MockTxManager(object):
     def flush(self):
         "Pretend to flush for a long time"
@@ -78,6 +78,7 @@ class TransactionManager(object):
         self._flush_count = 0
         self._transactions_received = 0
         self._transactions_flushed = 0
+        self._transactions_dropped = 0
 
         # Global counter to assign a number to each transaction: we may have an issue
         #  if this overlaps
@@ -130,6 +131,35 @@ class TransactionManager(object):
         log.debug("Transaction %s added" % (tr.get_id()))
         self.print_queue_stats()
 
+    def drop_oldest(self, ratio=0.5):
+        """
+        Drop the oldest transactions until the queue is at most `ratio`
+        of its current size, to relieve memory pressure.
+        Return the number of dropped transactions.
+        """
+        target_size = self._total_size * ratio
+        dropped = 0
+        # Transactions are appended, the oldest come first
+        for tr in self._transactions:
+            if self._total_size <= target_size:
+                break
+            self._total_count -= 1
+            self._total_size -= tr.get_size()
+            dropped += 1
+
+        if dropped:
+            dropped_trs = set(self._transactions[:dropped])
+            del self._transactions[:dropped]
+            if self._trs_to_flush:
+                self._trs_to_flush = [tr for tr in self._trs_to_flush if tr not in dropped_trs]
+            self._transactions_dropped += dropped
+            log.warn("Dropped the %s oldest transaction%s" % (dropped, plural(dropped)))
+            self.print_queue_stats()
+        return dropped
+
+    def get_dropped_count(self):
+        return self._transactions_dropped
+
     def flush(self):
 
         if self._trs_to_flush is not None:
@@ -214,8 +244,10 @@ class TransactionManager(object):
 
     def tr_success(self,tr):
         log.debug("Transaction %d completed" % tr.get_id())
-        self._transactions.remove(tr)
-        self._total_count -= 1
-        self._total_size -= tr.get_size()
+        # It may have been dropped while it was being flushed
+        if tr in self._transactions:
+            self._transactions.remove(tr)
+            self._total_count -= 1
+            self._total_size -= tr.get_size()
         self._transactions_flushed += 1
         self.print_queue_stats()
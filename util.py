@@ -8,6 +8,7 @@ import re
 import signal
 import socket
 import sys
+import threading
 import time
 import types
 import urllib2
@@ -228,6 +229,116 @@ def get_hostname(config=None):
     else:
         return hostname
 
+
+class HostIdentity(object):
+    """
+    Process-wide cache of the host identity sent along with every payload.
+
+    Resolving the host name may parse datadog.conf, run `hostname -f` and
+    query the GCE/EC2 metadata endpoints, and `get_uuid` looks up the MAC
+    address: both are resolved once, then refreshed every
+    `REFRESH_INTERVAL` seconds or after `invalidate()` (e.g. on SIGHUP).
+    When a refresh fails, the last known identity is kept.
+    """
+    REFRESH_INTERVAL = 30 * 60  # seconds
+
+    _lock = threading.Lock()
+    _config = None
+    # (hostname, uuid, resolution timestamp)
+    _identity = None
+
+    @classmethod
+    def init(cls, config=None):
+        """
+        Resolve the identity with `config`, which is also used by the
+        following refreshes, and return the host name.
+        Raise if no host name can be determined.
+        """
+        with cls._lock:
+            cls._config = config
+            return cls._resolve()[0]
+
+    @classmethod
+    def get_hostname(cls):
+        return cls._get()[0]
+
+    @classmethod
+    def get_uuid(cls):
+        return cls._get()[1]
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Have the identity resolved again on its next use.
+
+        Called from signal handlers, so it doesn't take the lock: the
+        handler may run in the thread holding it. The readers check the
+        timestamp again once they hold the lock.
+        """
+        identity = cls._identity
+        if identity is not None:
+            cls._identity = (identity[0], identity[1], None)
+
+    @classmethod
+    def reset(cls):
+        """Forget the identity and the configuration, used by tests."""
+        with cls._lock:
+            cls._config = None
+            cls._identity = None
+
+    @classmethod
+    def _get(cls):
+        identity = cls._identity
+        if identity is not None and identity[2] is not None \
+                and time.time() - identity[2] < cls.REFRESH_INTERVAL:
+            return identity
+
+        with cls._lock:
+            # Another thread may have refreshed it while we were waiting
+            identity = cls._identity
+            if identity is not None and identity[2] is not None \
+                    and time.time() - identity[2] < cls.REFRESH_INTERVAL:
+                return identity
+            try:
+                return cls._resolve()
+            except Exception:
+                if identity is None:
+                    raise
+                log.exception("Unable to refresh the host identity, keeping %s", identity[0])
+                cls._identity = (identity[0], identity[1], time.time())
+                return cls._identity
+
+    @classmethod
+    def _resolve(cls):
+        if cls._config is None:
+            from config import get_config
+            cls._config = get_config(parse_args=True)
+
+        hostname = get_hostname(cls._config)
+        identity = (hostname, get_uuid(), time.time())
+        if cls._identity is not None and cls._identity[0] != hostname:
+            log.info("Host name changed from %s to %s", cls._identity[0], hostname)
+        cls._identity = identity
+        return identity
+
+
+# The EC2/GCE metadata helpers used to leave this default socket timeout
+# behind them, the checks without a timeout of their own rely on it
+DEFAULT_SOCKET_TIMEOUT = 3  # seconds
+
+
+def _set_default_socket_timeout():
+    """
+    Set the process-wide default socket timeout, unless one is already set.
+    The metadata requests themselves pass their own timeout.
+    """
+    try:
+        if socket.getdefaulttimeout() is None:
+            socket.setdefaulttimeout(DEFAULT_SOCKET_TIMEOUT)
+    except Exception:
+        pass
+
+
 class GCE(object):
     URL = "http://169.254.169.254/computeMetadata/v1/?recursive=true"
     TIMEOUT = 0.1 # second
@@ -246,27 +357,15 @@ class GCE(object):
             GCE.metadata = {}
             return GCE.metadata
 
-        socket_to = None
-        try:
-            socket_to = socket.getdefaulttimeout()
-            socket.setdefaulttimeout(GCE.TIMEOUT)
-        except Exception:
-            pass
-
         try:
             opener = urllib2.build_opener()
             opener.addheaders = [('X-Google-Metadata-Request','True')]
-            GCE.metadata = json.loads(opener.open(GCE.URL).read().strip())
+            GCE.metadata = json.loads(opener.open(GCE.URL, timeout=GCE.TIMEOUT).read().strip())
 
         except Exception:
             GCE.metadata = {}
 
-        try:
-            if socket_to is None:
-                socket_to = 3
-            socket.setdefaulttimeout(socket_to)
-        except Exception:
-            pass
+        _set_default_socket_timeout()
         return GCE.metadata
 
 
@@ -338,17 +437,10 @@ class EC2(object):
             log.info("Instance metadata collection is disabled. Not collecting it.")
             return []
 
-        socket_to = None
         try:
-            socket_to = socket.getdefaulttimeout()
-            socket.setdefaulttimeout(EC2.TIMEOUT)
-        except Exception:
-            pass
-
-        try:
-            iam_role = urllib2.urlopen(EC2.METADATA_URL_BASE + "/iam/security-credentials/").read().strip()
-            iam_params = json.loads(urllib2.urlopen(EC2.METADATA_URL_BASE + "/iam/security-credentials/" + unicode(iam_role)).read().strip())
-            instance_identity = json.loads(urllib2.urlopen(EC2.INSTANCE_IDENTITY_URL).read().strip())
+            iam_role = urllib2.urlopen(EC2.METADATA_URL_BASE + "/iam/security-credentials/", timeout=EC2.TIMEOUT).read().strip()
+            iam_params = json.loads(urllib2.urlopen(EC2.METADATA_URL_BASE + "/iam/security-credentials/" + unicode(iam_role), timeout=EC2.TIMEOUT).read().strip())
+            instance_identity = json.loads(urllib2.urlopen(EC2.INSTANCE_IDENTITY_URL, timeout=EC2.TIMEOUT).read().strip())
             region = instance_identity['region']
 
             import boto.ec2
@@ -361,13 +453,7 @@ class EC2(object):
             log.exception("Problem retrieving custom EC2 tags")
             EC2_tags = []
 
-        try:
-            if socket_to is None:
-                socket_to = 3
-            socket.setdefaulttimeout(socket_to)
-        except Exception:
-            pass
-
+        _set_default_socket_timeout()
         return EC2_tags
 
 
@@ -384,35 +470,22 @@ class EC2(object):
         # 'i-deadbeef'
 
         # Every call may add TIMEOUT seconds in latency so don't abuse this call
-        # python 2.4 does not support an explicit timeout argument so force it here
-        # Rather than monkey-patching urllib2, just lower the timeout globally for these calls
+        # The timeout is passed to each request rather than set globally, this
+        # can be called from the metadata thread while checks are running
 
         if not agentConfig['collect_instance_metadata']:
             log.info("Instance metadata collection is disabled. Not collecting it.")
             return {}
 
-        socket_to = None
-        try:
-            socket_to = socket.getdefaulttimeout()
-            socket.setdefaulttimeout(EC2.TIMEOUT)
-        except Exception:
-            pass
-
         for k in ('instance-id', 'hostname', 'local-hostname', 'public-hostname', 'ami-id', 'local-ipv4', 'public-keys/', 'public-ipv4', 'reservation-id', 'security-groups'):
             try:
-                v = urllib2.urlopen(EC2.METADATA_URL_BASE + "/" + unicode(k)).read().strip()
+                v = urllib2.urlopen(EC2.METADATA_URL_BASE + "/" + unicode(k), timeout=EC2.TIMEOUT).read().strip()
                 assert type(v) in (types.StringType, types.UnicodeType) and len(v) > 0, "%s is not a string" % v
                 EC2.metadata[k.rstrip('/')] = v
             except Exception:
                 pass
 
-        try:
-            if socket_to is None:
-                socket_to = 3
-            socket.setdefaulttimeout(socket_to)
-        except Exception:
-            pass
-
+        _set_default_socket_timeout()
         return EC2.metadata
 
     @staticmethod
@@ -423,13 +496,43 @@ class EC2(object):
             return None
 
 
+def get_memory_usage_kb():
+    """
+    Return the resident memory of the current process, in kB.
+    Read from /proc/self/statm when available, which is much cheaper than
+    forking `ps`.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * (os.sysconf('SC_PAGE_SIZE') // 1024)
+    except (IOError, OSError, ValueError, IndexError):
+        out, _, _ = get_subprocess_output(['ps', '-p', str(os.getpid()), '-o', 'rss='], log)
+        return int(out.strip())
+
+
 class Watchdog(object):
     """Simple signal-based watchdog that will scuttle the current process
     if it has not been reset every N seconds, or if the processes exceeds
     a specified memory threshold.
     Can only be invoked once per process, so don't use with multiple threads.
     If you instantiate more than one, you're also asking for trouble.
+
+    With a memory threshold, the memory usage is checked on every reset:
+    * above SOFT_MEMORY_RATIO of the threshold, memory pressure handlers
+      (see `add_memory_pressure_handler`) are called so that the process
+      can shed some load, e.g. drop old transactions. While the usage stays
+      above it, they're called again every SHED_INTERVAL_RESETS resets.
+      The pressure is over after RELEASE_RESETS resets in a row under the
+      soft limit: the RSS rarely goes much lower after shedding, as freed
+      memory is kept by the allocator.
+    * above HARD_MEMORY_RATIO, even after shedding, the process is killed
     """
+    SOFT_MEMORY_RATIO = 0.8
+    HARD_MEMORY_RATIO = 0.95
+    SHED_INTERVAL_RESETS = 10
+    RELEASE_RESETS = 10
+
     def __init__(self, duration, max_mem_mb = None):
         import resource
 
@@ -437,6 +540,14 @@ class Watchdog(object):
         self._duration = int(duration)
         signal.signal(signal.SIGALRM, Watchdog.self_destruct)
 
+        self._memory_pressure_handlers = []
+        self.memory_usage_kb = None
+        self.under_memory_pressure = False
+        # Number of resets that found the process above its soft budget
+        self.memory_pressure_count = 0
+        self._resets_since_shed = 0
+        self._resets_under_soft_limit = 0
+
         # cap memory usage
         if max_mem_mb is not None:
             self._max_mem_kb = 1024 * max_mem_mb
@@ -446,6 +557,54 @@ class Watchdog(object):
         else:
             self.memory_limit_enabled = False
 
+    def add_memory_pressure_handler(self, handler):
+        """
+        `handler(under_pressure)` is called with True when the process is
+        found above its soft memory budget (and periodically while it stays
+        above it), and with False once the pressure is over.
+        """
+        self._memory_pressure_handlers.append(handler)
+
+    def _call_memory_pressure_handlers(self, under_pressure):
+        for handler in self._memory_pressure_handlers:
+            try:
+                handler(under_pressure)
+            except Exception:
+                log.exception("Error in memory pressure handler %s", handler)
+
+    def _check_memory(self):
+        mem_usage_kb = get_memory_usage_kb()
+        soft_limit_kb = self.SOFT_MEMORY_RATIO * self._max_mem_kb
+
+        if mem_usage_kb > soft_limit_kb:
+            self.memory_pressure_count += 1
+            self._resets_under_soft_limit = 0
+            self._resets_since_shed += 1
+            if not self.under_memory_pressure \
+                    or self._resets_since_shed >= self.SHED_INTERVAL_RESETS:
+                log.warning("Memory usage of %s kB is above the soft limit of %d kB, shedding load",
+                            mem_usage_kb, soft_limit_kb)
+                self.under_memory_pressure = True
+                self._resets_since_shed = 0
+                self._call_memory_pressure_handlers(True)
+                if self._memory_pressure_handlers:
+                    mem_usage_kb = get_memory_usage_kb()
+        elif self.under_memory_pressure:
+            self._resets_under_soft_limit += 1
+            if self._resets_under_soft_limit >= self.RELEASE_RESETS:
+                log.info("Memory usage of %s kB stayed under %d kB, the pressure is over",
+                         mem_usage_kb, soft_limit_kb)
+                self.under_memory_pressure = False
+                self._resets_since_shed = 0
+                self._resets_under_soft_limit = 0
+                self._call_memory_pressure_handlers(False)
+
+        self.memory_usage_kb = mem_usage_kb
+        if mem_usage_kb > self.HARD_MEMORY_RATIO * self._max_mem_kb:
+            log.error("Memory usage of %s kB is above the hard limit of %d kB",
+                      mem_usage_kb, self.HARD_MEMORY_RATIO * self._max_mem_kb)
+            Watchdog.self_destruct(signal.SIGKILL, sys._getframe(0))
+
     @staticmethod
     def self_destruct(signum, frame):
         try:
@@ -459,9 +618,7 @@ class Watchdog(object):
     def reset(self):
         # self destruct if using too much memory, as tornado will swallow MemoryErrors
         if self.memory_limit_enabled:
-            mem_usage_kb = int(os.popen('ps -p %d -o %s | tail -1' % (os.getpid(), 'rss')).read())
-            if mem_usage_kb > (0.95 * self._max_mem_kb):
-                Watchdog.self_destruct(signal.SIGKILL, sys._getframe(0))
+            self._check_memory()
 
         log.debug("Resetting watchdog for %d" % self._duration)
         signal.alarm(self._duration)
@@ -0,0 +1,124 @@
+# stdlib
+import threading
+import time
+import urlparse
+
+# 3p
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 4
+
+
+class HTTPClient(object):
+    """
+    HTTP client meant to be kept for the lifetime of a check:
+
+    * requests are made with one `requests.Session` per key (e.g. per
+      instance), so the connections and TLS sessions to an endpoint are
+      reused from one run to the next instead of being set up again
+    * with `conditional=True`, the ETag and Last-Modified headers of the
+      last response of a URL are sent back with the next request, and a
+      304 answer returns that last response again
+    * there are never more than `max_connections_per_host` requests in
+      flight to the same host
+    * the number of requests, errors, 304 answers and the time spent
+      are counted per host, see `get_stats`
+    """
+
+    def __init__(self, default_headers=None, max_connections_per_host=DEFAULT_MAX_CONNECTIONS_PER_HOST):
+        self.default_headers = default_headers or {}
+        self.max_connections_per_host = max_connections_per_host
+
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._host_semaphores = {}
+        # (session key, url) -> last response with validators
+        self._last_responses = {}
+        self._stats = {}
+
+    def session(self, key=None):
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                session.headers.update(self.default_headers)
+                for prefix in ('http://', 'https://'):
+                    session.mount(prefix, HTTPAdapter(pool_maxsize=self.max_connections_per_host))
+                self._sessions[key] = session
+            return session
+
+    def _get_host_semaphore(self, host):
+        with self._lock:
+            semaphore = self._host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.max_connections_per_host)
+                self._host_semaphores[host] = semaphore
+            return semaphore
+
+    def _record(self, host, duration, error=False, not_modified=False):
+        with self._lock:
+            stats = self._stats.get(host)
+            if stats is None:
+                stats = self._stats[host] = {'requests': 0, 'errors': 0, 'not_modified': 0, 'time': 0.0}
+            stats['requests'] += 1
+            stats['time'] += duration
+            if error:
+                stats['errors'] += 1
+            if not_modified:
+                stats['not_modified'] += 1
+
+    def get(self, url, key=None, conditional=False, **kwargs):
+        return self.request('GET', url, key=key, conditional=conditional, **kwargs)
+
+    def request(self, method, url, key=None, conditional=False, **kwargs):
+        """
+        Same as `requests.request`, with the session of `key`.
+        """
+        session = self.session(key)
+
+        last_response = None
+        if conditional:
+            last_response = self._last_responses.get((key, url))
+            if last_response is not None:
+                headers = dict(kwargs.get('headers') or {})
+                if 'ETag' in last_response.headers:
+                    headers['If-None-Match'] = last_response.headers['ETag']
+                if 'Last-Modified' in last_response.headers:
+                    headers['If-Modified-Since'] = last_response.headers['Last-Modified']
+                kwargs['headers'] = headers
+
+        host = urlparse.urlsplit(url).netloc
+        start = time.time()
+        with self._get_host_semaphore(host):
+            try:
+                response = session.request(method, url, **kwargs)
+            except Exception:
+                self._record(host, time.time() - start, error=True)
+                raise
+
+        not_modified = response.status_code == 304 and last_response is not None
+        self._record(host, time.time() - start, error=response.status_code >= 400, not_modified=not_modified)
+
+        if conditional:
+            if not_modified:
+                return last_response
+            if response.ok and ('ETag' in response.headers or 'Last-Modified' in response.headers):
+                # Read the body now so that it can be returned again
+                response.content
+                self._last_responses[(key, url)] = response
+            else:
+                self._last_responses.pop((key, url), None)
+
+        return response
+
+    def get_stats(self):
+        with self._lock:
+            return dict((host, dict(stats)) for host, stats in self._stats.iteritems())
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.itervalues():
+                session.close()
+            self._sessions = {}
+            self._last_responses = {}
@@ -0,0 +1,80 @@
+# stdlib
+from collections import OrderedDict
+import threading
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping holding at most `max_size` worth of entries, the
+    least recently used ones are evicted first.
+
+    The size of an entry is given by `sizeof(key, value)`, 1 by default
+    so that `max_size` is a number of entries.
+    """
+
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self._sizeof = sizeof or (lambda key, value: 1)
+        self._lock = threading.Lock()
+        # key -> (value, size), least recently used first
+        self._entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Most recently used now
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        size = self._sizeof(key, value)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            if size > self.max_size:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute, *args):
+        """
+        Return the value of `key`, computed with `compute(*args)` and
+        cached on a miss.
+        """
+        value = self.get(key, self)
+        if value is self:
+            value = compute(*args)
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'size': self.size,
+            }
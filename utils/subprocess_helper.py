@@ -0,0 +1,207 @@
+"""
+Helper process running the commands of `get_subprocess_output`, see
+`utils.subprocess_output.SubprocessHelper`.
+
+It's started once by the collector as a fresh interpreter, so that its
+address space stays small and spawning commands is cheap, then reads
+framed requests on its stdin and streams the output of the commands back
+on its stdout.
+
+A frame is a `FRAME_HEADER` (request id, kind, payload length) followed
+by the payload. Requests are RUN frames, holding a JSON object:
+    {"command": [...], "shell": false, "timeout": 10, "env_id": 1, "env": {...}}
+`env` is only sent the first time an environment is used, the following
+requests only give its `env_id`.
+
+Answers are STDOUT and STDERR frames with the output, then one of
+EXIT (payload: the return code), TIMEOUT or FAILED (payload: JSON with
+the `errno` and `strerror` of the error raised when spawning).
+
+Only the standard library may be imported here.
+"""
+# stdlib
+import errno
+import json
+import os
+import select
+import signal
+import struct
+import subprocess
+import sys
+import time
+
+FRAME_HEADER = struct.Struct('!IBI')
+
+# Request
+RUN = 1
+# Answers
+STDOUT = 2
+STDERR = 3
+EXIT = 4
+TIMEOUT = 5
+FAILED = 6
+
+READ_SIZE = 65536
+# How often the commands which closed their output are polled
+POLL_INTERVAL = 0.005
+
+
+def _to_str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_to_str(v) for v in value]
+    return value
+
+
+class Command(object):
+
+    def __init__(self, request_id, proc, timeout):
+        self.request_id = request_id
+        self.proc = proc
+        self.deadline = time.time() + timeout if timeout else None
+        self.fds = {
+            proc.stdout.fileno(): (STDOUT, proc.stdout),
+            proc.stderr.fileno(): (STDERR, proc.stderr),
+        }
+
+
+class Helper(object):
+
+    def __init__(self, stdin, stdout):
+        self.stdin = stdin
+        self.stdout = stdout
+        self._buffer = ''
+        self._devnull = open(os.devnull)
+        # output fd -> Command
+        self._fds = {}
+        # Commands whose output is closed, not exited yet
+        self._exiting = []
+        self._commands = set()
+        self._envs = {}
+
+    def send(self, request_id, kind, payload=''):
+        self.stdout.write(FRAME_HEADER.pack(request_id, kind, len(payload)) + payload)
+        self.stdout.flush()
+
+    def run(self):
+        stdin_fd = self.stdin.fileno()
+        while True:
+            now = time.time()
+            deadlines = [c.deadline for c in self._commands if c.deadline is not None]
+            timeout = max(min(deadlines) - now, 0) if deadlines else None
+            if self._exiting:
+                timeout = min(timeout, POLL_INTERVAL) if timeout is not None else POLL_INTERVAL
+
+            try:
+                readable, _, _ = select.select([stdin_fd] + self._fds.keys(), [], [], timeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd in readable:
+                if fd == stdin_fd:
+                    data = os.read(stdin_fd, READ_SIZE)
+                    if not data:
+                        # The collector is gone
+                        self.kill_all()
+                        return
+                    self._buffer += data
+                    self._handle_requests()
+                elif fd in self._fds:
+                    self._read_output(fd)
+
+            self._reap()
+
+    def _handle_requests(self):
+        while len(self._buffer) >= FRAME_HEADER.size:
+            request_id, kind, length = FRAME_HEADER.unpack_from(self._buffer)
+            if len(self._buffer) < FRAME_HEADER.size + length:
+                return
+            payload = self._buffer[FRAME_HEADER.size:FRAME_HEADER.size + length]
+            self._buffer = self._buffer[FRAME_HEADER.size + length:]
+            if kind == RUN:
+                self._start(request_id, json.loads(payload))
+
+    def _start(self, request_id, request):
+        env = None
+        env_id = request.get('env_id')
+        if env_id is not None:
+            if request.get('env') is not None:
+                env = dict(os.environ)
+                env.update(_to_str(request['env']))
+                self._envs[env_id] = env
+            env = self._envs.get(env_id)
+
+        try:
+            proc = subprocess.Popen(_to_str(request['command']),
+                                    close_fds=True,
+                                    shell=request.get('shell', False),
+                                    stdin=self._devnull,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    env=env)
+        except OSError as e:
+            self.send(request_id, FAILED, json.dumps({'errno': e.errno, 'strerror': e.strerror}))
+            return
+
+        command = Command(request_id, proc, request.get('timeout'))
+        self._commands.add(command)
+        for fd in command.fds:
+            self._fds[fd] = command
+
+    def _read_output(self, fd):
+        command = self._fds[fd]
+        kind, f = command.fds[fd]
+        data = os.read(fd, READ_SIZE)
+        if data:
+            self.send(command.request_id, kind, data)
+            return
+
+        f.close()
+        del command.fds[fd]
+        del self._fds[fd]
+        if not command.fds:
+            self._exiting.append(command)
+
+    def _reap(self):
+        for command in list(self._exiting):
+            returncode = command.proc.poll()
+            if returncode is not None:
+                self._exiting.remove(command)
+                self._commands.discard(command)
+                self.send(command.request_id, EXIT, str(returncode))
+
+        now = time.time()
+        for command in list(self._commands):
+            if command.deadline is not None and command.deadline <= now:
+                self._kill(command)
+                self.send(command.request_id, TIMEOUT)
+
+    def _kill(self, command):
+        try:
+            command.proc.kill()
+        except OSError:
+            pass
+        command.proc.wait()
+        for fd, (_, f) in command.fds.items():
+            f.close()
+            del self._fds[fd]
+        if command in self._exiting:
+            self._exiting.remove(command)
+        self._commands.discard(command)
+
+    def kill_all(self):
+        for command in list(self._commands):
+            self._kill(command)
+
+
+def main():
+    # Ctrl-C is meant for the collector, the helper exits with it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Helper(sys.stdin, sys.stdout).run()
+
+
+if __name__ == '__main__':
+    main()
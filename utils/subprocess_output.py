@@ -2,22 +2,230 @@
 from contextlib import nested
 from functools import wraps
 import logging
+import os
 import subprocess
+import sys
 import tempfile
+import threading
+
+# 3p
+import simplejson as json
 
 # project
+from utils import subprocess_helper as helper_protocol
 from utils.platform import Platform
 
 log = logging.getLogger(__name__)
 
+HELPER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'subprocess_helper.py')
+# Waiting on the answer in short steps lets the main thread handle signals,
+# e.g. the SIGALRM of the watchdog
+WAIT_STEP = 0.5
+
+
+class SubprocessTimeout(Exception):
+    pass
+
+
+class SubprocessHelperError(Exception):
+    pass
+
 
-# FIXME: python 2.7 has a far better way to do this
-def get_subprocess_output(command, log, shell=False, stdin=None):
+class _Request(object):
+
+    def __init__(self):
+        self.stdout = []
+        self.stderr = []
+        self.done = threading.Event()
+        self.returncode = None
+        self.error = None
+
+
+class SubprocessHelper(object):
     """
-    Run the given subprocess command and return it's output. Raise an Exception
-    if an error occurs.
+    Client of the helper process running the commands, see
+    `utils.subprocess_helper`.
+
+    Spawning a command from the collector copies its page tables, which
+    gets slow as it grows: the helper is a small process started once,
+    commands are sent to it over a pipe, run concurrently and their output
+    is streamed back. Thread-safe.
     """
 
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._proc = None
+        self._reader = None
+        self._disabled = False
+        self._pid = None
+        self._next_id = 0
+        self._requests = {}
+        # environment items -> id of the environment in the helper
+        self._envs = {}
+
+    def _ensure_started(self):
+        # Called with the lock held. A forked child needs its own helper.
+        if self._proc is not None and self._pid == os.getpid():
+            return self._proc
+        if self._proc is not None:
+            # The helper of the parent: keeping its stdin open would keep
+            # it from exiting with the parent
+            self._close_inherited()
+        if self._disabled:
+            raise SubprocessHelperError("The subprocess helper couldn't be started")
+
+        try:
+            proc = subprocess.Popen([sys.executable, HELPER_PATH],
+                                    close_fds=True,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+        except OSError as e:
+            # Don't try again on each command
+            self._disabled = True
+            raise SubprocessHelperError("Unable to start the subprocess helper: %s" % e)
+        self._proc = proc
+        self._pid = os.getpid()
+        self._requests = {}
+        self._envs = {}
+        reader = threading.Thread(target=self._read_answers, args=(proc,), name="SubprocessHelper")
+        reader.daemon = True
+        reader.start()
+        self._reader = reader
+        log.debug("Started the subprocess helper, pid %s", proc.pid)
+        return proc
+
+    def _close_inherited(self):
+        proc, self._proc = self._proc, None
+        self._reader = None
+        self._requests = {}
+        for pipe in (proc.stdin, proc.stdout):
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+
+    def _read_answers(self, proc):
+        try:
+            while True:
+                header = proc.stdout.read(helper_protocol.FRAME_HEADER.size)
+                if len(header) < helper_protocol.FRAME_HEADER.size:
+                    break
+                request_id, kind, length = helper_protocol.FRAME_HEADER.unpack(header)
+                payload = proc.stdout.read(length) if length else ''
+                self._handle_answer(request_id, kind, payload)
+        except Exception:
+            log.exception("Error while reading the answers of the subprocess helper")
+
+        # The helper is gone, fail its pending requests
+        with self._lock:
+            if self._proc is proc:
+                self._proc = None
+                requests, self._requests = self._requests, {}
+            else:
+                requests = {}
+        for request in requests.itervalues():
+            request.error = SubprocessHelperError("The subprocess helper exited")
+            request.done.set()
+        try:
+            proc.wait()
+        except OSError:
+            pass
+
+    def _handle_answer(self, request_id, kind, payload):
+        if kind in (helper_protocol.STDOUT, helper_protocol.STDERR):
+            request = self._requests.get(request_id)
+            if request is not None:
+                (request.stdout if kind == helper_protocol.STDOUT else request.stderr).append(payload)
+            return
+
+        with self._lock:
+            request = self._requests.pop(request_id, None)
+        if request is None:
+            return
+        if kind == helper_protocol.EXIT:
+            request.returncode = int(payload)
+        elif kind == helper_protocol.TIMEOUT:
+            request.error = SubprocessTimeout()
+        elif kind == helper_protocol.FAILED:
+            error = json.loads(payload)
+            request.error = OSError(error['errno'], error['strerror'])
+        request.done.set()
+
+    def run(self, command, shell=False, timeout=None, env=None):
+        """
+        Run `command` in the helper, return `(stdout, stderr, returncode)`.
+
+        :param timeout: kill the command and raise `SubprocessTimeout` after
+            that many seconds
+        :param env: variables to add to the environment of the command.
+            The helper keeps the resulting environments to reuse them.
+        """
+        request = _Request()
+        message = {'command': command, 'shell': shell, 'timeout': timeout}
+        with self._lock:
+            proc = self._ensure_started()
+
+            if env is not None:
+                env_key = tuple(sorted(env.iteritems()))
+                env_id = self._envs.get(env_key)
+                if env_id is None:
+                    env_id = len(self._envs)
+                    message['env'] = env
+                message['env_id'] = env_id
+
+            try:
+                payload = json.dumps(message)
+            except (TypeError, ValueError) as e:
+                # e.g. arguments which aren't UTF-8
+                raise SubprocessHelperError("Unable to send %r to the subprocess helper: %s" % (command, e))
+            if env is not None:
+                self._envs[env_key] = env_id
+
+            self._next_id = (self._next_id + 1) % 2 ** 32
+            request_id = self._next_id
+            self._requests[request_id] = request
+            try:
+                proc.stdin.write(helper_protocol.FRAME_HEADER.pack(request_id, helper_protocol.RUN, len(payload)) + payload)
+                proc.stdin.flush()
+            except (IOError, OSError) as e:
+                self._requests.pop(request_id, None)
+                self._proc = None
+                raise SubprocessHelperError("Unable to send the command to the subprocess helper: %s" % e)
+
+        while not request.done.wait(WAIT_STEP):
+            pass
+        if request.error is not None:
+            raise request.error
+        return ''.join(request.stdout), ''.join(request.stderr), request.returncode
+
+    def stop(self, timeout=5):
+        """
+        Stop the helper and wait at most `timeout` seconds for its reader
+        thread. It's started again by the next command.
+        """
+        with self._lock:
+            proc, self._proc = self._proc, None
+            reader, self._reader = self._reader, None
+        if proc is not None:
+            # The helper exits when its stdin is closed
+            proc.stdin.close()
+        if reader is not None and reader is not threading.current_thread():
+            reader.join(timeout)
+
+
+# Not on Windows, where the helper can't `select` pipes
+_helper = SubprocessHelper() if not Platform.is_windows() else None
+
+
+def stop_subprocess_helper():
+    if _helper is not None:
+        _helper.stop()
+
+
+def _run_directly(command, shell, stdin, timeout, env):
+    if env is not None:
+        env = dict(os.environ, **env)
+
     # Use tempfile, allowing a larger amount of memory. The subprocess.Popen
     # docs warn that the data read is buffered in memory. They suggest not to
     # use subprocess.PIPE if the data size is large or unlimited.
@@ -27,17 +235,59 @@ def get_subprocess_output(command, log, shell=False, stdin=None):
                                 shell=shell,
                                 stdin=stdin,
                                 stdout=stdout_f,
-                                stderr=stderr_f)
+                                stderr=stderr_f,
+                                env=env)
+        timer = None
+        timed_out = threading.Event()
+        if timeout:
+            def kill():
+                timed_out.set()
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+            timer = threading.Timer(timeout, kill)
+            timer.start()
         proc.wait()
+        if timer is not None:
+            timer.cancel()
+        if timed_out.is_set():
+            raise SubprocessTimeout()
+
         stderr_f.seek(0)
         err = stderr_f.read()
-        if err:
-            log.debug("Error while running {0} : {1}".format(" ".join(command),
-                                                             err))
-
         stdout_f.seek(0)
         output = stdout_f.read()
-    return (output, err, proc.returncode)
+    return output, err, proc.returncode
+
+
+def get_subprocess_output(command, log, shell=False, stdin=None, timeout=None, env=None):
+    """
+    Run the given subprocess command and return it's output. Raise an Exception
+    if an error occurs.
+
+    Commands are run by the subprocess helper when possible, see
+    `SubprocessHelper`.
+
+    :param timeout: kill the command and raise `SubprocessTimeout` after
+        that many seconds
+    :param env: variables to add to the environment of the command
+    """
+    result = None
+    if _helper is not None and stdin is None:
+        try:
+            result = _helper.run(command, shell=shell, timeout=timeout, env=env)
+        except SubprocessHelperError as e:
+            log.debug("Running %s without the subprocess helper: %s", command, e)
+
+    if result is None:
+        result = _run_directly(command, shell, stdin, timeout, env)
+
+    output, err, returncode = result
+    if err:
+        log.debug("Error while running {0} : {1}".format(" ".join(command),
+                                                         err))
+    return (output, err, returncode)
 
 
 def log_subprocess(func):
@@ -1,102 +1,368 @@
 import binascii
+import ctypes
+import ctypes.util
+import errno
+import io
 import os
+import select
+import struct
 from stat import ST_INO, ST_SIZE
 
 
+class Inotify(object):
+    """
+    Minimal ctypes binding around the Linux inotify API, used by TailFile
+    to know whether a file changed since the last read without polling it.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_MOVE_SELF = 0x00000800
+    IN_DELETE_SELF = 0x00000400
+    IN_IGNORED = 0x00008000
+
+    IN_CLOEXEC = 0o2000000
+    IN_NONBLOCK = 0o4000
+
+    WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF
+    EVENT_HEADER = struct.Struct('iIII')
+
+    _libc = None
+
+    @classmethod
+    def _load_libc(cls):
+        if cls._libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            # Raises AttributeError if inotify is not supported
+            libc.inotify_init1
+            libc.inotify_add_watch
+            libc.inotify_rm_watch
+            cls._libc = libc
+        return cls._libc
+
+    @classmethod
+    def is_available(cls):
+        try:
+            cls._load_libc()
+            return True
+        except Exception:
+            return False
+
+    def __init__(self):
+        self._libc = self._load_libc()
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._wd = None
+
+    def fileno(self):
+        return self._fd
+
+    def watch(self, path):
+        """Watch `path`, replacing any previous watch."""
+        self.unwatch()
+        wd = self._libc.inotify_add_watch(self._fd, path, self.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._wd = wd
+
+    def unwatch(self):
+        if self._wd is not None:
+            self._libc.inotify_rm_watch(self._fd, self._wd)
+            self._wd = None
+
+    def read_events(self):
+        """
+        Drain pending events without blocking.
+        Return the OR'ed mask of the events that were read, 0 if none.
+        """
+        mask = 0
+        while True:
+            try:
+                data = os.read(self._fd, 4096)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return mask
+                raise
+            if not data:
+                return mask
+
+            offset = 0
+            header_size = self.EVENT_HEADER.size
+            while offset + header_size <= len(data):
+                _, event_mask, _, name_len = self.EVENT_HEADER.unpack_from(data, offset)
+                mask |= event_mask
+                offset += header_size + name_len
+
+            if mask & self.IN_IGNORED:
+                # The kernel dropped the watch (file deleted, unmounted...)
+                self._wd = None
+
+    def wait(self, timeout):
+        """Block until an event is pending or `timeout` seconds elapsed."""
+        try:
+            readable, _, _ = select.select([self._fd], [], [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        return bool(readable)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._wd = None
+
+
 class TailFile(object):
+    """
+    Follow a file and run `callback` on every complete line written to it.
+
+    The file is read in blocks into a reusable buffer and split in bulk.
+    Rotation (new inode), truncation (smaller size) and copytruncate
+    (different CRC of the first bytes) are only looked for once the end
+    of the file is reached. When inotify is available, these checks and
+    the read itself are skipped entirely as long as the file didn't change.
+    The inotify instance only exists while `tail()` runs.
+    """
 
     CRC_SIZE = 16
+    BLOCK_SIZE = 64 * 1024
+
+    ROTATED = 'rotated'
+    TRUNCATED = 'truncated'
 
-    def __init__(self, logger, path, callback):
+    def __init__(self, logger, path, callback, block_size=BLOCK_SIZE, use_inotify=True):
         self._path = path
         self._f = None
         self._inode = None
         self._size = 0
         self._crc = None
+        self._pos = 0
+        self._offset = 0
         self._log = logger
         self._callback = callback
 
-    def _open_file(self, move_end=False, pos=False):
+        self._block_size = block_size
+        self._buffer = bytearray(block_size)
+        self._partial = ''
+
+        self._use_inotify = use_inotify
+        self._inotify = None
+        self._inotify_watching = False
 
-        already_open = False
-        # close and reopen to handle logrotate
+    def _init_inotify(self):
+        if self._inotify is not None or not self._use_inotify or not Inotify.is_available():
+            return
+        try:
+            self._inotify = Inotify()
+        except OSError, e:
+            self._log.debug("Cannot use inotify to follow %s: %s" % (self._path, e))
+
+    def _read_crc(self, size):
+        if size < self.CRC_SIZE:
+            return None
+        self._f.seek(0)
+        data = self._f.read(self.CRC_SIZE)
+        self._f.seek(self._pos)
+        return binascii.crc32(data)
+
+    def _watch(self):
+        if self._inotify is None:
+            return
+        try:
+            self._inotify.watch(self._path)
+            self._inotify_watching = True
+        except OSError, e:
+            self._log.debug("Cannot watch %s with inotify: %s" % (self._path, e))
+            self._inotify_watching = False
+
+    def _open_file(self, move_end=False, pos=False):
         if self._f is not None:
             self._f.close()
             self._f = None
-            already_open = True
-
-        stat = os.stat(self._path)
-        inode = stat[ST_INO]
-        size = stat[ST_SIZE]
-
-        # Compute CRC of the beginning of the file
-        crc = None
-        if size >= self.CRC_SIZE:
-            tmp_file = open(self._path, 'r')
-            data = tmp_file.read(self.CRC_SIZE)
-            crc = binascii.crc32(data)
-
-        if already_open:
-            # Check if file has been removed
-            if self._inode is not None and inode != self._inode:
-                self._log.debug("File removed, reopening")
-                move_end = False
-                pos = False
-
-            # Check if file has been truncated
-            elif self._size > 0 and size < self._size:
-                self._log.debug("File truncated, reopening")
-                move_end = False
-                pos = False
-
-            # Check if file has been truncated and too much data has
-            # alrady been written (copytruncate and opened files...)
-            if size >= self.CRC_SIZE and self._crc is not None and crc != self._crc:
-                self._log.debug("Begining of file modified, reopening")
-                move_end = False
-                pos = False
-
-        self._inode = inode
-        self._size = size
-        self._crc = crc
 
-        self._f = open(self._path, 'r')
+        # Watch before opening so that no write can slip in between
+        self._watch()
+
+        self._f = io.open(self._path, 'rb', buffering=0)
+        stat = os.fstat(self._f.fileno())
+        self._inode = stat[ST_INO]
+        self._size = stat[ST_SIZE]
+        self._partial = ''
+
         if move_end:
             self._log.debug("Opening file %s" % (self._path))
-            self._f.seek(0, os.SEEK_END)
+            self._pos = self._size
         elif pos:
             self._log.debug("Reopening file %s at %s" % (self._path, pos))
-            self._f.seek(pos)
+            self._pos = pos
+        else:
+            self._pos = 0
+
+        self._offset = self._pos
+        self._crc = self._read_crc(self._size)
+        self._f.seek(self._pos)
 
         return True
 
-    def tail(self, line_by_line=True, move_end=True):
+    def _has_changed(self):
+        """
+        Whether the file may have changed since we last reached its end.
+        Without inotify we can't know, so assume it did.
+        """
+        if self._inotify is None or not self._inotify_watching:
+            return True
+        mask = self._inotify.read_events()
+        if mask & Inotify.IN_IGNORED:
+            self._inotify_watching = False
+        return mask != 0
+
+    def _check_rotation(self):
+        """
+        Called at EOF. Return ROTATED if another file now lives at `path`,
+        TRUNCATED if the file was truncated or rewritten in place, and
+        None if it can still be read from the current position.
+        """
+        try:
+            inode = os.stat(self._path)[ST_INO]
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Rotated away and not recreated yet, keep following the old file
+            self._inotify_watching = False
+            return None
+
+        if inode != self._inode:
+            self._log.debug("File removed, reopening")
+            return self.ROTATED
+
+        size = os.fstat(self._f.fileno())[ST_SIZE]
+        if size < self._pos:
+            self._log.debug("File truncated, reopening")
+            return self.TRUNCATED
+
+        # Check if file has been truncated and too much data has
+        # already been written (copytruncate and opened files...)
+        crc = self._read_crc(size)
+        if crc is not None and self._crc is not None and crc != self._crc:
+            self._log.debug("Begining of file modified, reopening")
+            return self.TRUNCATED
+
+        if not self._inotify_watching:
+            self._watch()
+
+        self._size = size
+        self._crc = crc
+        return None
+
+    def _read_block(self):
+        """
+        Read the next block of the file and return the complete lines it
+        holds, as they are in the file. An empty list means EOF was reached.
+        """
+        lines = []
+        while not lines:
+            n = self._f.readinto(self._buffer)
+            if not n:
+                return lines
+
+            data = self._partial + memoryview(self._buffer)[:n].tobytes()
+            lines = data.split('\n')
+            self._partial = lines.pop()
+            self._pos += n
+
+        return lines
+
+    @staticmethod
+    def _strip_holes(line):
+        if '\0' in line:
+            # a truncate may have create holes in the file
+            return line.strip(chr(0))
+        return line
+
+    def position(self):
+        """
+        Return (inode, offset) of the end of the last line handed to the
+        callback, i.e. where to resume reading without skipping a line.
+        """
+        return self._inode, self._offset
+
+    def wait(self, timeout):
+        """
+        Block until the file changes or `timeout` seconds elapsed.
+        Return True if woken up by a change. Without inotify, just sleep.
+        """
+        if self._inotify is None or not self._inotify_watching:
+            select.select([], [], [], timeout)
+            return False
+        return self._inotify.wait(timeout)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+            self._inotify_watching = False
+
+    def tail(self, line_by_line=True, move_end=True, pos=None):
         """Read line-by-line and run callback on each line.
         line_by_line: yield each time a callback has returned True
-        move_end: start from the last line of the log"""
+        move_end: start from the last line of the log
+        pos: start from this offset instead, e.g. a saved `position()`"""
+        callback = self._callback
+        strip_holes = self._strip_holes
         try:
-            self._open_file(move_end=move_end)
+            self._init_inotify()
+            if pos is not None:
+                self._open_file(move_end=False, pos=pos)
+            else:
+                self._open_file(move_end=move_end)
 
             while True:
-                pos = self._f.tell()
-                line = self._f.readline()
-                if line:
-                    line = line.strip(chr(0))  # a truncate may have create holes in the file
-                    if self._callback(line.rstrip("\n")):
-                        if line_by_line:
+                lines = self._read_block()
+                if lines:
+                    # The offset of the end of each line in the file
+                    offset = self._offset
+                    for line in lines:
+                        offset += len(line) + 1
+                        if callback(strip_holes(line)) and line_by_line:
+                            self._offset = offset
                             yield True
-                            pos = self._f.tell()
-                            self._open_file(move_end=False, pos=pos)
-                        else:
-                            continue
-                    else:
-                        continue
-                else:
+                    self._offset = offset
+                    continue
+
+                yield True
+
+                # Nothing to read nor to check until the file changes
+                while not self._has_changed():
                     yield True
-                    assert pos == self._f.tell()
-                    self._open_file(move_end=False, pos=pos)
+
+                rotation = self._check_rotation()
+                if rotation == self.ROTATED:
+                    # Consume what was appended to the old file before it went away
+                    for line in self._drain():
+                        if callback(line) and line_by_line:
+                            yield True
+                if rotation is not None:
+                    self._open_file(move_end=False)
 
         except Exception, e:
             # log but survive
             self._log.exception(e)
             raise StopIteration(e)
+        finally:
+            self.close()
+
+    def _drain(self):
+        lines = []
+        while True:
+            block = self._read_block()
+            if not block:
+                return lines
+            lines.extend(self._strip_holes(line) for line in block)
@@ -0,0 +1,121 @@
+# stdlib
+import calendar
+from datetime import datetime
+import time
+
+# Pseudo-format for timestamps already expressed in seconds since the epoch
+EPOCH = '%s'
+
+# Formats decoded by slicing, as (date/time separator, fraction separator)
+ISO_LAYOUTS = {
+    '%Y-%m-%d %H:%M:%S': (' ', None),
+    '%Y-%m-%d %H:%M:%S,%f': (' ', ','),
+    '%Y-%m-%d %H:%M:%S.%f': (' ', '.'),
+    '%Y-%m-%dT%H:%M:%S': ('T', None),
+    '%Y-%m-%dT%H:%M:%S.%f': ('T', '.'),
+}
+
+
+class _FractionMismatch(ValueError):
+    """
+    The value has the layout of an ISO format, but not its fraction of
+    seconds: `strptime` wouldn't parse it either.
+    """
+    pass
+
+
+class TimestampParser(object):
+    """
+    Convert timestamps to seconds since the epoch, trying `formats` in order.
+    Fractions of seconds are dropped, like `time.mktime` and
+    `calendar.timegm` do on a `timetuple()`.
+
+    Meant for timestamps read in order, e.g. from a log file:
+    * the last timestamp and its result are memoized, lines logged on
+      the same second don't parse anything
+    * ISO-like formats are decoded by slicing instead of `strptime`, and
+      the epoch of the last "YYYY-mm-dd HH:MM" prefix is memoized so that
+      only the seconds are decoded until the minute changes
+
+    Memos are single tuples, so that a parser can be shared by threads.
+    """
+
+    def __init__(self, formats=(EPOCH,), utc=True):
+        self.formats = tuple(formats)
+        self.utc = utc
+
+        self._last = (None, None)
+        self._last_prefix = (None, None)
+
+    def parse(self, value):
+        """
+        Return the epoch of `value`, raise ValueError if no format matches.
+        """
+        last_value, last_result = self._last
+        if value == last_value and last_value is not None:
+            return last_result
+
+        for fmt in self.formats:
+            try:
+                result = self._parse(value, fmt)
+                break
+            except (ValueError, TypeError):
+                pass
+        else:
+            raise ValueError("Unable to parse timestamp %r with formats %s" % (value, self.formats))
+
+        self._last = (value, result)
+        return result
+
+    def _parse(self, value, fmt):
+        if fmt == EPOCH:
+            return int(float(value))
+
+        if fmt in ISO_LAYOUTS:
+            try:
+                return self._parse_iso(value, *ISO_LAYOUTS[fmt])
+            except _FractionMismatch:
+                # e.g. "YYYY-mm-dd HH:MM:SS,fff" tried with the layout
+                # without fraction before the one with it
+                raise
+            except ValueError:
+                # Let strptime deal with the less common spellings
+                # it accepts, like unpadded fields
+                pass
+
+        return self._to_epoch(datetime.strptime(value, fmt).timetuple())
+
+    def _parse_iso(self, value, sep, frac_sep):
+        if len(value) < 19 or value[4] != '-' or value[7] != '-' or value[10] != sep \
+                or value[13] != ':' or value[16] != ':':
+            raise ValueError(value)
+
+        seconds = value[17:19]
+        if not seconds.isdigit() or int(seconds) > 61:
+            raise ValueError(value)
+
+        fraction = value[19:]
+        if frac_sep is None:
+            if fraction:
+                raise _FractionMismatch(value)
+        elif len(fraction) < 2 or len(fraction) > 7 or fraction[0] != frac_sep \
+                or not fraction[1:].isdigit():
+            raise _FractionMismatch(value)
+
+        prefix = value[:16]
+        last_prefix, minute_epoch = self._last_prefix
+        if prefix != last_prefix:
+            fields = (value[0:4], value[5:7], value[8:10], value[11:13], value[14:16])
+            if not ''.join(fields).isdigit():
+                raise ValueError(value)
+            # Validates the ranges of the fields
+            dt = datetime(*map(int, fields))
+            minute_epoch = self._to_epoch(dt.timetuple())
+            self._last_prefix = (prefix, minute_epoch)
+
+        return minute_epoch + int(seconds)
+
+    def _to_epoch(self, timetuple):
+        if self.utc:
+            return calendar.timegm(timetuple)
+        return time.mktime(timetuple)